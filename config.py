@@ -31,7 +31,119 @@ if "DATA_AFRICA_PRODUCTION" in os.environ:
 
 JSONIFY_PRETTYPRINT_REGULAR = False
 
-CACHE_TYPE = 'filesystem'
+CACHE_TYPE = 'data_africa.util.local_cache.local_cache'
 CACHE_DIR = os.path.join(basedir, 'cache/')
-CACHE_DEFAULT_TIMEOUT = os.environ.get("CACHE_DEFAULT_TIMEOUT", 60 * 60 * 24 * 7 * 4) # 28 days
+CACHE_DEFAULT_TIMEOUT = int(os.environ.get("CACHE_DEFAULT_TIMEOUT", 60 * 60 * 24 * 7 * 4)) # 28 days
 CACHE_THRESHOLD = 5000
+
+''' Byte cap of the shared local cache and per-namespace quotas as (name, key prefix, bytes); first matching prefix wins '''
+CACHE_LOCAL_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_NAMESPACES = [
+    ("join", "join/", 768 * 1024 * 1024),
+    ("attrs", "attrs/", 64 * 1024 * 1024),
+    ("metadata", "", 128 * 1024 * 1024),
+]
+
+''' Serve join and attrs requests from memory-mapped snapshots instead of Postgres '''
+SNAPSHOT_MODE = "DATA_AFRICA_SNAPSHOT_MODE" in os.environ
+SNAPSHOT_DIR = os.environ.get("DATA_AFRICA_SNAPSHOT_DIR", os.path.join(basedir, 'snapshots/'))
+SNAPSHOT_KEEP = 3
+
+''' Append one JSON line per API request to this file, for replay and cache warm-up '''
+QUERY_LOG_PATH = os.environ.get("DATA_AFRICA_QUERY_LOG", None)
+
+''' Per-endpoint statement_timeout budgets in ms, kept below gunicorn's 120s worker timeout '''
+STATEMENT_TIMEOUT_DEFAULT = 100000
+STATEMENT_TIMEOUTS = {
+    "core.api_join_view": 100000,
+    "core.logic_view": 30000,
+    "attrs.attrs": 30000,
+    "attrs.attrs_by_id": 10000,
+    "attrs.search_view": 10000,
+}
+
+''' Cost-based admission control. Queries whose estimated cost (rows touched, or the
+planner cost with "explain") exceeds max_cost are rejected, those above queue_cost
+wait for one of ADMISSION_HEAVY_SLOTS per worker. The None entry is the default. '''
+ADMISSION_CONTROL = True
+ADMISSION_BUDGETS = {
+    None: {"max_rows": 80000},
+    "core.api_join_view": {"max_rows": 80000, "queue_cost": 2000000,
+                           "max_cost": 50000000, "explain": False},
+}
+ADMISSION_HEAVY_SLOTS = 2
+ADMISSION_QUEUE_TIMEOUT = 30
+
+''' Order joins by estimated selectivity instead of joining every table to the first '''
+COST_BASED_JOINS = True
+
+''' Seconds before the in-process url_name and parent name lookups are rebuilt '''
+LOOKUP_MAX_AGE = 3600
+
+''' Ordering by a lookup column sorts in Python: most matching rows such a query may return '''
+LOOKUP_ORDER_MAX_ROWS = 100000
+
+''' /api/join/compact/ with layout=columns is built in memory: most rows it may return '''
+COMPACT_COLUMNS_MAX_ROWS = 50000
+
+''' Data version registry: the file holding the current version, or a "schema.table" holding it for every host instead, how often in seconds workers poll it before switching to a new version in the background, and the longest wait before retrying a failed switch '''
+DATA_VERSION_FILE = os.environ.get("DATA_AFRICA_VERSION_FILE", os.path.join(basedir, 'data_version'))
+DATA_VERSION_TABLE = os.environ.get("DATA_AFRICA_VERSION_TABLE")
+DATA_VERSION_POLL_INTERVAL = 5
+DATA_VERSION_MAX_RETRY_DELAY = 15 * 60
+
+''' Share one execution between identical concurrent join and map requests, within and across workers; requests with a limit above COALESCE_MAX_ROWS, and bodies above COALESCE_MAX_BYTES, are streamed instead '''
+COALESCE = True
+COALESCE_DIR = os.path.join(basedir, 'cache/coalesce/')
+COALESCE_WAIT = 30
+COALESCE_TTL = 5
+''' How long shared join and map responses stay in the cache when a data version is recorded '''
+RESULT_CACHE_TTL = 60 * 60 * 24
+COALESCE_MAX_BYTES = 4 * 1024 * 1024
+COALESCE_MAX_ROWS = 10000
+
+''' Cache-Control max-age in seconds of the precomputed variables endpoints; /api/years/ is revalidated instead '''
+METADATA_MAX_AGE = 60 * 60 * 24
+
+''' NDJSON join output: rows fetched per server-side cursor batch, and gzip with a sync flush every STREAM_FLUSH_BYTES '''
+NDJSON_BATCH_SIZE = 1000
+STREAM_GZIP = True
+STREAM_GZIP_LEVEL = 6
+STREAM_FLUSH_BYTES = 64 * 1024
+
+''' Run joins across schemas as concurrent per-table sub-queries, each on its own pooled connection, hash joined in Python '''
+PARALLEL_JOINS = False
+
+''' Prometheus metrics at /metrics; each worker writes its values to METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds '''
+METRICS = True
+METRICS_DIR = os.path.join(basedir, 'cache/metrics/')
+METRICS_FLUSH_INTERVAL = 10
+
+''' Log statements slower than SLOW_QUERY_THRESHOLD seconds to this file (rotated externally), with EXPLAIN (ANALYZE, BUFFERS) for a sampled fraction '''
+SLOW_QUERY_LOG = os.environ.get("DATA_AFRICA_SLOW_QUERY_LOG", None)
+SLOW_QUERY_THRESHOLD = 2.0
+SLOW_QUERY_EXPLAIN_SAMPLE = 0.1
+SLOW_QUERY_EXPLAIN_QUEUE = 16
+SLOW_QUERY_EXPLAIN_TIMEOUT = 60
+
+''' Precomputed TopoJSON shapes written by build_shapes: simplification tolerance in degrees per level, quantization grid size and GeoJSON digits read from PostGIS '''
+SHAPES_DIR = os.environ.get("DATA_AFRICA_SHAPES_DIR", os.path.join(basedir, 'shapes/'))
+SHAPES_LEVELS = {"high": 0.0, "medium": 0.005, "low": 0.02}
+SHAPES_DEFAULT_LEVEL = "medium"
+SHAPES_QUANTIZATION = 100000
+SHAPES_PRECISION = 6
+SHAPES_MAX_AGE = 60 * 60 * 24
+
+''' Point lookups at /api/locate/: grid cell size in degrees of the in-memory polygon index, points per request, and whether preload builds the index before forking '''
+LOCATE_GRID_SIZE = 0.25
+LOCATE_MAX_POINTS = 10000
+LOCATE_PRELOAD = False
+
+''' build_xwalks: worker processes, tolerance in percentage points of --check, and the poverty region geometries as {"table": "schema.table", "key": ..., "country": ..., "geom": ...}; without them only the DHS crosswalk is rebuilt '''
+XWALK_WORKERS = 4
+XWALK_CHECK_TOLERANCE = 1.0
+XWALK_POVERTY_GEOMETRY = None
+
+''' load_data: rows per Parquet batch, and how long in ms the final table swap may wait for running queries '''
+LOAD_BATCH_SIZE = 50000
+LOAD_LOCK_TIMEOUT = 30000
@@ -1,6 +1,7 @@
 import os
 from flask import Flask, jsonify
 from flask_cache import Cache
+from sqlalchemy.exc import OperationalError
 
 app = Flask(__name__)
 app.config.from_object('config')
@@ -8,9 +9,17 @@ cache = Cache(app)
 
 from data_africa.attrs.views import mod as attrs_module
 from data_africa.core.views import mod as core_module
+from data_africa.core.metrics import mod as metrics_module
+from data_africa.core import metrics
+from data_africa.core import pool_stats
+from data_africa.core import slowlog  # registers the engine event listeners
+from data_africa.core.exceptions import DataAfricaException, ServiceException, QueryTimeoutException
 
 app.register_blueprint(attrs_module)
 app.register_blueprint(core_module)
+app.register_blueprint(metrics_module)
+
+from data_africa import commands
 
 if os.environ.get("LOCAL_CORS", None):
     from flask_cors import CORS
@@ -18,4 +27,19 @@ if os.environ.get("LOCAL_CORS", None):
 
 @app.errorhandler(500)
 def error_page(err):
+    if isinstance(err, DataAfricaException):
+        metrics.count_exception(err)
     return jsonify(error=str(err)), 500
+
+
+@app.errorhandler(ServiceException)
+def service_error(err):
+    metrics.count_exception(err)
+    return jsonify(error=str(err)), err.status_code
+
+
+@app.errorhandler(OperationalError)
+def database_error(err):
+    if pool_stats.is_statement_timeout(err):
+        return service_error(QueryTimeoutException(pool_stats.TIMEOUT_MESSAGE))
+    raise err
@@ -2,8 +2,7 @@
 from data_africa.database import db
 from sqlalchemy.dialects import postgresql
 from data_africa.core.models import BaseModel
-from sqlalchemy.orm import column_property
-from sqlalchemy import select, and_
+from data_africa.core.lookups import lookup_property
 
 attr_map = {}
 
@@ -118,10 +117,7 @@ class DHSGeo(JoinableAttr, BaseModel):
     iso2 = db.Column(db.String)
     start_year = db.Column(db.Integer)
 
-    dhs_geo_parent_name = column_property(
-        select([Geo.name])
-        .where(and_(Geo.iso2 == iso2, Geo.level == 'adm0'))
-    )
+    dhs_geo_parent_name = lookup_property("adm0_name", iso2)
 
 
 class WaterSupply(BaseAttr):
@@ -0,0 +1,122 @@
+'''Prebuilt response bodies and id index for the attrs views
+
+Attribute tables only change when data is loaded, so each kind is read and
+serialized once per process. When a data version is recorded, the rows are
+read by one worker per host and shared with the others through the attrs
+namespace of the cache. Response bodies are kept per sumlevel
+combination and single attributes are found through a dictionary keyed by
+id and url_name. Payloads are kept per data version: the kinds and bodies
+in use are rebuilt in the background for a new version, and the old ones
+dropped once the process has switched to it.
+'''
+import simplejson
+
+from data_africa import app, cache
+from data_africa.core import data_version
+from data_africa.core import lookups
+from data_africa.core import snapshot
+
+_state = {"versions": {}}
+
+
+class AttrPayloads(object):
+    '''Serialized rows of one attribute kind'''
+
+    def __init__(self, headers, data):
+        self.headers = headers
+        self.data = data
+        self.bodies = {}
+        self.index = {}
+        level_idx = headers.index("level") if "level" in headers else None
+        self.levels = set(row[level_idx] for row in data) if level_idx is not None else set()
+        self._level_idx = level_idx
+        # ids take precedence over url_names
+        for key in ["url_name", "id"]:
+            if key in headers:
+                key_idx = headers.index(key)
+                for row in data:
+                    if row[key_idx] is not None:
+                        self.index[row[key_idx]] = row
+
+    def body(self, sumlevels=None):
+        '''JSON body and row count for the given sumlevels. Levels the
+        table does not contain match nothing, so they are dropped from the
+        key to keep the number of stored bodies bounded.'''
+        if sumlevels is not None:
+            sumlevels = tuple(sorted(self.levels.intersection(sumlevels)))
+        if sumlevels not in self.bodies:
+            data = self.data
+            if sumlevels is not None:
+                data = [row for row in data if self._level_idx is not None
+                        and row[self._level_idx] in sumlevels]
+            self.bodies[sumlevels] = (simplejson.dumps({"data": data, "headers": self.headers}),
+                                      len(data))
+        return self.bodies[sumlevels]
+
+    def find(self, attr_id):
+        return self.index.get(attr_id)
+
+
+def load_rows(attr_cls):
+    if app.config["SNAPSHOT_MODE"]:
+        try:
+            headers, data = snapshot.attr_rows(attr_cls)
+            return headers, [list(row) for row in data]
+        except snapshot.SnapshotMiss:
+            pass
+    data = []
+    headers = []
+    for attr in attr_cls.query.all():
+        obj = attr.serialize()
+        if not headers:
+            headers = list(obj.keys())
+        data.append([obj[key] for key in headers])
+    # lookup columns come back as their key
+    cols = [getattr(attr_cls, key, None) for key in headers]
+    return headers, [list(row) for row in lookups.translate(cols, data)]
+
+
+def shared_rows(kind, attr_cls, version):
+    '''load_rows through the shared cache. Without a recorded version the
+    rows could change under the same key, so each worker reads its own.'''
+    from data_africa.core import coalesce
+    if not version:
+        return load_rows(attr_cls)
+    key = "attrs/{}/{}".format(version, kind)
+    rows = cache.get(key)
+    if rows is None:
+        with coalesce.single_flight(key):
+            rows = cache.get(key)
+            if rows is None:
+                rows = load_rows(attr_cls)
+                cache.set(key, rows)
+    return rows
+
+
+def get(kind, attr_cls):
+    version = data_version.current()
+    kinds = _state["versions"].setdefault(version, {})
+    if kind not in kinds:
+        kinds[kind] = AttrPayloads(*shared_rows(kind, attr_cls, version))
+    return kinds[kind]
+
+
+def clear():
+    _state["versions"] = {}
+
+
+@data_version.on_prepare
+def prepare(version):
+    from data_africa.attrs.models import get_mapped_attrs
+    attr_map = get_mapped_attrs()
+    kinds = {}
+    for kind, old in list(_state["versions"].get(data_version.current(), {}).items()):
+        kinds[kind] = AttrPayloads(*shared_rows(kind, attr_map[kind], version))
+        for sumlevels in list(old.bodies):
+            kinds[kind].body(sumlevels)
+    _state["versions"][version] = kinds
+
+
+@data_version.on_activate
+def activate(version):
+    _state["versions"] = {version: _state["versions"][version]}
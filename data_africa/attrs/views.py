@@ -1,46 +1,41 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 from data_africa.attrs.models import get_mapped_attrs
+from data_africa.attrs import payloads
 from data_africa.attrs import search
-from sqlalchemy import or_
+from data_africa.core import querylog
 
 mod = Blueprint('attrs', __name__, url_prefix='/attrs')
 
 attr_map = get_mapped_attrs()
 
 
-def show_attrs(attr_obj, sumlevels=None):
-    if sumlevels is not None:
-        attrs = attr_obj.query.filter(attr_obj.level.in_(sumlevels)).all()
-    else:
-        attrs = attr_obj.query.all()
-
-    data = []
-    headers = []
-    for a in attrs:
-        obj = a.serialize()
-        data.append(list(obj.values()))
-        if not headers:
-            headers = list(obj.keys())
-    return jsonify(data=data, headers=headers)
+def show_attrs(kind, attr_obj, sumlevels=None):
+    body, rows = payloads.get(kind, attr_obj).body(sumlevels)
+    resp = Response(body, mimetype="application/json")
+    resp.stats = {"rows": rows}
+    return resp
 
 
 @mod.route("/<kind>/")
+@querylog.capture
 def attrs(kind):
     if kind in attr_map:
         attr_obj = attr_map[kind]
         sumlevel = request.args.get("sumlevel", None)
         sumlevels = sumlevel.split(",") if sumlevel else None
-        return show_attrs(attr_obj, sumlevels=sumlevels)
+        return show_attrs(kind, attr_obj, sumlevels=sumlevels)
     raise Exception("Invalid attribute type.")
 
 
 @mod.route("/<kind>/<attr_id>/")
+@querylog.capture
 def attrs_by_id(kind, attr_id):
     if kind in attr_map:
-        attr_obj = attr_map[kind]
-        aid_obj = attr_obj.query.filter(or_(attr_obj.id == attr_id, attr_obj.url_name == attr_id)).first()
-        tmp = aid_obj.serialize()
-        return jsonify(data=[list(tmp.values())], headers=list(tmp.keys()))
+        attr_payloads = payloads.get(kind, attr_map[kind])
+        row = attr_payloads.find(attr_id)
+        if row is None:
+            raise Exception("Invalid attribute id.")
+        return querylog.jsonify_rows([row], headers=attr_payloads.headers)
     raise Exception("Invalid attribute type.")
 
 
@@ -0,0 +1,90 @@
+'''Compare cache backends on a replayed or synthetic request trace
+
+Every request looks its key up; a miss stores a payload of the key's size,
+as the app would after computing the response. Keys and sizes come from a
+query log (path + args, bytes) or from a Zipf-distributed synthetic trace.
+Reported are hit ratio and get latency percentiles per backend.
+'''
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import simplejson
+from werkzeug.contrib.cache import FileSystemCache
+
+from data_africa.util.local_cache import LocalCache
+from data_africa.util.replay import percentile
+
+
+def trace_from_logs(paths):
+    trace = []
+    for path in paths:
+        with open(path) as handle:
+            for line in handle:
+                line = line.strip()
+                if not line.startswith("{"):
+                    continue
+                record = simplejson.loads(line)
+                if record.get("status") != 200 or not record.get("bytes"):
+                    continue
+                key = "join/{}?{}".format(record["path"], record.get("args", ""))
+                trace.append((key, record["bytes"]))
+    return trace
+
+
+def synthetic_trace(requests, keys, skew=1.1, mean_size=20000, seed=0):
+    '''Zipf-like popularity over keys with log-normally distributed sizes'''
+    rand = random.Random(seed)
+    weights = [1.0 / (rank ** skew) for rank in range(1, keys + 1)]
+    sizes = [max(int(rand.lognormvariate(0, 1) * mean_size / 1.65), 64)
+             for _ in range(keys)]
+    picks = rand.choices(range(keys), weights=weights, k=requests) \
+        if hasattr(rand, "choices") else \
+        [_weighted(rand, weights) for _ in range(requests)]
+    return [("join/key-{}".format(idx), sizes[idx]) for idx in picks]
+
+
+def _weighted(rand, weights):
+    target = rand.random() * sum(weights)
+    for idx, weight in enumerate(weights):
+        target -= weight
+        if target <= 0:
+            return idx
+    return len(weights) - 1
+
+
+def run_trace(cache, trace):
+    hits = 0
+    latencies = []
+    for key, size in trace:
+        start = time.time()
+        value = cache.get(key)
+        latencies.append(1000 * (time.time() - start))
+        if value is None:
+            cache.set(key, b"x" * size)
+        else:
+            hits += 1
+    return {
+        "hit_ratio": hits / float(len(trace)) if trace else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def compare(trace, max_bytes, threshold):
+    '''Run the trace against FileSystemCache (entry-count threshold) and
+    LocalCache (byte cap)'''
+    root = tempfile.mkdtemp(prefix="cache-bench-")
+    try:
+        backends = [
+            ("filesystem", FileSystemCache(os.path.join(root, "fs"),
+                                           threshold=threshold, default_timeout=0)),
+            ("local", LocalCache(os.path.join(root, "local", "cache.sqlite"), max_bytes,
+                                 default_timeout=0)),
+        ]
+        return [(name, run_trace(cache, trace)) for name, cache in backends]
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,67 @@
+'''Throughput of the point-in-polygon locator
+
+Builds the locator from the database, then resolves uniformly random points
+within the bounding box of the Cell5M shapes. Reports the build time, the
+points resolved per second, per-point latency percentiles, how many
+polygons each point had to test and how many points fell inside any geo.
+Optionally checks the grid index against a scan of every shape.
+'''
+import random
+import time
+
+from data_africa.spatial import locate
+from data_africa.util.replay import percentile
+
+
+def random_points(locator, count, seed=0):
+    shapes = locator.indexes["geo"].shapes
+    x0 = min(shape.bbox[0] for shape in shapes)
+    y0 = min(shape.bbox[1] for shape in shapes)
+    x1 = max(shape.bbox[2] for shape in shapes)
+    y1 = max(shape.bbox[3] for shape in shapes)
+    rand = random.Random(seed)
+    return [(rand.uniform(y0, y1), rand.uniform(x0, x1)) for _ in range(count)]
+
+
+def scan(index, lon, lat):
+    '''Containing keys without the grid, testing every shape'''
+    return sorted(shape.key for shape in index.shapes if shape.contains(lon, lat))
+
+
+def run(count=10000, verify=0, seed=0):
+    start = time.time()
+    locator = locate.Locator()
+    build = time.time() - start
+
+    points = random_points(locator, count, seed)
+    latencies = []
+    matched = 0
+    tested = 0
+    start = time.time()
+    for lat, lon in points:
+        begin = time.time()
+        result = locator.locate(lat, lon)
+        latencies.append(1000000 * (time.time() - begin))
+        matched += 1 if result["geo"] else 0
+    elapsed = time.time() - start
+    for lat, lon in points:
+        tested += sum(len(index.candidates(lon, lat)) for index in locator.indexes.values())
+
+    mismatches = 0
+    for lat, lon in points[:verify]:
+        for index in locator.indexes.values():
+            if sorted(index.query(lon, lat)) != scan(index, lon, lat):
+                mismatches += 1
+    return {
+        "build_s": build,
+        "shapes": dict((key, len(index.shapes)) for key, index in locator.indexes.items()),
+        "points": count,
+        "points_per_s": count / elapsed if elapsed else None,
+        "p50_us": percentile(latencies, 50),
+        "p95_us": percentile(latencies, 95),
+        "p99_us": percentile(latencies, 99),
+        "candidates": tested / float(count or 1),
+        "matched": matched / float(count or 1),
+        "verified": min(verify, count),
+        "mismatches": mismatches,
+    }
@@ -0,0 +1,255 @@
+'''Micro-benchmarks of the pure-Python steps of a join request
+
+Every query in the catalogue goes through the steps a join request takes
+before any SQL runs: parsing the args, picking the tables, resolving the
+output columns, building join conditions and filters, building the whole
+query and compiling it for PostgreSQL. No database is needed: table
+metadata (years, sizes, distinct counts) and the lookup tables are replaced
+by the fixtures below while the benchmark runs. Any statement issued anyway
+is counted and reported. Per step, the mean and p95 time and the memory
+allocated (net and peak, from tracemalloc) are reported. Results can be
+saved and compared against an earlier run.
+'''
+import contextlib
+import itertools
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import simplejson
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+
+from data_africa import app
+from data_africa.attrs import consts
+from data_africa.core import join_api
+from data_africa.core import lookups
+from data_africa.core import planner
+from data_africa.core import table_manager
+from data_africa.core import views
+from data_africa.util.replay import percentile
+
+CATALOGUE = [
+    "show=year,geo&required=harvested_area&geo=040AF00155",
+    "show=year,geo,crop&required=harvested_area,value_of_production&sumlevel=latest_by_geo,adm1,lowest",
+    "show=year,geo&required=harvested_area,value_of_production,rainfall_awa_mm&geo=040AF00155",
+    "show=year,crop&required=harvested_area&year=latest&crop=maiz&order=harvested_area&sort=desc&limit=10",
+    "show=year,geo&required=value_per_ha&sumlevel=all,adm0&where=value_per_ha.value_per_ha:>1.5",
+    "show=year,poverty_geo&required=hc,totpop,sevpov&sumlevel=latest_by_geo,adm1",
+    "show=year,geo&required=totpop,harvested_area&sumlevel=all,adm0&year=latest",
+    "show=year,poverty_geo,poverty_level&required=hc,povgap&where=hc.hc:>0.2&sumlevel=all,adm0,all",
+    "show=year,geo&required=harvested_area&exclude=crop&display_names=1&geo=040AF00155",
+    "show=year,geo&required=harvested_area,value_of_production&fields=geo,year,harvested_area&where=value_of_production.harvested_area:R>2",
+    "show=year,dhs_geo&required=proportion_of_children,url_name&where=url_name.url_name:^nai&year=latest",
+]
+
+# table: (years, rows, distinct values per key column), roughly the
+# shape of the production data
+TABLES = {
+    "attrs.crop": (None, 42, {"id": 42}),
+    "attrs.geo": (None, 1100, {"id": 1100, "geo": 1100}),
+    "attrs.poverty_geo": (None, 330, {"poverty_geo": 330}),
+    "attrs.dhs_geo": (None, 450, {"dhs_geo": 450}),
+    "spatial.pov_xwalk2": (None, 9000, {"poverty_geo": 330, "geo": 1100}),
+    "spatial.dhs_xwalk_focus": (None, 12000, {"dhs_geo": 450, "geo": 1100}),
+    "crops.area": ([2005], 46000, {"crop": 42, "geo": 1100, "year": 1}),
+    "crops.area_by_supply": ([2005], 92000,
+                             {"water_supply": 2, "crop": 42, "geo": 1100, "year": 1}),
+    "crops.value": ([2005], 46000, {"crop": 42, "geo": 1100, "year": 1}),
+    "crops.value_by_supply": ([2005], 92000,
+                              {"water_supply": 2, "crop": 42, "geo": 1100, "year": 1}),
+    "poverty.survey_yg": ([2005, 2008, 2010, 2012], 1300, {"year": 4, "poverty_geo": 330}),
+    "poverty.survey_ygl": ([2005, 2008, 2010, 2012], 2600,
+                           {"year": 4, "poverty_geo": 330, "poverty_level": 2}),
+    "poverty.survey_ygg": ([2005, 2008, 2010, 2012], 2600,
+                           {"year": 4, "gender": 2, "poverty_geo": 330}),
+    "poverty.survey_yggl": ([2005, 2008, 2010, 2012], 5200,
+                            {"year": 4, "gender": 2, "poverty_geo": 330, "poverty_level": 2}),
+    "poverty.survey_ygr": ([2005, 2008, 2010, 2012], 2600,
+                           {"year": 4, "residence": 2, "poverty_geo": 330}),
+    "poverty.survey_ygrl": ([2005, 2008, 2010, 2012], 5200,
+                            {"year": 4, "residence": 2, "poverty_geo": 330, "poverty_level": 2}),
+    "health.conditions": ([2008, 2011, 2014], 8100,
+                          {"year": 3, "dhs_geo": 450, "condition": 3, "severity": 2}),
+    "health.conditions_gender": ([2008, 2011, 2014], 16200,
+                                 {"year": 3, "dhs_geo": 450, "condition": 3, "severity": 2,
+                                  "gender": 2}),
+    "health.conditions_residence": ([2008, 2011, 2014], 16200,
+                                    {"year": 3, "dhs_geo": 450, "condition": 3, "severity": 2,
+                                     "residence": 2}),
+    "climate.rainfall": ([2005], 1100, {"year": 1, "geo": 1100}),
+}
+
+LOOKUPS = {
+    "adm0_name": {"KE": "Kenya", "ET": "Ethiopia", "NG": "Nigeria", "TZ": "Tanzania"},
+    "dhs_url_name": {"040HGKE": "kenya", "050HGKE0012008": "nairobi",
+                     "040HGET": "ethiopia", "050HGET0012011": "tigray"},
+    "poverty_url_name": {"040AF00155": "kenya", "050AF00155001": "nairobi",
+                         "040AF00094": "ethiopia", "050AF00094001": "tigray"},
+}
+
+
+def fixture_metadata():
+    '''(years_set, years, sizes, distinct counts) as table_manager builds
+    them, from TABLES'''
+    years_set, years, sizes, counts = {}, {}, {}, {}
+    for name, (table_years, rows, distinct) in TABLES.items():
+        years_set[name] = table_years
+        years[name] = {consts.LATEST: max(table_years),
+                       consts.OLDEST: min(table_years)} if table_years else None
+        sizes[name] = rows
+        counts[name] = distinct
+    return years_set, years, sizes, counts
+
+
+@contextlib.contextmanager
+def fixtures():
+    '''Serve table metadata and lookups from the fixtures above'''
+    years_set, years, sizes, counts = fixture_metadata()
+    replaced = [(table_manager, "tbl_years_set", lambda version=None: years_set),
+                (table_manager, "tbl_years", lambda version=None: years),
+                (table_manager, "tbl_sizes", lambda version=None: sizes),
+                (table_manager, "tbl_distinct_counts", lambda version=None: counts),
+                (planner, "tbl_sizes", lambda version=None: sizes),
+                (planner, "tbl_distinct_counts", lambda version=None: counts),
+                (table_manager.TableManager, "table_years_set", years_set),
+                (table_manager.TableManager, "table_years", years),
+                (lookups, "table", LOOKUPS.__getitem__)]
+    saved = [(owner, name, owner.__dict__[name]) for owner, name, _ in replaced]
+    for owner, name, value in replaced:
+        setattr(owner, name, value)
+    try:
+        yield
+    finally:
+        for owner, name, value in saved:
+            setattr(owner, name, value)
+
+
+STEPS = ["build_api_obj", "required_table_joins", "parse_entities", "make_join_cond",
+         "where_filters", "sumlevel_filtering2", "build_join_query", "compile"]
+
+
+class StatementCounter(object):
+    '''Counts statements executed while enabled'''
+
+    def __init__(self):
+        self.enabled = False
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            self.count += 1
+
+
+def _steps(args):
+    '''(step name, callable) pairs, each callable using the results of
+    the previous steps'''
+    state = {}
+
+    def api_obj():
+        with app.test_request_context("/api/join/?" + args):
+            state["api_obj"] = views.build_api_obj(default_limit=10000)
+
+    def table_joins():
+        state["tables"], state["joins"] = views.manager.required_table_joins(state["api_obj"])
+
+    def entities():
+        join_api.parse_entities(state["tables"], state["api_obj"])
+
+    def join_conds():
+        tables = state["tables"]
+        for tbl_a, tbl_b in itertools.product(tables[:1], tables[1:]):
+            join_api.make_join_cond(tbl_a, tbl_b, state["api_obj"])
+
+    def wheres():
+        join_api.where_filters(state["tables"], state["api_obj"])
+
+    def sumlevels():
+        for table in state["tables"]:
+            join_api.sumlevel_filtering2(table, state["api_obj"])
+
+    def build():
+        state["qry"] = join_api.build_join_query(
+            list(state["tables"]), list(state["joins"]), state["api_obj"])[0]
+
+    def compile_sql():
+        str(state["qry"].statement.compile(dialect=postgresql.dialect()))
+
+    return list(zip(STEPS, [api_obj, table_joins, entities, join_conds, wheres,
+                            sumlevels, build, compile_sql]))
+
+
+def _allocations(func):
+    '''Net and peak bytes allocated by one call'''
+    tracemalloc.clear_traces()
+    func()
+    return tracemalloc.get_traced_memory()
+
+
+def run(catalogue=None, repeat=100):
+    '''Time every step of every query. Returns {"steps": {step: stats},
+    "queries": {args: total mean ms}, "statements": count}'''
+    catalogue = catalogue or CATALOGUE
+    counter = StatementCounter()
+    event.listen(Engine, "before_cursor_execute", counter)
+    timings = {}
+    allocations = {}
+    totals = {}
+    counter.enabled = True
+    try:
+        with app.app_context(), fixtures():
+            # warm up the mapper and compiled caches before timing
+            for args in catalogue:
+                for _, func in _steps(args):
+                    func()
+            for args in catalogue:
+                totals[args] = 0.0
+                for _ in range(repeat):
+                    for name, func in _steps(args):
+                        start = time.time()
+                        func()
+                        elapsed = 1000 * (time.time() - start)
+                        timings.setdefault(name, []).append(elapsed)
+                        totals[args] += elapsed / repeat
+                if tracemalloc is not None:
+                    tracemalloc.start()
+                    try:
+                        for name, func in _steps(args):
+                            allocations.setdefault(name, []).append(_allocations(func))
+                    finally:
+                        tracemalloc.stop()
+    finally:
+        event.remove(Engine, "before_cursor_execute", counter)
+
+    steps = {}
+    for name, values in timings.items():
+        allocs = allocations.get(name, [])
+        steps[name] = {
+            "mean_ms": sum(values) / len(values),
+            "p95_ms": percentile(sorted(values), 95),
+            "net_kb": sum(net for net, _ in allocs) / 1024.0 / (len(allocs) or 1) if allocs else None,
+            "peak_kb": sum(peak for _, peak in allocs) / 1024.0 / (len(allocs) or 1) if allocs else None,
+        }
+    return {"steps": steps, "queries": totals, "statements": counter.count}
+
+
+def save(results, path):
+    with open(path, "w") as handle:
+        simplejson.dump(results, handle, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline_path, tolerance):
+    '''Steps whose mean time grew by more than tolerance (a fraction) over
+    the saved baseline, as (step, baseline ms, current ms)'''
+    with open(baseline_path) as handle:
+        baseline = simplejson.load(handle)
+    slower = []
+    for name, stats in results["steps"].items():
+        before = baseline["steps"].get(name)
+        if before and stats["mean_ms"] > before["mean_ms"] * (1 + tolerance):
+            slower.append((name, before["mean_ms"], stats["mean_ms"]))
+    return slower
@@ -0,0 +1,95 @@
+'''Measure gunicorn worker boot time and memory with and without preload
+
+Each run starts gunicorn with gunicorn_conf.py, waits until every worker
+has booted and the app answers, then reads the resident (RSS) and
+proportional (PSS) set size of each worker from /proc. PSS splits shared
+pages between the processes mapping them, so it shows what preloading
+saves; RSS counts shared pages in full for every worker.
+'''
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from six.moves.urllib.error import URLError
+from six.moves.urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CONFIG = os.path.join(ROOT, "gunicorn_conf.py")
+
+
+def gunicorn_bin():
+    local = os.path.join(os.path.dirname(sys.executable), "gunicorn")
+    return local if os.path.exists(local) else "gunicorn"
+
+
+def children(pid):
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as handle:
+            return [int(child) for child in handle.read().split()]
+    except IOError:
+        return []
+
+
+def memory(pid):
+    '''RSS and PSS of a process in kB'''
+    mem = {"rss": None, "pss": None}
+    for path in ["/proc/{}/smaps_rollup".format(pid), "/proc/{}/status".format(pid)]:
+        try:
+            with open(path) as handle:
+                for line in handle:
+                    key, _, value = line.partition(":")
+                    if key in ["Rss", "VmRSS"] and mem["rss"] is None:
+                        mem["rss"] = int(value.split()[0])
+                    elif key == "Pss" and mem["pss"] is None:
+                        mem["pss"] = int(value.split()[0])
+        except IOError:
+            continue
+    return mem
+
+
+def _read_boots(path):
+    with open(path) as handle:
+        return [float(line.split()[1]) for line in handle if line.strip()]
+
+
+def run(preload, workers=4, port=5099, app_module="data_africa:app",
+        probe="/attrs/list/", timeout=120):
+    '''Start gunicorn once and return its boot timings and memory use'''
+    boot_log = tempfile.NamedTemporaryFile(prefix="boot-", suffix=".log", delete=False)
+    boot_log.close()
+    env = dict(os.environ,
+               DATA_AFRICA_PRELOAD="1" if preload else "0",
+               DATA_AFRICA_WORKERS=str(workers),
+               DATA_AFRICA_BIND="127.0.0.1:{}".format(port),
+               DATA_AFRICA_BOOT_LOG=boot_log.name)
+    start = time.time()
+    proc = subprocess.Popen([gunicorn_bin(), "-c", CONFIG, app_module],
+                            cwd=ROOT, env=env)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError("gunicorn exited with {}".format(proc.returncode))
+            if time.time() - start > timeout:
+                raise RuntimeError("gunicorn did not boot within {}s".format(timeout))
+            if len(_read_boots(boot_log.name)) >= workers:
+                try:
+                    urlopen("http://127.0.0.1:{}{}".format(port, probe)).read()
+                    break
+                except URLError:
+                    pass
+            time.sleep(0.05)
+        ready = time.time() - start
+        pids = children(proc.pid)
+        return {
+            "preload": preload,
+            "ready": ready,
+            "boots": _read_boots(boot_log.name),
+            "master": memory(proc.pid),
+            "workers": [dict(memory(pid), pid=pid) for pid in pids],
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+        os.remove(boot_log.name)
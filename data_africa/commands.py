@@ -0,0 +1,339 @@
+'''Command line tools, run with e.g. FLASK_APP=run.py flask build_snapshot'''
+import click
+
+from data_africa import app
+
+
+@app.cli.command("build_snapshot")
+@click.option("--version", default=None, help="Snapshot version name")
+@click.option("--no-activate", is_flag=True,
+              help="Build without switching CURRENT to the new version")
+def build_snapshot_command(version, no_activate):
+    '''Export all registered tables to a memory-mapped snapshot'''
+    from data_africa.core import snapshot
+    manifest = snapshot.build_snapshot(version=version, activate=not no_activate)
+    for name, meta in sorted(manifest["tables"].items()):
+        click.echo("{:<40} {:>10} rows".format(name, meta["rows"]))
+    removed = snapshot.prune_snapshots(app.config["SNAPSHOT_KEEP"])
+    click.echo("Built snapshot {}{}".format(
+        manifest["version"], "" if no_activate else " (active)"))
+    if removed:
+        click.echo("Pruned {}".format(", ".join(removed)))
+
+
+@app.cli.command("activate_snapshot")
+@click.argument("version")
+def activate_snapshot_command(version):
+    '''Atomically switch workers to an existing snapshot version'''
+    from data_africa.core import snapshot
+    snapshot.activate_snapshot(version)
+    click.echo("Activated snapshot {}".format(version))
+
+
+@app.cli.command("warm_cache")
+@click.argument("sources", nargs=-1, type=click.Path(exists=True))
+@click.option("--workers", default=8, help="Number of parallel requests")
+@click.option("--base-url", default=None,
+              help="Replay against a running server, warming its workers' "
+                   "in-process caches too")
+def warm_cache_command(sources, workers, base_url):
+    '''Populate caches by replaying captured or curated request URLs.
+
+    Each source file holds one URL per line or one JSON record with a url
+    (or path and args) field per line, as written by the query log.
+
+    Without --base-url the URLs go through the test client in this process,
+    which fills the cache shared through CACHE_DIR but not the in-process
+    state (lookups, snapshot columns, the locate index) of running workers.'''
+    import time
+    from data_africa.core import table_manager
+    from data_africa.util import replay
+
+    start = time.time()
+    table_manager.tbl_years()
+    table_manager.tbl_years_set()
+    table_manager.tbl_sizes()
+    meta_time = time.time() - start
+
+    urls = replay.read_urls(sources)
+    results = replay.run(urls, workers=workers, base_url=base_url)
+    total_time = time.time() - start
+
+    by_endpoint = {}
+    for res in results:
+        stats = by_endpoint.setdefault(res["endpoint"] or "(unrouted)",
+                                       {"ok": 0, "failed": 0, "elapsed": 0.0})
+        stats["ok" if res["status"] == 200 else "failed"] += 1
+        stats["elapsed"] += res["elapsed"]
+
+    click.echo("{:<32} {:>6} {:>7} {:>10}".format("endpoint", "ok", "failed", "mean ms"))
+    for endpoint, stats in sorted(by_endpoint.items()):
+        count = stats["ok"] + stats["failed"]
+        click.echo("{:<32} {:>6} {:>7} {:>10.1f}".format(
+            endpoint, stats["ok"], stats["failed"], 1000 * stats["elapsed"] / count))
+
+    warmed = set(res["endpoint"] for res in results if res["status"] == 200)
+    targets = replay.warmable_endpoints()
+    covered = [endpoint for endpoint in targets if endpoint in warmed]
+    ok_count = sum(1 for res in results if res["status"] == 200)
+    if not base_url:
+        click.echo("Replayed in this process: only the shared cache is warm, "
+                   "pass --base-url to warm running workers")
+    click.echo("Metadata warmed in {:.2f}s".format(meta_time))
+    click.echo("Warmed {}/{} requests in {:.2f}s".format(ok_count, len(results), total_time))
+    click.echo("Endpoint coverage {}/{}; not warmed: {}".format(
+        len(covered), len(targets),
+        ", ".join(sorted(set(targets) - set(covered))) or "none"))
+
+
+@app.cli.command("replay")
+@click.argument("sources", nargs=-1, type=click.Path(exists=True))
+@click.option("--concurrency", default=8, help="Number of concurrent clients")
+@click.option("--rate", default=None, type=float,
+              help="Target requests per second across all clients")
+@click.option("--repeat", default=1, help="Replay the log this many times")
+@click.option("--base-url", default=None,
+              help="Replay against a running server instead of the test client")
+def replay_command(sources, concurrency, rate, repeat, base_url):
+    '''Replay a captured query log and report latency per endpoint'''
+    from data_africa.util import replay
+
+    urls = replay.read_urls(sources) * repeat
+    results, wall = replay.load(urls, concurrency=concurrency, rate=rate,
+                                base_url=base_url)
+    summary = replay.summarize(results, wall)
+
+    click.echo("{:<32} {:>7} {:>6} {:>8} {:>9} {:>9} {:>9}".format(
+        "endpoint", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for endpoint, stats in sorted(summary.items()):
+        click.echo("{:<32} {:>7} {:>6} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            endpoint, stats["count"], stats["errors"], stats["rps"],
+            stats["p50"] or 0, stats["p95"] or 0, stats["p99"] or 0))
+    click.echo("Replayed {} requests in {:.2f}s".format(len(results), wall))
+
+
+@app.cli.command("bump_data_version")
+@click.option("--version", default=None, help="Version name, defaults to a timestamp")
+def bump_data_version_command(version):
+    '''Record a data load so workers rebuild their in-memory payloads'''
+    from data_africa.core import data_version
+    click.echo("Data version {}".format(data_version.bump(version)))
+
+
+@app.cli.command("bench_startup")
+@click.option("--workers", default=4, help="Number of gunicorn workers")
+@click.option("--port", default=5099, help="Port to bind the benchmark server to")
+@click.option("--app-module", default="data_africa:app", help="WSGI app to serve")
+def bench_startup_command(workers, port, app_module):
+    '''Compare worker boot time and memory with and without preload'''
+    from data_africa.bench import startup
+
+    click.echo("{:<10} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+        "mode", "ready s", "boot s", "RSS MB", "PSS MB", "total PSS MB"))
+    for preload in [False, True]:
+        res = startup.run(preload, workers=workers, port=port, app_module=app_module)
+        rss = [proc["rss"] or 0 for proc in res["workers"]]
+        pss = [proc["pss"] or 0 for proc in res["workers"]]
+        count = len(res["workers"]) or 1
+        click.echo("{:<10} {:>8.2f} {:>10.3f} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+            "preload" if preload else "default", res["ready"],
+            sum(res["boots"]) / (len(res["boots"]) or 1),
+            sum(rss) / 1024.0 / count, sum(pss) / 1024.0 / count,
+            (sum(pss) + (res["master"]["pss"] or 0)) / 1024.0))
+
+
+@app.cli.command("bench_cache")
+@click.argument("logs", nargs=-1, type=click.Path(exists=True))
+@click.option("--requests", default=20000, help="Synthetic trace length")
+@click.option("--keys", default=5000, help="Distinct keys in the synthetic trace")
+@click.option("--max-bytes", default=None, type=int,
+              help="Byte cap of the local cache, defaults to CACHE_LOCAL_MAX_BYTES")
+def bench_cache_command(logs, requests, keys, max_bytes):
+    '''Compare hit ratio and read latency of the filesystem and local caches.
+
+    Replays the given query logs, or a synthetic Zipf trace without logs.'''
+    from data_africa.bench import cache as cache_bench
+
+    trace = cache_bench.trace_from_logs(logs) if logs else \
+        cache_bench.synthetic_trace(requests, keys)
+    max_bytes = max_bytes or app.config["CACHE_LOCAL_MAX_BYTES"]
+    results = cache_bench.compare(trace, max_bytes, app.config["CACHE_THRESHOLD"])
+
+    click.echo("{:<12} {:>10} {:>10} {:>10} {:>10}".format(
+        "backend", "hit ratio", "p50 ms", "p95 ms", "p99 ms"))
+    for name, res in results:
+        click.echo("{:<12} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            name, res["hit_ratio"], res["p50"] or 0, res["p95"] or 0, res["p99"] or 0))
+    click.echo("{} requests, {} distinct keys, {:.1f} MB distinct payload".format(
+        len(trace), len(set(key for key, _ in trace)),
+        sum(dict(trace).values()) / 1024.0 / 1024))
+
+
+@app.cli.command("slow_queries")
+@click.argument("logs", nargs=-1, type=click.Path(exists=True))
+@click.option("--top", default=10, help="Number of query shapes to list")
+@click.option("--shape", default=None, help="Show the worst statement and plan of this shape")
+def slow_queries_command(logs, top, shape):
+    '''Summarize the slow query log by query shape, worst total time first'''
+    import simplejson
+    from data_africa.core import slowlog
+
+    if not logs:
+        if not app.config["SLOW_QUERY_LOG"]:
+            raise click.UsageError("Pass log files or set SLOW_QUERY_LOG")
+        logs = slowlog.log_paths(app.config["SLOW_QUERY_LOG"])
+    records, plans = slowlog.read(logs)
+    summary = slowlog.summarize(records, plans)
+
+    if shape:
+        stats = [item for item in summary if item["shape"] == shape]
+        if not stats:
+            raise click.UsageError("No statements with shape {}".format(shape))
+        worst = stats[0]["worst"]
+        click.echo("{} ms, {}".format(worst["ms"], worst.get("request", "-")))
+        click.echo(worst["sql"])
+        click.echo(simplejson.dumps(worst["params"]))
+        plan = plans.get(worst["id"]) or next(
+            (plans[entry["id"]] for entry in records.values()
+             if entry["shape"] == shape and "plan" in plans.get(entry["id"], {})), None)
+        if plan and "plan" in plan:
+            click.echo(simplejson.dumps(plan["plan"], indent=2))
+        return
+
+    click.echo("{:<14} {:>7} {:>10} {:>10} {:>10} {:>6} {:>6}  {}".format(
+        "shape", "count", "total s", "avg ms", "max ms", "errors", "plans", "endpoint"))
+    for stats in summary[:top]:
+        endpoint = max(stats["endpoints"].items(), key=lambda item: item[1])[0]
+        click.echo("{:<14} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>6} {:>6}  {}".format(
+            stats["shape"], stats["count"], stats["total_ms"] / 1000.0,
+            stats["total_ms"] / stats["count"], stats["max_ms"], stats["errors"],
+            stats["plans"], endpoint))
+    click.echo("{} slow statements in {} shapes".format(len(records), len(summary)))
+
+
+@app.cli.command("bench_planning")
+@click.option("--repeat", default=100, help="Iterations per catalogue query")
+@click.option("--save", default=None, type=click.Path(), help="Write the results to this JSON file")
+@click.option("--baseline", default=None, type=click.Path(exists=True),
+              help="Fail if a step got slower than in this saved run")
+@click.option("--tolerance", default=0.2, help="Allowed slowdown over the baseline, as a fraction")
+def bench_planning_command(repeat, save, baseline, tolerance):
+    '''Time query planning and SQL compilation without touching the database'''
+    from data_africa.bench import planning
+
+    results = planning.run(repeat=repeat)
+    click.echo("{:<22} {:>10} {:>10} {:>10} {:>10}".format(
+        "step", "mean ms", "p95 ms", "net KB", "peak KB"))
+    for name in planning.STEPS:
+        stats = results["steps"][name]
+        click.echo("{:<22} {:>10.3f} {:>10.3f} {:>10} {:>10}".format(
+            name, stats["mean_ms"], stats["p95_ms"],
+            "-" if stats["net_kb"] is None else "{:.1f}".format(stats["net_kb"]),
+            "-" if stats["peak_kb"] is None else "{:.1f}".format(stats["peak_kb"])))
+    if results["statements"]:
+        click.echo("warning: {} statements executed while timing".format(results["statements"]))
+    if save:
+        planning.save(results, save)
+    if baseline:
+        slower = planning.regressions(results, baseline, tolerance)
+        for name, before, after in slower:
+            click.echo("{} regressed: {:.3f} ms -> {:.3f} ms".format(name, before, after))
+        if slower:
+            raise SystemExit(1)
+
+
+@app.cli.command("build_shapes")
+@click.argument("layers", nargs=-1)
+def build_shapes_command(layers):
+    '''Build the simplified TopoJSON files of the given layers (default all)'''
+    from data_africa.spatial import shapes
+
+    for name in layers or sorted(shapes.LAYERS):
+        manifest = shapes.build_layer(shapes.get_layer(name))
+        click.echo("{}: {} shapes, {} arcs".format(name, manifest["shapes"], manifest["arcs"]))
+        for level, entry in sorted(manifest["levels"].items()):
+            click.echo("  {:<8} {:>12,} bytes, {:>12,} gzipped".format(
+                level, entry["bytes"], entry["gzip_bytes"]))
+
+
+@app.cli.command("bench_locate")
+@click.option("--points", default=10000, help="Number of random points to resolve")
+@click.option("--verify", default=0, help="Check this many points against a full scan")
+@click.option("--seed", default=0, help="Random seed of the points")
+def bench_locate_command(points, verify, seed):
+    '''Measure point lookups per second of the in-memory polygon index'''
+    from data_africa.bench import locate as locate_bench
+
+    res = locate_bench.run(points, verify=verify, seed=seed)
+    click.echo("index built in {:.2f}s: {}".format(res["build_s"], ", ".join(
+        "{} {} shapes".format(count, key) for key, count in sorted(res["shapes"].items()))))
+    click.echo("{:>12} {:>10} {:>10} {:>10} {:>12} {:>8}".format(
+        "points/s", "p50 us", "p95 us", "p99 us", "candidates", "matched"))
+    click.echo("{:>12,.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1f} {:>8.1%}".format(
+        res["points_per_s"] or 0, res["p50_us"] or 0, res["p95_us"] or 0,
+        res["p99_us"] or 0, res["candidates"], res["matched"]))
+    if res["verified"]:
+        click.echo("{} of {} points differ from a full scan".format(
+            res["mismatches"], res["verified"]))
+
+
+@app.cli.command("build_xwalks")
+@click.argument("sources", nargs=-1)
+@click.option("--workers", default=None, type=int, help="Worker processes, defaults to XWALK_WORKERS")
+@click.option("--force", is_flag=True, help="Recompute every country, changed or not")
+@click.option("--check", is_flag=True, help="Validate the overlap sums per geo afterwards")
+@click.option("--max-seconds", default=None, type=float, help="Fail if the rebuild takes longer")
+def build_xwalks_command(sources, workers, force, check, max_seconds):
+    '''Recompute the poverty and DHS crosswalks of countries whose geometries changed'''
+    import time
+    from data_africa.spatial import xwalk
+
+    available = xwalk.sources()
+    for name in sources:
+        if name not in available:
+            raise click.BadParameter("unknown or unconfigured source {}, expected one of {}".format(
+                name, ", ".join(sorted(available))))
+
+    def progress(name, country, rows, seconds):
+        click.echo("{} {}: {} rows in {:.1f}s".format(name, country, rows, seconds))
+
+    start = time.time()
+    results = xwalk.build(list(sources), workers=workers, force=force, progress=progress)
+    elapsed = time.time() - start
+    failed = False
+    for name, res in sorted(results.items()):
+        click.echo("{}: {} countries rebuilt, {} unchanged, {} rows written, {} stale rows removed".format(
+            name, len(res["rebuilt"]), len(res["skipped"]), res["rows"], res["removed"]))
+        if check:
+            tolerance = app.config["XWALK_CHECK_TOLERANCE"]
+            groups, covered, partial, over = xwalk.check(available[name], tolerance)
+            click.echo("  {} geo groups: {} fully covered, {} partly covered, {} over 100%".format(
+                groups, covered, partial, len(over)))
+            for geo, group, total in over[:10]:
+                click.echo("  {} {}: {:.2f}%".format(geo, group, total))
+            failed = failed or bool(over)
+    click.echo("done in {:.1f}s".format(elapsed))
+    if max_seconds is not None and elapsed > max_seconds:
+        click.echo("slower than {:.1f}s".format(max_seconds))
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.command("load_data")
+@click.argument("table")
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--append", is_flag=True, help="Add the rows to the current ones instead of replacing them")
+def load_data_command(table, files, append):
+    '''Load CSV or Parquet files into TABLE (e.g. poverty.survey_ygl) with
+    COPY, swap it in and refresh the cached metadata'''
+    import time
+    from data_africa.core import data_version
+    from data_africa.core import loader
+
+    start = time.time()
+    rows = loader.load_table(loader.get_model(table), files, append=append)
+    click.echo("{}: {} rows after loading {} file(s) in {:.1f}s".format(
+        table, rows, len(files), time.time() - start))
+    loader.run_hooks([table])
+    click.echo("Data version {}".format(data_version.latest()))
@@ -0,0 +1,195 @@
+'''Cost-based admission control for join queries
+
+Before a join is executed its cost is estimated from the cached table sizes
+(tbl_sizes) and the selectivity of the filters that apply to each table, or
+optionally from the planner's EXPLAIN estimate. Each endpoint has a budget
+in ADMISSION_BUDGETS: queries above queue_cost must wait for one of a
+small number of heavy query slots in the worker, queries above max_cost are
+rejected with an explanation of how to narrow them.
+'''
+import threading
+import time
+
+from flask import has_request_context, request
+
+from data_africa import app
+from data_africa.attrs import consts
+from data_africa.core.exceptions import QueryRejectedException
+from data_africa.core.exceptions import QueryQueueFullException
+from data_africa.database import db
+
+# fraction of rows kept by a sumlevel filter at the given level
+SUMLEVEL_SELECTIVITY = {
+    consts.ALL: 1.0,
+    consts.ADM0: 0.02,
+    consts.ADM1: 0.5,
+    consts.LATEST_BY_GEO: 0.3,
+    consts.LOWEST: 0.5,
+}
+# fraction of rows kept by an equality filter on one value
+EQUALITY_SELECTIVITY = 0.1
+# fraction of rows kept by a where, inside or neighbors filter
+FILTER_SELECTIVITY = 0.3
+NEIGHBORS_SELECTIVITY = 0.001
+
+_slots = {"sem": None}
+
+
+def budget(endpoint=None):
+    if endpoint is None and has_request_context():
+        endpoint = request.endpoint
+    budgets = app.config["ADMISSION_BUDGETS"]
+    return budgets.get(endpoint, budgets.get(None, {}))
+
+
+def check_limit(api_obj, endpoint=None):
+    max_rows = budget(endpoint).get("max_rows")
+    if max_rows and api_obj.limit and api_obj.limit > max_rows:
+        raise QueryRejectedException(
+            "Limit parameter must be less than {:,}".format(max_rows))
+
+
+def equality_selectivity(table, col_name, values, distinct_counts):
+    n_distinct = distinct_counts.get(table.full_name(), {}).get(col_name)
+    if n_distinct:
+        return min(1.0, float(len(values)) / n_distinct)
+    return min(1.0, len(values) * EQUALITY_SELECTIVITY)
+
+
+def estimate_table_rows(table, api_obj, sizes, distinct_counts=None):
+    '''Estimated number of rows of table left after its own filters'''
+    distinct_counts = distinct_counts or {}
+    rows = float(sizes.get(table.full_name()) or 0)
+    cols = set(table.col_strs(short_name=True))
+
+    for col_name, val in api_obj.vars_and_vals.items():
+        if col_name not in cols:
+            continue
+        if col_name == consts.YEAR and val in [consts.LATEST, consts.OLDEST]:
+            values = [val]
+        else:
+            values = val.split(",")
+        rows *= equality_selectivity(table, col_name, values, distinct_counts)
+
+    for col_name, level in api_obj.shows_and_levels.items():
+        if hasattr(table, "{}_filter".format(col_name)):
+            rows *= SUMLEVEL_SELECTIVITY.get(level, 1.0)
+
+    for col_name in api_obj.where_vars():
+        if col_name in cols:
+            rows *= FILTER_SELECTIVITY
+    if api_obj.inside and any(kind in cols for kind, _ in api_obj.inside):
+        rows *= FILTER_SELECTIVITY
+    if api_obj.neighbors and "geo" in cols:
+        rows *= NEIGHBORS_SELECTIVITY
+    return max(rows, 1.0)
+
+
+def estimate(tables, api_obj):
+    '''Return (cost, output rows) for a join of tables. The cost counts
+    the rows scanned from every input plus the rows produced, since the
+    join is both counted and streamed.'''
+    from data_africa.core.table_manager import tbl_sizes, tbl_distinct_counts
+    sizes = tbl_sizes()
+    distinct_counts = tbl_distinct_counts()
+    inputs = [estimate_table_rows(table, api_obj, sizes, distinct_counts)
+              for table in tables]
+    output = max(inputs) if inputs else 0.0
+    if api_obj.limit:
+        streamed = min(output, api_obj.limit)
+    else:
+        streamed = output
+    return sum(inputs) + output + streamed, output
+
+
+def explain(qry):
+    '''Planner total cost and row estimate for an unexecuted query'''
+    compiled = qry.statement.compile(dialect=db.engine.dialect)
+    conn = db.session.connection()
+    result = conn.execute("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+    plan = result.scalar()[0]["Plan"]
+    return plan["Total Cost"], plan["Plan Rows"]
+
+
+class Ticket(object):
+    '''Admission granted to a query, holding a heavy slot if one was needed'''
+
+    def __init__(self, slot=None, cost=None):
+        self.slot = slot
+        self.cost = cost
+
+    def release(self):
+        if self.slot is not None:
+            slot, self.slot = self.slot, None
+            slot.release()
+
+    def attach(self, resp):
+        '''Keep the slot until the response has been fully streamed'''
+        if self.slot is not None:
+            resp.call_on_close(self.release)
+        return resp
+
+
+class Slots(object):
+    '''A bounded counting semaphore with a timeout on acquire. Waiters
+    sleep on a condition and are woken by release().'''
+
+    def __init__(self, count):
+        self.count = count
+        self.free = count
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.free <= 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.free -= 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self.free >= self.count:
+                raise ValueError("Slot released too many times")
+            self.free += 1
+            self._cond.notify()
+
+
+def heavy_slots():
+    if _slots["sem"] is None:
+        _slots["sem"] = Slots(app.config["ADMISSION_HEAVY_SLOTS"])
+    return _slots["sem"]
+
+
+def acquire_slot(timeout):
+    sem = heavy_slots()
+    if not sem.acquire(timeout):
+        raise QueryQueueFullException(
+            "Too many expensive queries are running, please retry shortly")
+    return sem
+
+
+def admit(qry, tables, api_obj, endpoint=None):
+    '''Estimate the cost of qry and reject it, queue it or let it through'''
+    if not app.config["ADMISSION_CONTROL"]:
+        return Ticket()
+    limits = budget(endpoint)
+    if limits.get("explain"):
+        cost, _ = explain(qry)
+    else:
+        cost, _ = estimate(tables, api_obj)
+
+    max_cost = limits.get("max_cost")
+    if max_cost and cost > max_cost:
+        raise QueryRejectedException(
+            "Query is estimated to cost {:,.0f}, above the budget of {:,} for "
+            "this endpoint. Narrow it with filters (e.g. geo or year), a more "
+            "specific sumlevel or a lower limit.".format(cost, max_cost))
+
+    queue_cost = limits.get("queue_cost")
+    if queue_cost and cost > queue_cost:
+        return Ticket(acquire_slot(app.config["ADMISSION_QUEUE_TIMEOUT"]), cost)
+    return Ticket(cost=cost)
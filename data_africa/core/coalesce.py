@@ -0,0 +1,283 @@
+'''Single-flight execution of identical concurrent requests
+
+Requests are keyed on their path, normalized query args and the data
+version. Within a worker the first request for a key runs the view while
+identical requests wait for its result. Across workers, an flock on a lock
+file named after the hash of the key elects a single runner per key; the
+runner removes the file when done. It stores the finished response in the
+shared cache, and workers that waited on the lock, or that ask for the
+same key later, reuse it. A data version is part of the key, so with one
+recorded a response is kept for RESULT_CACHE_TTL seconds (within the quota
+of the cache's join namespace); without one, only for COALESCE_TTL seconds.
+If the result is not found there (an error or a body above
+COALESCE_MAX_BYTES), the waiter runs the view itself.
+
+Sharing a response means buffering it, so only bounded requests take part:
+those asking for at most COALESCE_MAX_ROWS rows. Larger requests are
+streamed as before. A body that still grows past COALESCE_MAX_BYTES stops
+being buffered and streams on to its own client, and the requests waiting
+for it run the view themselves.
+'''
+import contextlib
+import functools
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # no cross-worker coalescing on this platform
+    fcntl = None
+
+from flask import Response, request
+
+from data_africa import app, cache
+from data_africa.core import data_version
+from data_africa.core.querylog import normalize_args
+from data_africa.core.streaming import accepts_gzip
+
+_lock = threading.Lock()
+_inflight = {}
+STATS = {
+    "executions": 0,
+    "local_shared": 0,
+    "remote_shared": 0,
+    "fallbacks": 0,
+}
+
+
+class Flight(object):
+    '''A view execution other requests with the same key can wait for'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _incr(key):
+    with _lock:
+        STATS[key] += 1
+
+
+def snapshot():
+    '''Counters for this worker; saved counts executions avoided'''
+    with _lock:
+        stats = dict(STATS)
+    stats["saved"] = stats["local_shared"] + stats["remote_shared"]
+    stats["inflight"] = len(_inflight)
+    stats["pid"] = os.getpid()
+    return stats
+
+
+def request_key():
+    # gzip-encoded and plain responses are kept apart
+    encoding = "gzip:" if accepts_gzip() else ""
+    return "join/coalesce/{}{}{}?{}".format(data_version.current() or "", encoding,
+                                            request.path, normalize_args(request.args))
+
+
+def bounded():
+    '''Whether the request asks for few enough rows to be buffered'''
+    limit = request.args.get("limit")
+    if not limit:
+        return True
+    try:
+        return int(limit) <= app.config["COALESCE_MAX_ROWS"]
+    except ValueError:  # rejected by the view, the error is small
+        return True
+
+
+def _stream_on(resp, chunks, body_iter):
+    '''Let resp stream the chunks read so far, then the rest of its body'''
+    original = resp.response
+
+    def generate():
+        try:
+            for chunk in chunks:
+                yield chunk
+            for chunk in body_iter:
+                yield chunk
+        finally:
+            if hasattr(original, "close"):
+                original.close()
+    resp.response = generate()
+    return resp
+
+
+def _capture(resp):
+    '''Buffer a response into a picklable result. Returns (result, None),
+    or (None, resp) once the body exceeds COALESCE_MAX_BYTES, resp then
+    streaming the remainder unbuffered.'''
+    max_bytes = app.config["COALESCE_MAX_BYTES"]
+    chunks = []
+    size = 0
+    body_iter = resp.iter_encoded()
+    try:
+        for chunk in body_iter:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                return None, _stream_on(resp, chunks, body_iter)
+    except BaseException:
+        resp.close()
+        raise
+    resp.close()
+    return {
+        "status": resp.status_code,
+        "headers": [(name, value) for name, value in resp.headers
+                    if name.lower() != "content-length"],
+        "body": b"".join(chunks),
+        "stats": getattr(resp, "stats", None),
+    }, None
+
+
+def _respond(result):
+    resp = Response(result["body"], status=result["status"],
+                    headers=result["headers"])
+    resp.stats = dict(result["stats"]) if result["stats"] else None
+    return resp
+
+
+def _lock_path(key):
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return os.path.join(app.config["COALESCE_DIR"], "{}.lock".format(digest))
+
+
+def _make_lock_dir():
+    lock_dir = app.config["COALESCE_DIR"]
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:  # created by another worker meanwhile
+            pass
+
+
+def _try_lock(handle, timeout):
+    if timeout is None:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return True
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+
+def _locked_path(handle, path):
+    '''Whether the locked handle is still the file at path'''
+    try:
+        return os.fstat(handle.fileno()).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def _key_lock(key, timeout=None):
+    '''flock on the lock file of key, waiting up to timeout seconds
+    (for as long as it takes when None); yields whether it was taken.
+    The holder removes the file before releasing it, so a worker that
+    locked the removed file opens the new one and tries again.'''
+    _make_lock_dir()
+    path = _lock_path(key)
+    while True:
+        with open(path, "a") as handle:
+            if not _try_lock(handle, timeout):
+                yield False
+                return
+            if _locked_path(handle, path):
+                try:
+                    yield True
+                finally:
+                    os.remove(path)
+                return
+        # closing the file releases the lock
+
+
+@contextlib.contextmanager
+def single_flight(key):
+    '''Run the block for key in one worker of this host at a time,
+    waiting for as long as another one holds it'''
+    if fcntl is None:
+        yield
+        return
+    with _key_lock(key):
+        yield
+
+
+def result_ttl():
+    '''Seconds a shared response is kept: a new data version changes
+    every key, so results of a recorded version never go stale'''
+    if data_version.current():
+        return app.config["RESULT_CACHE_TTL"]
+    return app.config["COALESCE_TTL"]
+
+
+def _execute(key, func, args, kwargs):
+    result, streamed = _capture(app.make_response(func(*args, **kwargs)))
+    _incr("executions")
+    if result is not None and result["status"] == 200:
+        cache.set(key, result, timeout=result_ttl())
+    return result, streamed
+
+
+def _run_shared(key, func, args, kwargs):
+    '''Run the view once per key across the workers of this host.
+    Returns (result, None), or (None, response) for a body too large to
+    share.'''
+    shared = cache.get(key)
+    if shared is not None:
+        _incr("remote_shared")
+        return shared, None
+    if fcntl is None:
+        return _execute(key, func, args, kwargs)
+
+    with _key_lock(key, 0) as runner:
+        if runner:
+            return _execute(key, func, args, kwargs)
+    # another worker runs this key: wait, then reuse its result
+    with _key_lock(key, app.config["COALESCE_WAIT"]) as waited:
+        if waited:
+            shared = cache.get(key)
+            if shared is not None:
+                _incr("remote_shared")
+                return shared, None
+        else:
+            _incr("fallbacks")
+        return _execute(key, func, args, kwargs)
+
+
+def coalesce(func):
+    '''View decorator sharing one execution between identical requests'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not app.config["COALESCE"] or not bounded():
+            return func(*args, **kwargs)
+        key = request_key()
+        with _lock:
+            flight = _inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _inflight[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(app.config["COALESCE_WAIT"]) and flight.result is not None:
+                _incr("local_shared")
+                return _respond(flight.result)
+            _incr("fallbacks")
+            return func(*args, **kwargs)
+
+        try:
+            flight.result, streamed = _run_shared(key, func, args, kwargs)
+        finally:
+            with _lock:
+                _inflight.pop(key, None)
+            flight.done.set()
+        if streamed is not None:
+            return streamed
+        return _respond(flight.result)
+    return wrapper
@@ -0,0 +1,125 @@
+'''Dictionary-encoded JSON layout for join results
+
+Every column holding strings (and nulls) is replaced by integer codes into
+a per-column value table listed under "dictionaries". A column is encoded
+when its first non-null value is a string. With the default "rows" layout
+the rows are encoded and streamed as they arrive and the dictionaries are
+written after them. The "columns" layout, where data holds one list per
+header instead of one list per row, needs every row before it can start, so
+it is limited to COMPACT_COLUMNS_MAX_ROWS rows. decode() turns a compact
+document back into the regular join shape.
+'''
+import simplejson
+import six
+from flask import Response
+
+from data_africa import app
+from data_africa.core.exceptions import QueryRejectedException
+
+ROWS = "rows"
+COLUMNS = "columns"
+
+
+class Encoder(object):
+    '''Dictionary-encodes the string columns of rows, one row at a time'''
+
+    def __init__(self, width):
+        # per column: {value: code}, False when not encoded, None until
+        # the first non-null value is seen
+        self.codes = [None] * width
+
+    def encode_row(self, row):
+        inf = float('inf')
+        row = [x if x != inf else None for x in row]
+        for idx, val in enumerate(row):
+            if val is None:
+                continue
+            table = self.codes[idx]
+            if table is None:
+                table = self.codes[idx] = {} if isinstance(val, six.string_types) else False
+            if table is not False:
+                code = table.get(val)
+                if code is None:
+                    code = table[val] = len(table)
+                row[idx] = code
+        return row
+
+    def dictionaries(self, headers):
+        return {headers[idx]: sorted(table, key=table.get)
+                for idx, table in enumerate(self.codes) if table}
+
+
+def encode(headers, rows, layout=ROWS):
+    '''Return (dictionaries, data) for a list of result rows'''
+    encoder = Encoder(len(headers))
+    rows = [encoder.encode_row(row) for row in rows]
+    if layout == COLUMNS:
+        rows = [[row[idx] for row in rows] for idx in range(len(headers))]
+    return encoder.dictionaries(headers), rows
+
+
+def decode(doc):
+    '''Turn a compact document into the regular {"data": rows, ...} shape'''
+    result = {key: val for key, val in doc.items()
+              if key not in ["dictionaries", "layout"]}
+    data = doc["data"]
+    if doc["layout"] == COLUMNS:
+        data = [list(row) for row in zip(*data)]
+    else:
+        data = [list(row) for row in data]
+    for name, values in doc["dictionaries"].items():
+        idx = doc["headers"].index(name)
+        for row in data:
+            if row[idx] is not None:
+                row[idx] = values[row[idx]]
+    result["data"] = data
+    return result
+
+
+def _dumps(value):
+    return simplejson.dumps(value, separators=(",", ":"))
+
+
+def _trailer(tables, api_obj):
+    return u'"source":{},"subs":{},"limit":{},"warnings":{}}}'.format(
+        _dumps([table.info(api_obj) for table in tables]), _dumps(api_obj.subs),
+        _dumps(api_obj.limit), _dumps(api_obj.warnings))
+
+
+def _buffered_columns(tables, headers, data, api_obj):
+    max_rows = app.config["COMPACT_COLUMNS_MAX_ROWS"]
+    rows = []
+    for row in data:
+        if len(rows) >= max_rows:
+            raise QueryRejectedException(
+                "layout=columns is limited to {} rows, use the rows layout "
+                "or narrow the query".format(max_rows))
+        rows.append(row)
+    dictionaries, encoded = encode(headers, rows, COLUMNS)
+    body = u'{{"headers":{},"layout":"columns","dictionaries":{},"data":{},'.format(
+        _dumps(headers), _dumps(dictionaries), _dumps(encoded)) + _trailer(tables, api_obj)
+    resp = Response(body, content_type='application/json')
+    resp.stats = {"rows": len(rows)}
+    return resp
+
+
+def compact_response(tables, cols, data, api_obj):
+    headers = [col if not hasattr(col, "key") else col.key for col in cols]
+    if api_obj.layout == COLUMNS:
+        return _buffered_columns(tables, headers, data, api_obj)
+    stats = {"rows": 0}
+
+    def generate():
+        encoder = Encoder(len(headers))
+        yield u'{{"headers":{},"layout":"rows","data":['.format(_dumps(headers))
+        separator = u""
+        for row in data:
+            yield separator + _dumps(encoder.encode_row(row))
+            separator = u","
+            stats["rows"] += 1
+        yield u'],"dictionaries":{},'.format(_dumps(encoder.dictionaries(headers))) + \
+            _trailer(tables, api_obj)
+
+    resp = Response(generate(), content_type='application/json')
+    resp.stats = stats
+    return resp
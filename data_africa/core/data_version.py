@@ -0,0 +1,204 @@
+'''Registry of the currently loaded data version
+
+A data version is a token written by bump() after each data load, either to
+DATA_VERSION_FILE or, when DATA_VERSION_TABLE names one, to a table shared
+by every host. When neither holds a version, the active snapshot version is
+used in snapshot mode.
+
+Every worker serves exactly one version, current(), and everything derived
+from the data (memoized table metadata, lookups, payloads, the locate index,
+coalescing keys) is kept per version. Before each request the registry is
+polled, at most every DATA_VERSION_POLL_INTERVAL seconds. A new version is
+prepared on a background thread by the PREPARE_HOOKS while requests keep
+being answered from the old one; once every hook has finished, the
+ACTIVATE_HOOKS switch the process over and drop what was kept for the old
+version. A failed rebuild is logged and retried with an exponential
+backoff, from twice the poll interval up to DATA_VERSION_MAX_RETRY_DELAY.
+'''
+import datetime
+import os
+import threading
+import time
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from data_africa import app
+
+PREPARE_HOOKS = []
+ACTIVATE_HOOKS = []
+
+_state = {"active": None, "activated": False, "latest": None, "polled": None,
+          "rebuild": None, "failed": None}
+_lock = threading.Lock()
+
+
+def on_prepare(func):
+    '''Register func(version) to build a new version's state in the
+    background, without touching what the current version uses'''
+    PREPARE_HOOKS.append(func)
+    return func
+
+
+def on_activate(func):
+    '''Register func(version) to switch over to a prepared version'''
+    ACTIVATE_HOOKS.append(func)
+    return func
+
+
+def _version_table():
+    schema, name = app.config["DATA_VERSION_TABLE"].split(".")
+    return Table(name, MetaData(),
+                 Column("version", String, primary_key=True),
+                 Column("created", DateTime, nullable=False),
+                 schema=schema)
+
+
+def _read_file():
+    try:
+        with open(app.config["DATA_VERSION_FILE"]) as handle:
+            return handle.read().strip()
+    except IOError:
+        return None
+
+
+def _read_table():
+    from data_africa.database import db
+    version_table = _version_table()
+    qry = select([version_table.c.version]) \
+        .order_by(version_table.c.created.desc()).limit(1)
+    with db.engine.connect() as conn:
+        if not conn.dialect.has_table(conn, version_table.name, schema=version_table.schema):
+            return None
+        return conn.execute(qry).scalar()
+
+
+def _read():
+    if app.config["DATA_VERSION_TABLE"]:
+        try:
+            version = _read_table()
+        except SQLAlchemyError:
+            # keep serving what we know rather than rebuilding for nothing
+            app.logger.warning("Could not read the data version", exc_info=True)
+            return _state["latest"]
+    else:
+        version = _read_file()
+    if not version and app.config["SNAPSHOT_MODE"]:
+        from data_africa.core import snapshot
+        version = snapshot.current_version()
+    return version or None
+
+
+def latest():
+    '''The most recently recorded version, read at most once per
+    DATA_VERSION_POLL_INTERVAL seconds'''
+    now = time.time()
+    polled = _state["polled"]
+    if polled is None or now - polled >= app.config["DATA_VERSION_POLL_INTERVAL"]:
+        _state["latest"] = _read()
+        _state["polled"] = now
+    return _state["latest"]
+
+
+def current():
+    '''The version this process serves'''
+    if not _state["activated"]:
+        with _lock:
+            if not _state["activated"]:
+                _state["active"] = latest()
+                _state["activated"] = True
+    return _state["active"]
+
+
+def rebuilding():
+    '''The version being prepared in the background, or None'''
+    rebuild = _state["rebuild"]
+    # a thread inherited through fork is not alive in the child
+    if rebuild is not None and rebuild[1].is_alive():
+        return rebuild[0]
+    return None
+
+
+def rebuild(version):
+    '''Prepare version and switch this process over to it'''
+    start = time.time()
+    try:
+        with app.app_context():
+            for hook in PREPARE_HOOKS:
+                hook(version)
+        with _lock:
+            for hook in ACTIVATE_HOOKS:
+                hook(version)
+            _state["active"] = version
+            _state["activated"] = True
+    except Exception:
+        failed = _state["failed"]
+        attempts = failed[2] + 1 if failed is not None and failed[0] == version else 1
+        _state["failed"] = (version, time.time(), attempts)
+        app.logger.exception("Rebuild %d for data version %s failed", attempts, version)
+        return False
+    _state["failed"] = None
+    app.logger.info("Switched to data version %s after %.2fs", version, time.time() - start)
+    return True
+
+
+def retry_at(version):
+    '''When a rebuild of version may start again after failing'''
+    failed = _state["failed"]
+    if failed is None or failed[0] != version:
+        return 0
+    delay = app.config["DATA_VERSION_POLL_INTERVAL"] * 2 ** failed[2]
+    return failed[1] + min(delay, app.config["DATA_VERSION_MAX_RETRY_DELAY"])
+
+
+def poll():
+    '''Start a background rebuild when a new version has been recorded.
+    Returns the version being prepared, or None.'''
+    version = latest()
+    if version == current():
+        return None
+    with _lock:
+        if rebuilding() is not None:
+            return rebuilding()
+        if time.time() < retry_at(version):
+            return None
+        thread = threading.Thread(target=rebuild, args=(version,),
+                                  name="data-version-{}".format(version))
+        thread.daemon = True
+        _state["rebuild"] = (version, thread)
+        thread.start()
+    return version
+
+
+@app.before_request
+def poll_version():
+    poll()
+
+
+def _write_file(version):
+    path = app.config["DATA_VERSION_FILE"]
+    tmp_path = "{}.{}".format(path, os.getpid())
+    with open(tmp_path, "w") as handle:
+        handle.write(version + "\n")
+    os.rename(tmp_path, path)
+
+
+def _write_table(version):
+    from data_africa.database import db
+    version_table = _version_table()
+    version_table.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.execute(version_table.insert(), {
+            "version": version, "created": datetime.datetime.utcnow()})
+
+
+def bump(version=None):
+    '''Atomically record a new data version and return it'''
+    version = version or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f")
+    if app.config["DATA_VERSION_TABLE"]:
+        _write_table(version)
+    else:
+        _write_file(version)
+    _state["latest"] = version
+    _state["polled"] = time.time()
+    return version
@@ -0,0 +1,62 @@
+'''Derived measures computed in SQL from columns of the joined tables
+
+A derived measure can be requested, filtered (where=name.name:>10) and
+ordered like any stored column. Table selection sees its input columns, so
+the tables providing them are joined as usual; the measure itself is an
+expression over those columns and its inputs are not returned unless
+requested. Divisions return NULL instead of failing when the denominator
+is zero.
+'''
+from sqlalchemy import Float, cast, func
+
+from data_africa.core.exceptions import DataAfricaException
+
+
+def safe_ratio(numerator, denominator):
+    return cast(numerator, Float) / func.nullif(denominator, 0)
+
+
+def _column(tables, name):
+    for table in tables:
+        if hasattr(table, name):
+            return getattr(table, name)
+    raise DataAfricaException("No joined table provides {}".format(name))
+
+
+class Ratio(object):
+    def __init__(self, name, numerator, denominator):
+        self.name = name
+        self.numerator = numerator
+        self.denominator = denominator
+        self.inputs = [numerator, denominator]
+
+    def expression(self, tables):
+        return safe_ratio(_column(tables, self.numerator),
+                          _column(tables, self.denominator))
+
+
+MEASURES = {measure.name: measure for measure in [
+    # value of production in international dollars per hectare harvested
+    Ratio("value_per_ha", "value_of_production", "harvested_area"),
+    # people below the poverty line per person
+    Ratio("num_per_capita", "num", "totpop"),
+]}
+
+
+def is_derived(name):
+    return name in MEASURES
+
+
+def expand(names):
+    '''Replace derived measures in names by their input columns'''
+    result = []
+    for name in names:
+        for col_name in MEASURES[name].inputs if name in MEASURES else [name]:
+            if col_name not in result:
+                result.append(col_name)
+    return result
+
+
+def column(tables, name):
+    '''Labeled expression for a derived measure'''
+    return MEASURES[name].expression(tables).label(name)
@@ -1,2 +1,23 @@
 class DataAfricaException(Exception):
     pass
+
+
+class ServiceException(DataAfricaException):
+    '''An error reported to the client with a specific HTTP status'''
+    status_code = 500
+
+
+class QueryTimeoutException(ServiceException):
+    status_code = 504
+
+
+class NotFoundException(ServiceException):
+    status_code = 404
+
+
+class QueryRejectedException(ServiceException):
+    status_code = 400
+
+
+class QueryQueueFullException(ServiceException):
+    status_code = 503
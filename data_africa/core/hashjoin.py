@@ -0,0 +1,90 @@
+'''Concurrent per-table sub-queries joined in Python
+
+Each relation is one table's sub-query, already narrowed by that table's own
+filters. The sub-queries run at the same time, each on its own pooled
+connection, and their rows are hash joined in the planner's join order on the
+columns each table shares with the tables before it. Like the SQL inner
+join, rows with a NULL join key never match.
+'''
+import threading
+
+from data_africa.database import db
+
+
+class Relation(object):
+    '''A table's sub-query, the column names it selects and its join keys as
+    (column name, index of an earlier relation providing it)'''
+
+    def __init__(self, table, query, names, keys):
+        self.table = table
+        self.query = query
+        self.names = names
+        self.keys = keys
+        self.rows = None
+
+
+def fetch(relations):
+    '''Run the relations' sub-queries concurrently'''
+    # connections are checked out in the request thread, so they get the
+    # statement_timeout of the endpoint being served
+    conns = [db.engine.connect() for _ in relations]
+    errors = []
+
+    def run(conn, relation):
+        try:
+            relation.rows = conn.execute(relation.query.statement).fetchall()
+        except Exception as err:
+            errors.append(err)
+
+    try:
+        threads = [threading.Thread(target=run, args=(conn, relation))
+                   for conn, relation in zip(conns, relations)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for conn in conns:
+            conn.close()
+    if errors:
+        raise errors[0]
+    return relations
+
+
+def join(relations):
+    '''Hash join fetched relations. Returns the joined rows, each the
+    concatenation of one row per relation, and a function mapping
+    (relation index, column name) to a position in those rows.'''
+    offsets = []
+    width = 0
+    for relation in relations:
+        offsets.append(width)
+        width += len(relation.names)
+
+    def position(idx, name):
+        return offsets[idx] + relations[idx].names.index(name)
+
+    rows = [tuple(row) for row in relations[0].rows]
+    for relation in relations[1:]:
+        left = [position(provider, name) for name, provider in relation.keys]
+        right = [relation.names.index(name) for name, _ in relation.keys]
+        index = {}
+        for row in relation.rows:
+            key = tuple(row[i] for i in right)
+            if None not in key:
+                index.setdefault(key, []).append(tuple(row))
+        joined = []
+        for row in rows:
+            key = tuple(row[i] for i in left)
+            if None not in key:
+                for match in index.get(key, ()):
+                    joined.append(row + match)
+        rows = joined
+    return rows, position
+
+
+def order_rows(rows, pos, descending=False):
+    '''Sort rows on one position, NULLs last as in the SQL path'''
+    present = [row for row in rows if row[pos] is not None]
+    present.sort(key=lambda row: row[pos], reverse=descending)
+    return present + [row for row in rows if row[pos] is None]
@@ -2,23 +2,37 @@
 Implementation of logic for joining variables across tables
 '''
 import itertools
-from sqlalchemy import and_, or_
+import re
+from sqlalchemy import String, and_, or_, true
 from sqlalchemy.orm import aliased
 
+from data_africa import app
+from data_africa.core import admission
+from data_africa.core import derived
+from data_africa.core import hashjoin
+from data_africa.core import lookups
+from data_africa.core import planner
 from data_africa.core.table_manager import TableManager
 
 from data_africa.util.helper import splitter
 from data_africa.attrs import consts
 
 from data_africa.attrs.views import attr_map
-from data_africa.core.streaming import stream_qry, stream_qry_csv
-from data_africa.core.exceptions import DataAfricaException
+from data_africa.core.streaming import stream_rows
+from data_africa.core.exceptions import DataAfricaException, QueryRejectedException
 from data_africa.core import get_columns
 from data_africa.spatial.models import Cell5M
 
 from data_africa.database import db
 
 
+def parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
 def parse_method_and_val(cond):
     if cond.startswith("^"):
         return "startswith", cond[1:], False
@@ -31,11 +45,11 @@ def parse_method_and_val(cond):
     elif cond.startswith("str!"):
         return "ne", str(cond[4:]), False
     elif cond.startswith("!"):
-        return "ne", int(cond[1:]), False
+        return "ne", parse_number(cond[1:]), False
     elif cond.startswith(">"):
-        return "gt", int(cond[1:]), False
+        return "gt", parse_number(cond[1:]), False
     elif cond.startswith("<"):
-        return "lt", int(cond[1:]), False
+        return "lt", parse_number(cond[1:]), False
     elif cond.startswith("R<"):
         return "rt", float(cond[2:]), False
     elif cond.startswith("R>"):
@@ -91,17 +105,18 @@ def sumlevel_filtering2(table, api_obj):
 def parse_entities(tables, api_obj):
     '''Give a list of tables and required variables resolve
     the underlying objects'''
-    values = api_obj.vars_needed
-
-    # force the primary key columns to be returned to avoid potential confusion
-    for table in tables:
-        my_missing_pks = [col for col in table.__table__.columns
-                          if col.primary_key and col.key not in values]
-        values += [pkc.key for pkc in my_missing_pks]
-
-    values = set(values)
-
-    col_objs = [get_column_from_tables(tables, value) for value in values]
+    # return the primary keys of the data tables so rows stay distinguishable,
+    # crosswalk keys only when they are asked for
+    keys = [col.key for table in tables
+            if table.is_attr() or not table.is_crosswalk()
+            for col in table.__table__.columns if col.primary_key]
+    values = api_obj.output_names(keys)
+
+    col_objs = [derived.column(tables, value) if derived.is_derived(value)
+                else get_column_from_tables(tables, value) for value in values]
+    for value, col in zip(values, col_objs):
+        if col is None or isinstance(col, list):
+            raise DataAfricaException("Unknown field", value)
 
     return col_objs
 
@@ -117,19 +132,22 @@ def find_overlap(tbl1, tbl2):
 
 
 
-def make_filter(col, cond):
-    '''Generate SQLAlchemy filter based on string'''
+def make_filter(col, cond, numerator=None):
+    '''Generate SQLAlchemy filter based on string. Ratio conditions compare
+    numerator / col, where a zero col excludes the row'''
     method, value, negate = parse_method_and_val(cond)
+    if method in ["rt", "rg"] and numerator is None:
+        raise DataAfricaException("Ratio filters need a numerator.denominator pair")
     if method == "ne":
         expr = col != value
     elif method == "gt":
         expr = col > value
     elif method == "lt":
         expr = col < value
-    # elif method == "rt":
-        # expr = and_(cols[1] != 0, cols[0] / cols[1] < value)
-    # elif method == "rg":
-        # expr = and_(cols[1] != 0, cols[0] / cols[1] > value)
+    elif method == "rt":
+        expr = derived.safe_ratio(numerator, col) < value
+    elif method == "rg":
+        expr = derived.safe_ratio(numerator, col) > value
     else:
         if method == 'like' and "%" not in value:
             method = '__eq__'
@@ -140,6 +158,25 @@ def make_filter(col, cond):
     return expr
 
 
+def lookup_filter(col, cond):
+    '''Filter a lookup column by testing cond against the looked up values
+    and selecting the matching keys'''
+    method, value, negate = parse_method_and_val(cond)
+    if method == "like":
+        pattern = re.escape(value).replace(r"\%", ".*")
+        test = lambda x: re.match(pattern + "$", x) is not None
+    elif method == "ne":
+        test = lambda x: x != str(value)
+    elif method in ["startswith", "endswith"]:
+        test = lambda x: getattr(x, method)(value)
+    else:
+        raise DataAfricaException("Unsupported filter for {}".format(col.key))
+    expr = col.in_(lookups.matching_keys(col, test))
+    if negate:
+        expr = ~expr
+    return expr
+
+
 def where_filters(tables, api_obj):
     '''Process the where query argument from an API call'''
     if not api_obj.where:
@@ -159,12 +196,23 @@ def where_filters(tables, api_obj):
             if hasattr(*args):
                 func = getattr(*args)
                 filts.append(func(cond))
+        elif derived.is_derived(filt_col):
+            filts.append(make_filter(derived.MEASURES[filt_col].expression(tables), cond))
+        elif parse_method_and_val(cond)[0] in ["rt", "rg"]:
+            numerator = get_column_from_tables(tables, target_var)
+            denominator = get_column_from_tables(tables, filt_col)
+            if not numerator or not denominator:
+                raise DataAfricaException("Bad ratio filter", colname)
+            filts.append(make_filter(denominator, cond, numerator))
         else:
             cols = get_column_from_tables(tables, target_var, False)
             for col in cols:
                 table = col.class_
                 filt_col = getattr(table, filt_col)
-                filt = make_filter(filt_col, cond)
+                if lookups.lookup_name(filt_col):
+                    filt = lookup_filter(filt_col, cond)
+                else:
+                    filt = make_filter(filt_col, cond)
                 filts.append(filt)
     return filts
 
@@ -205,13 +253,41 @@ def get_column_from_tables(tables, col, return_first=True):
 def handle_ordering(tables, api_obj):
     '''Process sort and order parameters from the API'''
     sort = "desc" if api_obj.sort == "desc" else "asc"
-    if api_obj.order not in TableManager.possible_variables:
+    if not TableManager.can_order(api_obj.order):
         raise DataAfricaException("Bad order parameter", api_obj.order)
-    my_col = get_column_from_tables(tables, api_obj.order)
+    if derived.is_derived(api_obj.order):
+        my_col = derived.MEASURES[api_obj.order].expression(tables)
+    else:
+        my_col = get_column_from_tables(tables, api_obj.order)
     sort_expr = getattr(my_col, sort)()
     return sort_expr.nullslast()
 
 
+def lookup_order_col(tables, api_obj):
+    '''The order column if it is a lookup. The database only holds its
+    key, so these rows are sorted on the looked up values in Python.'''
+    if not api_obj.order or derived.is_derived(api_obj.order):
+        return None
+    col = get_column_from_tables(tables, api_obj.order)
+    return col if lookups.lookup_name(col) else None
+
+
+def order_by_lookup(qry, col, count, api_obj):
+    '''Every matching row sorted on the looked up values of col, with
+    offset and limit then applied like the SQL path'''
+    max_rows = app.config["LOOKUP_ORDER_MAX_ROWS"]
+    if count > max_rows:
+        raise QueryRejectedException(
+            "Ordering by {} is limited to {:,} matching rows, narrow the query "
+            "with filters".format(api_obj.order, max_rows))
+    mapping = lookups.table(lookups.lookup_name(col))
+    rows = [tuple(row[:-1]) + (mapping.get(row[-1]),) for row in qry.add_columns(col)]
+    rows = hashjoin.order_rows(rows, -1, api_obj.sort == "desc")
+    start = api_obj.offset or 0
+    stop = start + api_obj.limit if api_obj.limit else None
+    return [row[:-1] for row in rows[start:stop]]
+
+
 
 
 def inside_filters(tables, api_obj):
@@ -256,6 +332,30 @@ def simple_filter(qry, tables, api_obj):
                     filts.append(getattr(tbl, col_name).in_(vals))
     return qry.filter(*filts)
 
+def table_filters(tbl, api_obj):
+    '''Conditions from the query variables and sumlevel value filters that
+    apply to a single table'''
+    cols = set(tbl.col_strs(short_name=True))
+    conds = []
+    for col_name, val in api_obj.vars_and_vals.items():
+        if col_name not in cols:
+            continue
+        if col_name == consts.YEAR and val in [consts.LATEST, consts.OLDEST]:
+            years = TableManager.table_years[tbl.full_name()]
+            conds.append(tbl.year == years[val])
+        else:
+            vals = val.split(",")
+            conds.append(getattr(tbl, col_name).in_(vals))
+    # joined filters logic
+    for col, level in api_obj.shows_and_levels.items():
+        args = (tbl, "{}_val_filter".format(col))
+        if hasattr(*args):
+            vals = getattr(*args)(level)
+            if vals:
+                conds.append(~getattr(tbl, col).in_(vals))
+    return conds
+
+
 def make_join_cond(tbl_a, tbl_b, api_obj):
     a_cols = set(tbl_a.col_strs(short_name=True))
     b_cols = tbl_b.col_strs(short_name=True)
@@ -263,35 +363,85 @@ def make_join_cond(tbl_a, tbl_b, api_obj):
 
     conds = [getattr(tbl_a, col_name) == getattr(tbl_b, col_name)
                 for col_name in overlap]
-    # TODO move to function...
-    for col_name, val in api_obj.vars_and_vals.items():
-        if col_name == consts.YEAR and val in [consts.LATEST, consts.OLDEST]:
-            if col_name in a_cols:
-                years1 = TableManager.table_years[tbl_a.full_name()]
-                conds.append(tbl_a.year == years1[val])
-            if col_name in b_cols:
-                years2 = TableManager.table_years[tbl_b.full_name()]
-                conds.append(tbl_b.year == years2[val])
-        else:
-            vals = val.split(",")
-            if col_name in a_cols:
-                conds.append(getattr(tbl_a, col_name).in_(vals))
-            if col_name in b_cols:
-                conds.append(getattr(tbl_b, col_name).in_(vals))
-    # joined filters logic
-    shows_and_levels = api_obj.shows_and_levels.items()
-    for table in [tbl_a, tbl_b]:
-        for col, level in shows_and_levels:
-            args = (table, "{}_val_filter".format(col))
-            if hasattr(*args):
-                vals = getattr(*args)(level)
-                if vals:
-                    conds.append(~getattr(table, col).in_(vals))
+    conds += table_filters(tbl_a, api_obj) + table_filters(tbl_b, api_obj)
     return and_(*conds)
 
 
-def joinable_query(tables, joins, api_obj, tbl_years, csv_format=False):
-    '''Entry point from the view for processing join query'''
+def parallel_relations(tables, cols, api_obj):
+    '''Per-table sub-queries for the hash join path, or None when the query
+    has to run as a single SQL join'''
+    if not app.config["PARALLEL_JOINS"] or len(tables) < 2:
+        return None
+    if len(set(table.get_schema_name() for table in tables)) < 2:
+        return None
+    if api_obj.display_names or api_obj.neighbors or api_obj.inside:
+        return None
+    # derived measures span tables
+    if not all(hasattr(col, "class_") for col in cols):
+        return None
+    for where in splitter(api_obj.where) if api_obj.where else []:
+        colname, cond = where.split(":")
+        if derived.is_derived(colname.rsplit(".", 1)[-1]) or \
+                parse_method_and_val(cond)[0] in ["rt", "rg"]:
+            return None
+    order_col = None
+    if api_obj.order:
+        if derived.is_derived(api_obj.order):
+            return None
+        order_col = get_column_from_tables(tables, api_obj.order)
+        # Python and the database may collate strings differently
+        if isinstance(order_col.type, String):
+            return None
+
+    plan = planner.plan_join_keys(tables, api_obj)
+    order = [table for table, _ in plan]
+    needed = {table: [] for table in order}
+
+    def need(table, name):
+        if name not in needed[table]:
+            needed[table].append(name)
+
+    for table, keys in plan:
+        for name, provider in keys:
+            need(table, name)
+            need(provider, name)
+    for col in cols:
+        need(col.class_, col.key)
+    if order_col is not None:
+        need(order_col.class_, order_col.key)
+
+    relations = []
+    for table, keys in plan:
+        names = needed[table] or [col.key for col in table.__table__.columns
+                                  if col.primary_key]
+        qry = db.session.query(*[getattr(table, name) for name in names])
+        qry = qry.filter(*(table_filters(table, api_obj) +
+                           where_filters([table], api_obj) +
+                           sumlevel_filtering2(table, api_obj)))
+        # a filter reaching into another table would turn into a cross join
+        if len(qry.statement.froms) != 1:
+            return None
+        relations.append(hashjoin.Relation(
+            table, qry, names, [(name, order.index(provider)) for name, provider in keys]))
+    return relations
+
+
+def hash_join_window(rows, position, relations, tables, cols, api_obj):
+    '''Order, offset, limit and project hash joined rows like the SQL path'''
+    index = {relation.table: idx for idx, relation in enumerate(relations)}
+    if api_obj.order:
+        order_col = get_column_from_tables(tables, api_obj.order)
+        rows = hashjoin.order_rows(rows, position(index[order_col.class_], order_col.key),
+                                   api_obj.sort == "desc")
+    start = api_obj.offset or 0
+    stop = start + api_obj.limit if api_obj.limit else None
+    positions = [position(index[col.class_], col.key) for col in cols]
+    return [tuple(row[pos] for pos in positions) for row in rows[start:stop]]
+
+
+def build_join_query(tables, joins, api_obj):
+    '''Build the join query without running it. Returns the query, its
+    output columns and the tables and joins including any crosswalks.'''
     cols = parse_entities(tables, api_obj)
 
     tables = sorted(tables, key=lambda x: 1 if x.is_attr() else -1)
@@ -308,14 +458,22 @@ def joinable_query(tables, joins, api_obj, tbl_years, csv_format=False):
                 joins.append(table.crosswalk())
                 joined_tables.append(sname)
 
-    qry = db.session.query(tables[0]).select_from(tables[0])
-
-    if joins:
+    if joins and app.config["COST_BASED_JOINS"]:
+        plan = planner.plan_joins(tables, api_obj)
+        driver = plan[0][0]
+        qry = db.session.query(driver).select_from(driver)
+        for tbl, conds in plan[1:]:
+            join_conds = conds + table_filters(tbl, api_obj)
+            qry = qry.join(tbl, and_(*join_conds) if join_conds else true())
+        filts += table_filters(driver, api_obj)
+    elif joins:
+        qry = db.session.query(tables[0]).select_from(tables[0])
         combos = list(itertools.product(tables[:1], tables[1:]))
         for tbl_a, tbl_b in combos:
             join_cond = make_join_cond(tbl_a, tbl_b, api_obj)
             qry = qry.join(tbl_b, join_cond)
     else:
+        qry = db.session.query(tables[0]).select_from(tables[0])
         qry = simple_filter(qry, tables, api_obj)
 
     if not qry and len(tables) == 1:
@@ -327,7 +485,8 @@ def joinable_query(tables, joins, api_obj, tbl_years, csv_format=False):
 
     if api_obj.order:
         sort_expr = handle_ordering(tables, api_obj)
-        qry = qry.order_by(sort_expr)
+        if lookup_order_col(tables, api_obj) is None:
+            qry = qry.order_by(sort_expr)
 
     filts += where_filters(tables, api_obj)
 
@@ -339,23 +498,51 @@ def joinable_query(tables, joins, api_obj, tbl_years, csv_format=False):
     qry = handle_neighbors(qry, tables, api_obj)
 
     qry = qry.filter(*filts)
+    return qry, cols, tables, joins
+
 
-    c = qry.count()
-    if c == 0 and api_obj.tries == 0:
-        api_obj.tries += 1
-        if "geo" in api_obj.vars_and_vals and api_obj.vars_and_vals["geo"].startswith("050AF"):
-            orig_geo = api_obj.vars_and_vals["geo"]
-            new_geo = "040AF" + api_obj.vars_and_vals["geo"][5:10]
-            api_obj.vars_and_vals["geo"] = new_geo
-            api_obj.subs["geo"] = {orig_geo: new_geo}
-            return joinable_query(tables, joins, api_obj, tbl_years, csv_format)
-
-    if api_obj.limit:
-        qry = qry.limit(api_obj.limit)
-
-    if api_obj.offset:
-        qry = qry.offset(api_obj.offset)
-
-    if csv_format:
-        return stream_qry_csv(cols, qry, api_obj)
-    return stream_qry(tables, cols, qry, api_obj)
+def joinable_query(tables, joins, api_obj, tbl_years, fmt=None):
+    '''Entry point from the view for processing join query'''
+    qry, cols, tables, joins = build_join_query(tables, joins, api_obj)
+
+    ticket = admission.admit(qry, tables, api_obj)
+    try:
+        relations = parallel_relations(tables, cols, api_obj) if joins else None
+        if relations:
+            joined, position = hashjoin.join(hashjoin.fetch(relations))
+            c = len(joined)
+        else:
+            c = qry.count()
+        if c == 0 and api_obj.tries == 0:
+            api_obj.tries += 1
+            if "geo" in api_obj.vars_and_vals and api_obj.vars_and_vals["geo"].startswith("050AF"):
+                orig_geo = api_obj.vars_and_vals["geo"]
+                new_geo = "040AF" + api_obj.vars_and_vals["geo"][5:10]
+                api_obj.vars_and_vals["geo"] = new_geo
+                api_obj.subs["geo"] = {orig_geo: new_geo}
+                ticket.release()
+                return joinable_query(tables, joins, api_obj, tbl_years, fmt)
+
+        lookup_col = lookup_order_col(tables, api_obj) if not relations else None
+        if relations:
+            rows = hash_join_window(joined, position, relations, tables, cols, api_obj)
+        elif lookup_col is not None:
+            rows = order_by_lookup(qry, lookup_col, c, api_obj)
+        else:
+            if api_obj.limit:
+                qry = qry.limit(api_obj.limit)
+
+            if api_obj.offset:
+                qry = qry.offset(api_obj.offset)
+
+            if fmt == "ndjson":
+                # fetch through a server-side cursor, in batches
+                qry = qry.yield_per(app.config["NDJSON_BATCH_SIZE"])
+            rows = qry
+
+        rows = lookups.translate(cols, rows)
+        resp = stream_rows(fmt, tables, cols, rows, api_obj)
+    except Exception:
+        ticket.release()
+        raise
+    return ticket.attach(resp)
@@ -0,0 +1,215 @@
+'''Bulk loading of data files into the registered tables
+
+A load fills a staging table created with LIKE <table> INCLUDING ALL (same
+columns, defaults, constraints and indexes, plus the table's grants),
+streams every file into it with COPY, runs ANALYZE and renames it over the
+live table. Everything runs in one transaction, so readers see either the
+old or the new table, and a failed load leaves nothing behind. With append
+the current rows are copied into the staging table first. Tables that views
+or foreign keys depend on cannot be swapped and are refused up front. After
+the swap, the copied indexes and constraints get the names of the originals
+back, so names do not drift from load to load.
+
+CSV files need a header row and are sent to COPY as they are. Parquet files
+need pyarrow and are converted in batches. Once every table is loaded the
+POST_LOAD_HOOKS run, ending with a data version bump: the workers then
+rebuild their table metadata, payloads and lookups for the new version in
+the background, without a restart.
+'''
+import csv
+import os
+
+from sqlalchemy import MetaData, Table, text
+
+from data_africa import app
+from data_africa.core import data_version
+from data_africa.core import table_manager
+from data_africa.core.exceptions import DataAfricaException
+from data_africa.core.registrar import registered_models
+from data_africa.database import db
+from data_africa.util import bulk
+
+CSV = "csv"
+PARQUET = "parquet"
+
+POST_LOAD_HOOKS = []
+
+
+def post_load(func):
+    '''Register func(table names) to run after a load'''
+    POST_LOAD_HOOKS.append(func)
+    return func
+
+
+def get_model(full_name):
+    for tbl in registered_models:
+        if table_manager.table_name(tbl) == full_name:
+            return tbl
+    raise DataAfricaException("Unknown table {}".format(full_name))
+
+
+def file_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".parquet", ".pq"):
+        return PARQUET
+    return CSV
+
+
+def _quote(*names):
+    return ".".join('"{}"'.format(name) for name in names)
+
+
+def _check_columns(tbl, columns):
+    table_cols = set(col.name for col in tbl.__table__.columns)
+    unknown = [col for col in columns if col not in table_cols]
+    if unknown:
+        raise DataAfricaException("Unknown columns for {}: {}".format(
+            table_manager.table_name(tbl), ", ".join(unknown)))
+    missing = [col.name for col in tbl.__table__.primary_key.columns if col.name not in columns]
+    if missing:
+        raise DataAfricaException("Missing key columns for {}: {}".format(
+            table_manager.table_name(tbl), ", ".join(missing)))
+
+
+def _copy_csv(conn, tbl, staging, path):
+    with open(path) as handle:
+        columns = next(csv.reader(handle), [])
+        _check_columns(tbl, columns)
+        handle.seek(0)
+        statement = "COPY {} ({}) FROM STDIN WITH CSV HEADER".format(
+            _quote(tbl.__table__.schema, staging), ", ".join(_quote(col) for col in columns))
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(statement, handle)
+        finally:
+            cursor.close()
+
+
+def _copy_parquet(conn, tbl, staging, path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise DataAfricaException("Loading Parquet files requires pyarrow")
+    parquet = pq.ParquetFile(path)
+    columns = parquet.schema_arrow.names
+    _check_columns(tbl, columns)
+
+    def rows():
+        for batch in parquet.iter_batches(batch_size=app.config["LOAD_BATCH_SIZE"]):
+            values = batch.to_pydict()
+            for row in zip(*[values[col] for col in columns]):
+                yield row
+
+    staging_table = Table(staging, MetaData(), schema=tbl.__table__.schema)
+    bulk.copy_rows(conn, staging_table, columns, rows(), app.config["LOAD_BATCH_SIZE"])
+
+
+def _copy_grants(conn, schema, name, staging):
+    grants = conn.execute(text(
+        "SELECT grantee, privilege_type FROM information_schema.role_table_grants "
+        "WHERE table_schema = :schema AND table_name = :name AND grantee <> current_user"),
+        schema=schema, name=name).fetchall()
+    for grantee, privilege in grants:
+        conn.execute("GRANT {} ON {} TO {}".format(
+            privilege, _quote(schema, staging),
+            "PUBLIC" if grantee == "PUBLIC" else _quote(grantee)))
+
+
+def _dependents(conn, schema, name):
+    '''Objects outside the table itself (views, foreign keys of other
+    tables) that depend on it'''
+    return [row[0] for row in conn.execute(text(
+        "SELECT DISTINCT pg_describe_object(d.classid, d.objid, 0) FROM pg_depend d "
+        "LEFT JOIN pg_rewrite r ON d.classid = 'pg_rewrite'::regclass AND r.oid = d.objid "
+        "LEFT JOIN pg_constraint c ON d.classid = 'pg_constraint'::regclass AND c.oid = d.objid "
+        "WHERE d.refclassid = 'pg_class'::regclass AND d.refobjid = CAST(:table AS regclass) "
+        "AND d.deptype = 'n' AND coalesce(r.ev_class, c.conrelid, 0) <> d.refobjid"),
+        table=_quote(schema, name))]
+
+
+def _named_objects(conn, schema, name):
+    '''Constraints and the indexes not backing one, as
+    {(kind, definition without names): [names]}'''
+    found = {}
+    constraints = conn.execute(text(
+        "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = CAST(:table AS regclass) ORDER BY conname"),
+        table=_quote(schema, name))
+    for obj_name, kind, definition in constraints:
+        found.setdefault(("constraint", kind, definition), []).append(obj_name)
+    indexes = conn.execute(text(
+        "SELECT i.relname, x.indisunique, pg_get_indexdef(x.indexrelid) FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "WHERE x.indrelid = CAST(:table AS regclass) AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid) ORDER BY i.relname"),
+        table=_quote(schema, name))
+    for obj_name, unique, definition in indexes:
+        # "CREATE INDEX <name> ON <table> USING ..." without the names
+        found.setdefault(("index", unique, definition.split(" USING ", 1)[1]), []).append(obj_name)
+    return found
+
+
+def _restore_names(conn, schema, name, originals):
+    '''Rename the indexes and constraints of the swapped-in table to the
+    names they had on the table it replaced'''
+    for key, names in _named_objects(conn, schema, name).items():
+        for current, original in zip(names, originals.get(key, [])):
+            if current == original:
+                continue
+            if key[0] == "constraint":
+                # renaming a key constraint renames its index as well
+                conn.execute("ALTER TABLE {} RENAME CONSTRAINT {} TO {}".format(
+                    _quote(schema, name), _quote(current), _quote(original)))
+            else:
+                conn.execute("ALTER INDEX {} RENAME TO {}".format(
+                    _quote(schema, current), _quote(original)))
+
+
+def load_table(tbl, paths, append=False):
+    '''Replace (or append to) a table with the rows of the given files.
+    Returns the number of rows in the table afterwards.'''
+    if db.engine.dialect.name != "postgresql":
+        raise DataAfricaException("Bulk loading requires PostgreSQL")
+    schema, name = tbl.__table__.schema, tbl.__table__.name
+    staging = "{}_load_{}".format(name, os.getpid())
+    old = "{}_old_{}".format(name, os.getpid())
+    with db.engine.begin() as conn:
+        # a load is not bound by the API's statement budget
+        conn.execute("SET LOCAL statement_timeout = 0")
+        dependents = _dependents(conn, schema, name)
+        if dependents:
+            raise DataAfricaException("Cannot replace {}.{}, drop these first: {}".format(
+                schema, name, ", ".join(dependents)))
+        originals = _named_objects(conn, schema, name)
+        conn.execute("CREATE TABLE {} (LIKE {} INCLUDING ALL)".format(
+            _quote(schema, staging), _quote(schema, name)))
+        _copy_grants(conn, schema, name, staging)
+        if append:
+            conn.execute("INSERT INTO {} SELECT * FROM {}".format(
+                _quote(schema, staging), _quote(schema, name)))
+        for path in paths:
+            if file_format(path) == PARQUET:
+                _copy_parquet(conn, tbl, staging, path)
+            else:
+                _copy_csv(conn, tbl, staging, path)
+        conn.execute("ANALYZE {}".format(_quote(schema, staging)))
+        rows = conn.execute("SELECT count(*) FROM {}".format(_quote(schema, staging))).scalar()
+
+        # readers block from here until commit, give up rather than queue forever
+        conn.execute("SET LOCAL lock_timeout = {:d}".format(app.config["LOAD_LOCK_TIMEOUT"]))
+        conn.execute("ALTER TABLE {} RENAME TO {}".format(_quote(schema, name), _quote(old)))
+        conn.execute("ALTER TABLE {} RENAME TO {}".format(_quote(schema, staging), _quote(name)))
+        conn.execute("DROP TABLE {}".format(_quote(schema, old)))
+        _restore_names(conn, schema, name, originals)
+    return rows
+
+
+def run_hooks(table_names):
+    for hook in POST_LOAD_HOOKS:
+        hook(table_names)
+
+
+@post_load
+def bump_version(table_names):
+    # cached metadata is keyed by version, so this alone invalidates it
+    data_version.bump()
@@ -0,0 +1,132 @@
+'''In-process lookup tables for derived attribute columns
+
+Columns such as the url_name of a poverty or DHS geography used to be
+correlated scalar subqueries, evaluated by Postgres once per output row.
+They are now declared with lookup_property: the query selects the key column
+itself and, once rows come back, the key is replaced with a dictionary
+lookup. The dictionaries are built once per process from the crosswalk and
+attribute tables and kept per data version; they are rebuilt after
+LOOKUP_MAX_AGE seconds or right away with refresh(). A new data version has
+its dictionaries built in the background before the process switches to it.
+'''
+import time
+
+from sqlalchemy import String, type_coerce
+from sqlalchemy.orm import column_property
+
+from data_africa import app
+from data_africa.core import data_version
+
+_tables = {}
+
+
+def _poverty_url_names():
+    from data_africa.attrs.models import Geo
+    from data_africa.spatial.models import PovertyXWalk
+    qry = Geo.query.join(PovertyXWalk, PovertyXWalk.geo == Geo.id) \
+        .with_entities(PovertyXWalk.poverty_geo, Geo.url_name) \
+        .order_by(PovertyXWalk.pct_overlap.asc().nullsfirst())
+    # the geography with the largest overlap wins
+    return dict(qry)
+
+
+def _dhs_url_names():
+    from data_africa.attrs.models import Geo
+    from data_africa.spatial.models import DHSXWalk
+    qry = Geo.query.join(DHSXWalk, DHSXWalk.geo == Geo.id) \
+        .with_entities(DHSXWalk.dhs_geo, Geo.url_name) \
+        .order_by(DHSXWalk.pct_overlap.asc().nullsfirst())
+    return dict(qry)
+
+
+def _adm0_names():
+    from data_africa.attrs.models import Geo
+    from data_africa.attrs.consts import ADM0
+    qry = Geo.query.filter(Geo.level == ADM0) \
+        .with_entities(Geo.iso2, Geo.name)
+    return dict(qry)
+
+
+BUILDERS = {
+    "poverty_url_name": _poverty_url_names,
+    "dhs_url_name": _dhs_url_names,
+    "adm0_name": _adm0_names,
+}
+
+
+def lookup_property(name, key_col):
+    '''Map an attribute that selects key_col from the database and is
+    translated through the named lookup table when rows are returned'''
+    return column_property(type_coerce(key_col, String),
+                           info={"lookup": name, "key": key_col})
+
+
+def _info(col):
+    prop = getattr(col, "property", None)
+    return getattr(prop, "info", None) or {}
+
+
+def lookup_name(col):
+    '''Name of the lookup behind a mapped attribute, or None'''
+    return _info(col).get("lookup")
+
+
+def key_name(col):
+    '''Name of the physical key column a lookup attribute selects'''
+    return _info(col)["key"].key
+
+
+def _build(name, version):
+    mapping = BUILDERS[name]()
+    _tables[(name, version)] = (time.time(), mapping)
+    return mapping
+
+
+def table(name):
+    max_age = app.config["LOOKUP_MAX_AGE"]
+    version = data_version.current()
+    built, mapping = _tables.get((name, version), (None, None))
+    if built is None or (max_age and time.time() - built > max_age):
+        mapping = _build(name, version)
+    return mapping
+
+
+@data_version.on_prepare
+def prepare(version):
+    for name in BUILDERS:
+        _build(name, version)
+
+
+@data_version.on_activate
+def activate(version):
+    for key in list(_tables):
+        if key[1] != version:
+            _tables.pop(key, None)
+
+
+def refresh():
+    '''Drop the lookup tables so they are rebuilt on next use'''
+    _tables.clear()
+
+
+def translate(cols, rows):
+    '''Replace lookup keys by their values in an iterable of rows'''
+    targets = [(idx, table(lookup_name(col)))
+               for idx, col in enumerate(cols) if lookup_name(col)]
+    if not targets:
+        return rows
+
+    def generate():
+        for row in rows:
+            row = list(row)
+            for idx, mapping in targets:
+                row[idx] = mapping.get(row[idx])
+            yield row
+    return generate()
+
+
+def matching_keys(col, test):
+    '''Keys of the lookup behind col whose value passes test'''
+    mapping = table(lookup_name(col))
+    return [key for key, value in mapping.items()
+            if value is not None and test(value)]
@@ -0,0 +1,146 @@
+'''Pre-encoded payloads for the metadata endpoints
+
+The variables, table variables and geo variables responses only depend on
+the registered models, so they are encoded once per process. The variables
+endpoint is indexed by the (show, sumlevel) pairs a table accepts, and the
+body for each requested combination is kept once built. The years payload
+depends on the loaded data and is kept per data version; a new version's
+payload is built in the background before the process switches to it.
+Every payload carries an ETag. The model-derived ones are served with a
+long Cache-Control; the years payload is served with no-cache, so clients
+revalidate it and see a new data version right away.
+'''
+import hashlib
+
+import simplejson
+from flask import Response, request
+
+from data_africa import app
+from data_africa.core import data_version
+from data_africa.core.registrar import registered_models
+
+# bound on the number of distinct variables bodies kept per process
+MAX_VARIABLES_BODIES = 1024
+
+_state = {"static": None, "years": {}}
+
+
+class Payload(object):
+    '''An encoded JSON body and its ETag'''
+
+    def __init__(self, **data):
+        self.body = simplejson.dumps(data, sort_keys=True, separators=(",", ":"))
+        self.etag = hashlib.md5(self.body.encode("utf-8")).hexdigest()
+
+    def cache_headers(self, resp):
+        resp.cache_control.public = True
+        resp.cache_control.max_age = app.config["METADATA_MAX_AGE"]
+
+    def response(self):
+        resp = Response(self.body, mimetype="application/json")
+        resp.set_etag(self.etag)
+        self.cache_headers(resp)
+        return resp.make_conditional(request)
+
+
+class VersionedPayload(Payload):
+    '''A payload that changes with the data version: clients revalidate
+    it on every use, answered with a 304 until the version moves'''
+
+    def cache_headers(self, resp):
+        resp.cache_control.public = True
+        resp.cache_control.no_cache = True
+
+
+def _geo_variables():
+    geo_data = {}
+    for table in registered_models:
+        if table.get_schema_name() == 'spatial':
+            continue
+        if table.can_show("geo", "adm0"):
+            levels = dict(table.get_supported_levels())
+            levels.setdefault('year', ['all'])
+            for col in table.measures(short_name=True):
+                if col in ['year', 'start_year']:
+                    continue
+                geo_data.setdefault(col, {"column": col, "levels": []})
+                geo_data[col]["levels"].append(levels)
+    return list(geo_data.values())
+
+
+def _build():
+    table_vars = {table.full_name(): table.col_strs(short_name=True)
+                  for table in registered_models}
+    by_pair = {}
+    for table in registered_models:
+        for show, levels in table.get_supported_levels().items():
+            for sumlevel in levels:
+                by_pair.setdefault((show, sumlevel), {})[table.full_name()] = \
+                    table_vars[table.full_name()]
+    table_payload = Payload(metadata=table_vars)
+    return {
+        "by_pair": by_pair,
+        "table_variables": table_payload,
+        "geo_variables": Payload(metadata=_geo_variables()),
+        # no show and no sumlevel lists every table
+        "variables": {None: table_payload},
+    }
+
+
+def _static():
+    if _state["static"] is None:
+        _state["static"] = _build()
+    return _state["static"]
+
+
+def variables(shows, sumlevels):
+    '''Payload listing the tables able to show any (show, sumlevel) pair.
+    Pairs no table accepts match nothing and are dropped from the key.'''
+    static = _static()
+    if shows == [""] and sumlevels == [""]:
+        return static["variables"][None]
+    if sumlevels == [""]:
+        sumlevels = ["all"] * len(shows)
+    key = tuple(sorted(set(pair for pair in zip(shows, sumlevels)
+                           if pair in static["by_pair"])))
+    payload = static["variables"].get(key)
+    if payload is None:
+        results = {}
+        for pair in key:
+            results.update(static["by_pair"][pair])
+        payload = Payload(metadata=results)
+        if len(static["variables"]) < MAX_VARIABLES_BODIES:
+            static["variables"][key] = payload
+    return payload
+
+
+def table_variables():
+    return _static()["table_variables"]
+
+
+def geo_variables():
+    return _static()["geo_variables"]
+
+
+def years(years_set):
+    version = data_version.current()
+    payload = _state["years"].get(version)
+    if payload is None:
+        payload = _state["years"][version] = VersionedPayload(data=years_set)
+    return payload
+
+
+@data_version.on_prepare
+def prepare(version):
+    from data_africa.core.table_manager import tbl_years_set
+    _state["years"][version] = VersionedPayload(data=tbl_years_set(version))
+
+
+@data_version.on_activate
+def activate(version):
+    _state["years"] = {version: _state["years"][version]}
+
+
+def warm(years_set):
+    _static()
+    years(years_set)
@@ -0,0 +1,377 @@
+'''Prometheus metrics aggregated across gunicorn workers
+
+Requests are recorded into dictionaries owned by the serving thread, so the
+request path takes no lock. At the end of a request, once every
+METRICS_FLUSH_INTERVAL seconds, the worker sums its threads' values and
+writes them, together with its pool, coalescing and cache counters and pool
+gauges, to METRICS_DIR/<pid>.<start>.json with an atomic rename; the start
+time keeps a recycled pid from overwriting an exited worker's file.
+/metrics merges the files of all workers: gauges only count live workers,
+while the counters and histograms of exited workers are folded into one
+EXITED file, under an flock, and their own files removed.
+'''
+import contextlib
+import glob
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # exited workers' files are kept on this platform
+    fcntl = None
+
+import simplejson
+import six
+from flask import Blueprint, Response, g, request
+
+from data_africa import app, cache
+from data_africa.core import coalesce
+from data_africa.core import pool_stats
+from data_africa.core import querylog
+from data_africa.database import db
+
+mod = Blueprint('metrics', __name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HELP = {
+    "data_africa_requests_total": ("counter", "Requests by route and status"),
+    "data_africa_request_duration_seconds": (
+        "histogram", "Time until the response was fully sent, by route, planned tables and format"),
+    "data_africa_response_rows_total": ("counter", "Rows streamed by route and format"),
+    "data_africa_response_bytes_total": ("counter", "Response bytes sent by route and format"),
+    "data_africa_exceptions_total": ("counter", "DataAfricaException errors by type"),
+    "data_africa_cache_hits_total": ("counter", "Cache hits by namespace"),
+    "data_africa_cache_misses_total": ("counter", "Cache misses by namespace"),
+    "data_africa_cache_bytes": ("gauge", "Bytes held in the shared cache by namespace"),
+    "data_africa_cache_entries": ("gauge", "Entries held in the shared cache by namespace"),
+    "data_africa_db_pool_checked_out": ("gauge", "Connections checked out"),
+    "data_africa_db_pool_size": ("gauge", "Pool size"),
+    "data_africa_db_pool_overflow": ("gauge", "Connections above the pool size"),
+    "data_africa_db_pool_events_total": ("counter", "Pool events by kind"),
+    "data_africa_db_pool_wait_seconds_total": ("counter", "Time spent waiting for a connection"),
+    "data_africa_coalesce_total": ("counter", "Coalesced request outcomes by kind"),
+}
+
+_registry = []
+_registry_lock = threading.Lock()
+_local = threading.local()
+_flush_lock = threading.Lock()
+_state = {"flushed": 0.0, "pid": None, "started": None}
+
+# totals of the workers that have exited, in METRICS_DIR
+EXITED = "exited.totals"
+
+
+def _values():
+    values = getattr(_local, "values", None)
+    if values is None:
+        values = _local.values = {"counters": {}, "histograms": {}}
+        # once per thread, not per request
+        with _registry_lock:
+            _registry.append(values)
+    return values
+
+
+def _labels(**labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    counters = _values()["counters"]
+    key = (name, _labels(**labels))
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    histograms = _values()["histograms"]
+    key = (name, _labels(**labels))
+    hist = histograms.get(key)
+    if hist is None:
+        hist = histograms[key] = [0] * (len(BUCKETS) + 2)
+    for idx, bound in enumerate(BUCKETS):
+        if value <= bound:
+            hist[idx] += 1
+            break
+    else:
+        hist[len(BUCKETS)] += 1
+    hist[-1] += value
+
+
+def label(tables=None, fmt=None):
+    '''Attach the planned table set and output format to this request'''
+    if tables is not None:
+        g.metrics_tables = ",".join(sorted(table.full_name() for table in tables))
+    if fmt is not None:
+        g.metrics_format = fmt
+
+
+def count_exception(err):
+    inc("data_africa_exceptions_total", type=type(err).__name__)
+
+
+def _key(name, labels):
+    return simplejson.dumps([name, labels])
+
+
+def _process_values():
+    '''This worker's counters, histograms and gauges keyed for JSON'''
+    counters = {}
+    histograms = {}
+    with _registry_lock:
+        registry = list(_registry)
+    for values in registry:
+        # dict() copies in one step under the GIL
+        for (name, labels), val in dict(values["counters"]).items():
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + val
+        for (name, labels), hist in dict(values["histograms"]).items():
+            key = _key(name, labels)
+            total = histograms.setdefault(key, [0] * len(hist))
+            for idx, val in enumerate(list(hist)):
+                total[idx] += val
+
+    for kind, val in pool_stats.STATS.items():
+        if kind == "wait_seconds_total":
+            counters[_key("data_africa_db_pool_wait_seconds_total", [])] = val
+        elif kind != "wait_seconds_max":
+            counters[_key("data_africa_db_pool_events_total", [["kind", kind]])] = val
+    for kind, val in coalesce.STATS.items():
+        counters[_key("data_africa_coalesce_total", [["kind", kind]])] = val
+    backend_counts = getattr(cache.cache, "counts", None)
+    if backend_counts is not None:
+        for namespace, counts in backend_counts().items():
+            labels = [["namespace", namespace]]
+            counters[_key("data_africa_cache_hits_total", labels)] = counts["hits"]
+            counters[_key("data_africa_cache_misses_total", labels)] = counts["misses"]
+
+    gauges = {}
+    pool = db.engine.pool
+    if hasattr(pool, "checkedout"):
+        gauges[_key("data_africa_db_pool_checked_out", [])] = pool.checkedout()
+        gauges[_key("data_africa_db_pool_size", [])] = pool.size()
+        gauges[_key("data_africa_db_pool_overflow", [])] = max(pool.overflow(), 0)
+    return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+def _file_name():
+    # forked workers inherit the state, so the pid tells when to restart it
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        _state["pid"] = pid
+        _state["started"] = int(time.time() * 1000)
+    return "{}.{}.json".format(pid, _state["started"])
+
+
+def flush():
+    '''Write this worker's values to its file in METRICS_DIR'''
+    metrics_dir = app.config["METRICS_DIR"]
+    if not os.path.isdir(metrics_dir):
+        try:
+            os.makedirs(metrics_dir)
+        except OSError:  # created by another worker meanwhile
+            pass
+    path = os.path.join(metrics_dir, _file_name())
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as handle:
+        simplejson.dump(_process_values(), handle)
+    os.rename(tmp_path, path)
+    _state["flushed"] = time.time()
+
+
+def maybe_flush():
+    if time.time() - _state["flushed"] < app.config["METRICS_FLUSH_INTERVAL"]:
+        return
+    # only one thread flushes, the others carry on
+    if _flush_lock.acquire(False):
+        try:
+            flush()
+        except (IOError, OSError) as err:
+            app.logger.warning("Unable to write metrics: %s", err)
+        finally:
+            _flush_lock.release()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _file_id(path):
+    '''(pid, start time) of a worker file; files written before the start
+    time was added to the name have none'''
+    parts = os.path.basename(path).split(".")
+    return int(parts[0]), int(parts[1]) if len(parts) > 2 else 0
+
+
+def _add(merged, values):
+    for key, val in values["counters"].items():
+        merged["counters"][key] = merged["counters"].get(key, 0) + val
+    for key, hist in values["histograms"].items():
+        total = merged["histograms"].setdefault(key, [0] * len(hist))
+        for idx, val in enumerate(hist):
+            total[idx] += val
+
+
+def _load(path):
+    with open(path) as handle:
+        return simplejson.load(handle)
+
+
+def _running(paths):
+    '''Paths of the running workers: the newest file of each live pid'''
+    newest = {}
+    for path in paths:
+        pid, started = _file_id(path)
+        if started > newest.get(pid, (-1, None))[0]:
+            newest[pid] = (started, path)
+    return set(path for pid, (started, path) in newest.items() if _alive(pid))
+
+
+@contextlib.contextmanager
+def _dir_lock(metrics_dir):
+    if fcntl is None:
+        yield False
+        return
+    with open(os.path.join(metrics_dir, ".lock"), "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)  # released when closed
+        yield True
+
+
+def _retire(metrics_dir, paths, running):
+    '''Fold the counters and histograms of exited workers into EXITED and
+    remove their files. EXITED remembers the files it folded last, so a
+    crash before they are removed does not count them twice.'''
+    exited = [path for path in paths if path not in running]
+    if not exited:
+        return
+    totals_path = os.path.join(metrics_dir, EXITED)
+    try:
+        totals = _load(totals_path)
+    except (IOError, ValueError):
+        totals = {"counters": {}, "histograms": {}, "files": []}
+    folded = set(totals["files"])
+    for path in exited:
+        if os.path.basename(path) in folded:
+            continue
+        try:
+            _add(totals, _load(path))
+        except ValueError:  # unreadable, drop it
+            pass
+    totals["files"] = [os.path.basename(path) for path in exited]
+    tmp_path = "{}.tmp".format(totals_path)
+    with open(tmp_path, "w") as handle:
+        simplejson.dump(totals, handle)
+    os.rename(tmp_path, totals_path)
+    for path in exited:
+        os.remove(path)
+
+
+def collect():
+    '''Merge the files of every worker'''
+    with _flush_lock:
+        flush()
+    metrics_dir = app.config["METRICS_DIR"]
+    merged = {"counters": {}, "histograms": {}, "gauges": {}}
+    # a scrape in another worker must not retire files while these are read
+    with _dir_lock(metrics_dir) as locked:
+        paths = glob.glob(os.path.join(metrics_dir, "*.json"))
+        running = _running(paths)
+        if locked:
+            _retire(metrics_dir, paths, running)
+            paths = running
+        try:
+            _add(merged, _load(os.path.join(metrics_dir, EXITED)))
+        except (IOError, ValueError):  # no worker has exited yet
+            pass
+        for path in paths:
+            try:
+                values = _load(path)
+            except (IOError, ValueError):  # replaced while reading
+                continue
+            _add(merged, values)
+            if path in running:
+                for key, val in values["gauges"].items():
+                    merged["gauges"][key] = merged["gauges"].get(key, 0) + val
+
+    # the shared cache is read once rather than summed per worker
+    backend_stats = getattr(cache.cache, "stats", None)
+    if backend_stats is not None:
+        for namespace, stats in backend_stats().items():
+            labels = [["namespace", namespace]]
+            merged["gauges"][_key("data_africa_cache_bytes", labels)] = stats["bytes"]
+            merged["gauges"][_key("data_africa_cache_entries", labels)] = stats["entries"]
+    return merged
+
+
+def _escape(value):
+    return six.text_type(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name, labels, value):
+    if labels:
+        label_str = ",".join('{}="{}"'.format(key, _escape(val)) for key, val in labels)
+        return "{}{{{}}} {}".format(name, label_str, repr(float(value)))
+    return "{} {}".format(name, repr(float(value)))
+
+
+def render(merged):
+    '''Prometheus text exposition format'''
+    by_name = {}
+    for kind in ["counters", "gauges", "histograms"]:
+        for key, val in merged[kind].items():
+            name, labels = simplejson.loads(key)
+            by_name.setdefault(name, []).append((labels, val))
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text = HELP.get(name, ("untyped", name))
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, val in sorted(by_name[name]):
+            if metric_type != "histogram":
+                lines.append(_series(name, labels, val))
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), val[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else repr(bound)
+                lines.append(_series(name + "_bucket", labels + [["le", le]], cumulative))
+            lines.append(_series(name + "_sum", labels, val[-1]))
+            lines.append(_series(name + "_count", labels, cumulative))
+    return "\n".join(lines) + "\n"
+
+
+@app.before_request
+def start_timer():
+    g.metrics_start = time.time()
+
+
+@app.after_request
+def record(resp):
+    if not app.config["METRICS"] or request.endpoint == "metrics.metrics_view":
+        return resp
+    start = getattr(g, "metrics_start", time.time())
+    route = request.endpoint or "none"
+    tables = getattr(g, "metrics_tables", "")
+    fmt = getattr(g, "metrics_format", "")
+    status = str(resp.status_code)
+
+    def finish(size):
+        stats = getattr(resp, "stats", None) or {}
+        inc("data_africa_requests_total", route=route, status=status)
+        observe("data_africa_request_duration_seconds", time.time() - start,
+                route=route, tables=tables, format=fmt)
+        inc("data_africa_response_rows_total", stats.get("rows") or 0, route=route, format=fmt)
+        inc("data_africa_response_bytes_total", size, route=route, format=fmt)
+        maybe_flush()
+
+    return querylog.when_sent(resp, finish)
+
+
+@mod.route("/metrics")
+def metrics_view():
+    return Response(render(collect()), mimetype="text/plain; version=0.0.4")
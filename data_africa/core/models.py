@@ -71,19 +71,27 @@ class BaseModel(object):
     def is_attr():
         return False
 
+    @staticmethod
+    def is_crosswalk():
+        return False
+
 
 class ApiObject(object):
     def __init__(self, **kwargs):
         allowed = ["vars_needed", "vars_and_vals", "values",
                    "shows_and_levels", "force", "where", "order",
                    "sort", "limit", "exclude", "auto_crosswalk",
-                   "display_names", "offset", "inside", "neighbors"]
+                   "display_names", "offset", "inside", "neighbors",
+                   "fields", "layout"]
         self._year = None
         self.auto_crosswalk = False
         self.display_names = False
         self.offset = None
         self.inside = None
         self.neighbors = None
+        self.exclude = None
+        self.fields = None
+        self.layout = None
         self.tries = 0
         self.vars_and_vals = {}
         for keyword, value in kwargs.items():
@@ -100,6 +108,8 @@ class ApiObject(object):
         self.warnings = []
         if self.exclude:
             self.exclude = self.exclude.split(",")
+        if self.fields:
+            self.fields = self.fields.split(",")
         if hasattr(self, "year") and self.year != ALL:
             self._year = self.year
         self.force_schema = None
@@ -128,6 +138,17 @@ class ApiObject(object):
             self.subs[tbl_name][col] = {}
         self.subs[tbl_name][col] = deltas
 
+    def output_names(self, keys):
+        '''Names of the columns to return: the fields argument when given,
+        otherwise the needed variables and keys without the excluded ones'''
+        if self.fields:
+            return list(self.fields)
+        names = []
+        for name in self.vars_needed + keys:
+            if name and name not in names and name not in (self.exclude or []):
+                names.append(name)
+        return names
+
     def where_vars(self):
         if not hasattr(self, "where") or not self.where:
             return []
@@ -135,6 +156,9 @@ class ApiObject(object):
         wheres = self.where.split(",")
         # then split by colons, and take the last item after period e.g.
         var_names = [x.split(":")[0].split(".")[-1] for x in wheres]
+        # ratio conditions (R< and R>) also need the numerator column
+        var_names += [x.split(":")[0].rsplit(".", 1)[0] for x in wheres
+                      if x.split(":", 1)[-1].startswith(("R<", "R>"))]
         var_names = [x for x in var_names if x != 'sumlevel']
         # so where=year:2014,grads_total.degree:5 => ['year', 'degree']
         return var_names
@@ -0,0 +1,56 @@
+'''Cost-based join ordering for joinable_query
+
+Instead of joining every table to the first one, the planner builds a
+left-deep join tree. The table with the fewest estimated rows after its own
+filters (from tbl_sizes, the distinct counts of its key columns and the
+vars_and_vals/where/sumlevel filters that apply to it) drives the join.
+Each following table is the cheapest one sharing a column with the tables
+already joined. Every shared column is joined once, against the first
+table that provided it, so three tables sharing a key get two conditions
+instead of three.
+'''
+from data_africa.core import admission
+from data_africa.core.table_manager import tbl_sizes, tbl_distinct_counts
+
+
+def estimate_rows(tables, api_obj):
+    sizes = tbl_sizes()
+    distinct_counts = tbl_distinct_counts()
+    return {table: admission.estimate_table_rows(table, api_obj, sizes, distinct_counts)
+            for table in tables}
+
+
+def plan_join_keys(tables, api_obj):
+    '''Return [(table, [(column name, earlier table)])] in join order. The
+    first entry is the driving table and has no keys. Attribute tables never
+    drive and are joined after the data tables.'''
+    estimates = estimate_rows(tables, api_obj)
+
+    def cost(table):
+        return (table.is_attr(), estimates[table], tables.index(table))
+
+    driver = min(tables, key=cost)
+    provided = {}
+    for col_name in driver.col_strs(short_name=True):
+        provided.setdefault(col_name, driver)
+    plan = [(driver, [])]
+    remaining = [table for table in tables if table is not driver]
+
+    while remaining:
+        connected = [table for table in remaining
+                     if set(table.col_strs(short_name=True)).intersection(provided)]
+        nxt = min(connected or remaining, key=cost)
+        cols = nxt.col_strs(short_name=True)
+        keys = [(col_name, provided[col_name]) for col_name in cols if col_name in provided]
+        for col_name in cols:
+            provided.setdefault(col_name, nxt)
+        plan.append((nxt, keys))
+        remaining.remove(nxt)
+    return plan
+
+
+def plan_joins(tables, api_obj):
+    '''Return [(table, join conditions)] in join order, see plan_join_keys'''
+    return [(table, [getattr(table, col_name) == getattr(provider, col_name)
+                     for col_name, provider in keys])
+            for table, keys in plan_join_keys(tables, api_obj)]
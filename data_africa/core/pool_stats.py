@@ -0,0 +1,125 @@
+'''Connection pool telemetry and per-endpoint statement timeouts
+
+InstrumentedQueuePool records how long each checkout waited for a
+connection, how often the overflow was used and how many checkouts timed
+out. Pool events count connects, checkouts, checkins and invalidations.
+On checkout the connection's statement_timeout is set to the budget of the
+endpoint being served, so a runaway query is cancelled by Postgres and
+answered with a clean error instead of gunicorn killing the worker.
+'''
+import os
+import threading
+import time
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy import exc as sqla_exc
+from sqlalchemy.pool import QueuePool
+
+from data_africa import app
+
+QUERY_CANCELED = "57014"
+TIMEOUT_MESSAGE = ("Query exceeded the time budget for this endpoint, "
+                   "try adding filters or lowering the limit")
+
+_lock = threading.Lock()
+STATS = {
+    "connects": 0,
+    "checkouts": 0,
+    "checkins": 0,
+    "invalidations": 0,
+    "checkout_timeouts": 0,
+    "overflow_checkouts": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+
+
+def reset():
+    '''Zero the counters, e.g. in a worker forked from a preloaded master'''
+    with _lock:
+        for key in STATS:
+            STATS[key] = 0.0 if isinstance(STATS[key], float) else 0
+
+
+def _incr(key, amount=1):
+    with _lock:
+        STATS[key] += amount
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''QueuePool that measures how long callers wait for a connection'''
+
+    def _do_get(self):
+        start = time.time()
+        overflow = self.overflow()
+        try:
+            conn = super(InstrumentedQueuePool, self)._do_get()
+        except sqla_exc.TimeoutError:
+            _incr("checkout_timeouts")
+            raise
+        waited = time.time() - start
+        with _lock:
+            STATS["wait_seconds_total"] += waited
+            STATS["wait_seconds_max"] = max(STATS["wait_seconds_max"], waited)
+            # only checkouts that opened a connection above the pool size
+            if self.overflow() > max(overflow, 0):
+                STATS["overflow_checkouts"] += 1
+        return conn
+
+
+def statement_timeout():
+    '''Statement timeout in milliseconds for the endpoint being served'''
+    endpoint = request.endpoint if has_request_context() else None
+    return app.config["STATEMENT_TIMEOUTS"].get(
+        endpoint, app.config["STATEMENT_TIMEOUT_DEFAULT"])
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def on_connect(dbapi_conn, record):
+    _incr("connects")
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def on_checkout(dbapi_conn, record, proxy):
+    _incr("checkouts")
+    timeout = statement_timeout()
+    if timeout is None or record.info.get("statement_timeout") == timeout:
+        return
+    cursor = dbapi_conn.cursor()
+    cursor.execute("SET statement_timeout = %s", (int(timeout),))
+    cursor.close()
+    # commit so the setting outlives the rollback done when the connection
+    # is returned, letting later checkouts skip the round trip
+    dbapi_conn.commit()
+    record.info["statement_timeout"] = timeout
+
+
+@event.listens_for(InstrumentedQueuePool, "checkin")
+def on_checkin(dbapi_conn, record):
+    _incr("checkins")
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def on_invalidate(dbapi_conn, record, exception):
+    _incr("invalidations")
+
+
+def is_statement_timeout(err):
+    return getattr(getattr(err, "orig", None), "pgcode", None) == QUERY_CANCELED
+
+
+def snapshot(pool):
+    '''Counters for this worker plus the live state of its pool'''
+    with _lock:
+        stats = dict(STATS)
+    stats["wait_seconds_avg"] = (stats["wait_seconds_total"] / stats["checkouts"]
+                                 if stats["checkouts"] else 0.0)
+    stats["pid"] = os.getpid()
+    stats["pool"] = pool.__class__.__name__
+    for name in ["size", "checkedin", "checkedout", "overflow"]:
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    if hasattr(pool, "_max_overflow"):
+        stats["max_overflow"] = pool._max_overflow
+    return stats
@@ -0,0 +1,59 @@
+'''Build immutable metadata before gunicorn forks its workers
+
+With preload_app the master imports the app once, which already computes
+attr_map, TableManager.possible_variables and the table years. warm()
+additionally builds the remaining metadata and lookup structures, then
+closes every database connection so no socket is shared with the workers.
+Workers inherit the result copy-on-write; gc.freeze (Python 3.7+) keeps the
+garbage collector from touching, and thereby copying, the inherited pages.
+'''
+import gc
+import time
+
+from data_africa import app
+from data_africa.attrs import payloads
+from data_africa.attrs.models import get_mapped_attrs
+from data_africa.core import lookups
+from data_africa.core import metadata
+from data_africa.core import table_manager
+from data_africa.database import db
+from data_africa.spatial import locate
+
+
+def warm():
+    '''Build all shared metadata, returning seconds spent per step'''
+    timings = {}
+
+    def step(name, func):
+        start = time.time()
+        func()
+        timings[name] = time.time() - start
+
+    step("tbl_years", table_manager.tbl_years)
+    step("tbl_years_set", table_manager.tbl_years_set)
+    step("tbl_sizes", table_manager.tbl_sizes)
+    step("tbl_distinct_counts", table_manager.tbl_distinct_counts)
+    for name in lookups.BUILDERS:
+        step("lookup:" + name, lambda: lookups.table(name))
+    step("metadata", lambda: metadata.warm(table_manager.TableManager.table_years_set))
+    for kind, attr_cls in get_mapped_attrs().items():
+        step("attrs:" + kind, lambda: payloads.get(kind, attr_cls).body())
+    if app.config["LOCATE_PRELOAD"]:
+        step("locate", locate.index)
+    return timings
+
+
+def prepare_fork():
+    '''Drop pooled connections and freeze the heap before forking'''
+    db.session.remove()
+    db.engine.dispose()
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def preload():
+    timings = warm()
+    prepare_fork()
+    app.logger.info("Preloaded metadata in %.2fs", sum(timings.values()))
+    return timings
@@ -0,0 +1,127 @@
+'''Opt-in capture of API requests into a compact append-only log
+
+When QUERY_LOG_PATH is set, every view wrapped with capture appends one JSON
+line per request holding the normalized query args, status, latency, row
+count and response size. Lines are written with a single O_APPEND write so
+several gunicorn workers can share one file, which is rotated externally
+(e.g. by logrotate): a worker reopens the path once the file it writes to
+has been renamed. The log can be replayed with the replay and warm_cache
+commands.
+'''
+import functools
+import os
+import time
+
+import simplejson
+import six
+from flask import jsonify, request
+from six.moves.urllib.parse import urlencode
+
+from data_africa import app
+
+# path: (pid, descriptor, inode)
+_files = {}
+
+
+def normalize_args(args):
+    '''Stable representation of the query args: sorted, without empty values'''
+    pairs = sorted((key, val) for key, vals in args.lists()
+                   for val in vals if val != "")
+    return urlencode(pairs)
+
+
+def jsonify_rows(data, **kwargs):
+    '''jsonify a data list, remembering its length for the query log'''
+    resp = jsonify(data=data, **kwargs)
+    resp.stats = {"rows": len(data)}
+    return resp
+
+
+def _log_fd(path):
+    '''Descriptor appending to path, reopened after a fork or once the
+    file has been rotated away'''
+    entry = _files.get(path)
+    if entry is not None:
+        pid, fd, inode = entry
+        try:
+            if pid == os.getpid() and os.stat(path).st_ino == inode:
+                return fd
+        except OSError:  # rotated and not recreated yet
+            pass
+        os.close(fd)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _files[path] = (os.getpid(), fd, os.fstat(fd).st_ino)
+    return fd
+
+
+def append_line(path, record, **kwargs):
+    '''Append record to path as one JSON line, in a single write so
+    lines from several processes never interleave'''
+    line = simplejson.dumps(record, separators=(",", ":"), **kwargs) + "\n"
+    try:
+        os.write(_log_fd(path), line.encode("utf-8"))
+    except OSError as err:
+        app.logger.warning("Unable to write %s: %s", path, err)
+
+
+def write(record):
+    append_line(app.config["QUERY_LOG_PATH"], record)
+
+
+def _chunk_size(chunk):
+    if isinstance(chunk, six.text_type):
+        return len(chunk.encode("utf-8"))
+    return len(chunk)
+
+
+def when_sent(resp, finish):
+    '''Call finish with the response size in bytes once the body has been
+    sent: right away for a buffered response, after the last chunk (or
+    the client going away) for a streamed one'''
+    if not resp.is_streamed:
+        finish(len(resp.get_data()))
+        return resp
+
+    body = resp.response
+
+    def counted():
+        size = 0
+        try:
+            for chunk in body:
+                size += _chunk_size(chunk)
+                yield chunk
+        finally:
+            finish(size)
+
+    resp.response = counted()
+    return resp
+
+
+def _finish(record, start, resp, size):
+    stats = getattr(resp, "stats", None) or {}
+    record["ms"] = round(1000 * (time.time() - start), 2)
+    record["rows"] = stats.get("rows")
+    record["bytes"] = size
+    write(record)
+
+
+def capture(func):
+    '''View decorator recording each request when QUERY_LOG_PATH is set'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not app.config["QUERY_LOG_PATH"]:
+            return func(*args, **kwargs)
+        start = time.time()
+        record = {"ts": round(start, 3), "endpoint": request.endpoint,
+                  "path": request.path, "args": normalize_args(request.args)}
+        try:
+            resp = app.make_response(func(*args, **kwargs))
+        except Exception as err:
+            # ServiceException carries status_code, werkzeug's HTTPException code
+            record["status"] = (getattr(err, "status_code", None) or
+                                getattr(err, "code", None) or 500)
+            _finish(record, start, None, 0)
+            raise
+        record["status"] = resp.status_code
+        return when_sent(resp, functools.partial(_finish, record, start, resp))
+    return wrapper
@@ -0,0 +1,188 @@
+'''Opt-in recorder of slow SQL statements
+
+When SLOW_QUERY_LOG is set, every statement taking longer than
+SLOW_QUERY_THRESHOLD seconds, or cancelled by statement_timeout, is appended
+as one JSON line to the log, the same way as the query log: every worker
+writes each line with a single O_APPEND write, and rotation is left to
+logrotate or similar. The line holds the normalized request,
+the SQL with its parameters and a shape id shared by statements that differ
+only in their parameters. A SLOW_QUERY_EXPLAIN_SAMPLE fraction of the slow
+SELECTs is re-run with EXPLAIN (ANALYZE, BUFFERS) by a background thread on
+Postgres, and the plan is logged as a separate line with the same id. The
+slow_queries command summarizes the log by shape.
+'''
+import glob
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+import simplejson
+from flask import has_request_context, request
+from six.moves import queue
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from data_africa import app
+from data_africa.core.querylog import append_line, normalize_args
+
+# runs of numbered bind parameters, as rendered for IN lists
+PARAM_LIST = re.compile(r"\(\s*(?:%\(\w+?_\d+\)s|\?)(?:\s*,\s*(?:%\(\w+?_\d+\)s|\?))*\s*\)")
+PARAM_NUMBER = re.compile(r"%\((\w+?)_\d+\)s")
+
+_state = {"pid": None, "queue": None}
+
+
+def shape(statement):
+    '''Id of a statement with its IN lists and parameter numbering removed'''
+    normalized = PARAM_LIST.sub("(...)", statement)
+    normalized = PARAM_NUMBER.sub(r"%(\1)s", normalized)
+    normalized = " ".join(normalized.split())
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def write(record):
+    append_line(app.config["SLOW_QUERY_LOG"], record, default=str)
+
+
+def _explain_worker(jobs):
+    while True:
+        engine, record_id, statement, parameters = jobs.get()
+        start = time.time()
+        try:
+            conn = engine.raw_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SET LOCAL statement_timeout = %s",
+                               (int(app.config["SLOW_QUERY_EXPLAIN_TIMEOUT"] * 1000),))
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters)
+                plan = cursor.fetchone()[0]
+                cursor.close()
+            finally:
+                conn.rollback()
+                conn.close()
+            write({"id": record_id, "ts": round(start, 3), "shape": shape(statement),
+                   "explain_ms": round(1000 * (time.time() - start), 2), "plan": plan})
+        except Exception as err:
+            write({"id": record_id, "ts": round(start, 3), "shape": shape(statement),
+                   "explain_error": str(err)})
+
+
+def _explain_queue():
+    # the explain thread does not survive a fork
+    if _state["pid"] != os.getpid():
+        _state["queue"] = None
+        _state["pid"] = os.getpid()
+    if _state["queue"] is None:
+        jobs = queue.Queue(maxsize=app.config["SLOW_QUERY_EXPLAIN_QUEUE"])
+        thread = threading.Thread(target=_explain_worker, args=(jobs,))
+        thread.daemon = True
+        thread.start()
+        _state["queue"] = jobs
+    return _state["queue"]
+
+
+def _should_explain(conn, statement):
+    return (conn.engine.dialect.name == "postgresql" and
+            statement.lstrip().upper().startswith("SELECT") and
+            random.random() < app.config["SLOW_QUERY_EXPLAIN_SAMPLE"])
+
+
+def record(conn, statement, parameters, elapsed, error=None):
+    entry = {
+        "id": uuid.uuid4().hex[:12],
+        "ts": round(time.time(), 3),
+        "pid": os.getpid(),
+        "ms": round(1000 * elapsed, 2),
+        "shape": shape(statement),
+        "sql": statement,
+        "params": parameters,
+    }
+    if has_request_context():
+        entry["endpoint"] = request.endpoint
+        entry["request"] = "{}?{}".format(request.path, normalize_args(request.args))
+    if error is not None:
+        entry["error"] = error
+    write(entry)
+    if error is None and _should_explain(conn, statement):
+        try:
+            _explain_queue().put_nowait((conn.engine, entry["id"], statement, parameters))
+        except queue.Full:
+            pass
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    if app.config["SLOW_QUERY_LOG"]:
+        conn.info.setdefault("slowlog_start", []).append(time.time())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("slowlog_start")
+    if not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        record(conn, statement, parameters, elapsed)
+
+
+@event.listens_for(Engine, "handle_error")
+def on_error(context):
+    conn = context.connection
+    starts = conn.info.get("slowlog_start") if conn is not None else None
+    if not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        record(conn, context.statement or "", context.parameters,
+               elapsed, error=type(context.original_exception).__name__)
+
+
+def read(paths):
+    '''Records and plans from the given logs, oldest backups first'''
+    records = {}
+    plans = {}
+    for path in paths:
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    entry = simplejson.loads(line)
+                except ValueError:
+                    continue
+                if "sql" in entry:
+                    records[entry["id"]] = entry
+                else:
+                    plans[entry["id"]] = entry
+    return records, plans
+
+
+def log_paths(path):
+    '''The log and its numbered (uncompressed) rotated backups, oldest first'''
+    backups = [name for name in glob.glob(path + ".*")
+               if name.rsplit(".", 1)[1].isdigit()]
+    backups.sort(key=lambda name: -int(name.rsplit(".", 1)[1]))
+    return [name for name in backups + [path] if os.path.exists(name)]
+
+
+def summarize(records, plans):
+    '''Per shape: count, total and worst time, errors and plans captured,
+    sorted by total time'''
+    shapes = {}
+    for entry in records.values():
+        stats = shapes.setdefault(entry["shape"], {
+            "shape": entry["shape"], "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "errors": 0, "plans": 0, "worst": None, "endpoints": {}})
+        stats["count"] += 1
+        stats["total_ms"] += entry["ms"]
+        stats["errors"] += 1 if entry.get("error") else 0
+        stats["plans"] += 1 if "plan" in plans.get(entry["id"], {}) else 0
+        endpoint = entry.get("endpoint") or "-"
+        stats["endpoints"][endpoint] = stats["endpoints"].get(endpoint, 0) + 1
+        if entry["ms"] >= stats["max_ms"]:
+            stats["max_ms"] = entry["ms"]
+            stats["worst"] = entry
+    return sorted(shapes.values(), key=lambda stats: -stats["total_ms"])
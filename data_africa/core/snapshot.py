@@ -0,0 +1,555 @@
+'''Read-only, memory-mapped snapshots of the registered data tables
+
+A snapshot is a versioned directory of columnar files written by
+build_snapshot. Columns are stored by kind, from their SQL type, with every
+number little-endian:
+
+    int    <col>.dat holds one int64 per row, NULL being -2**63
+    float  <col>.dat holds one float64 per row, NULL being NaN
+    str    <col>.dat holds one uint32 code per row into <col>.dict, the
+           sorted JSON list of distinct values, NULL being 2**32 - 1
+    json   anything else (arrays, booleans): <col>.dat holds one JSON value
+           per row and <col>.idx the uint64 offset of each (plus the end)
+
+For int, float and str columns <col>.ord holds the uint32 ids of the non-NULL
+rows sorted by value, so equality filters are binary searches. Workers map
+the files read-only, so all processes on a host share the values and the
+sorted indexes through the OS page cache, and no database connection is
+needed to answer simple queries. Only the small str dictionaries are
+decoded in each process.
+
+    SNAPSHOT_DIR/
+        CURRENT -> 20170601T120000
+        20170601T120000/
+            manifest.json
+            poverty.survey_ygl/year.dat
+            poverty.survey_ygl/year.ord
+            ...
+
+Switching versions is atomic: a new symlink is renamed over CURRENT and each
+worker notices the change on its next request.
+'''
+import bisect
+import datetime
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+
+import simplejson
+from geoalchemy2 import Geometry
+from sqlalchemy.types import Boolean, Float, Integer, Numeric, String
+
+from data_africa import app
+from data_africa.attrs import consts
+from data_africa.core import derived
+from data_africa.core import lookups
+from data_africa.core.registrar import registered_models
+from data_africa.core.streaming import stream_rows
+from data_africa.database import db
+
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+# bump when the layout of the files changes; older snapshots are not read
+FORMAT = 2
+OFFSET = struct.Struct("<2Q")
+ROW_ID = struct.Struct("<I")
+NULL_INT = -2 ** 63
+NULL_CODE = 2 ** 32 - 1
+# kind: (array typecode, struct of one stored value)
+FIXED = {
+    "int": ("q", struct.Struct("<q")),
+    "float": ("d", struct.Struct("<d")),
+    "str": ("I", struct.Struct("<I")),
+}
+
+_state = {"snapshot": None}
+
+
+class SnapshotMiss(Exception):
+    '''Raised when a request cannot be answered from the snapshot alone'''
+    pass
+
+
+def snapshot_dir():
+    return app.config["SNAPSHOT_DIR"]
+
+
+def snapshot_models():
+    '''All tables exported to a snapshot: the registered data tables plus
+    any attribute table served by the attrs views'''
+    from data_africa.attrs.models import get_mapped_attrs
+    models = list(registered_models)
+    for attr_cls in get_mapped_attrs().values():
+        if attr_cls not in models:
+            models.append(attr_cls)
+    return models
+
+
+def table_columns(tbl):
+    '''Column attributes stored for a table. Only physical columns of the
+    table itself are exported; geometries and derived column_property
+    expressions are left to the database.'''
+    cols = []
+    for prop in tbl.__mapper__.column_attrs:
+        col = prop.columns[0]
+        if getattr(col, "table", None) is not tbl.__table__:
+            continue
+        if isinstance(col.type, Geometry):
+            continue
+        cols.append(prop.key)
+    return cols
+
+
+def column_kind(col):
+    '''How a column is stored, from its SQL type'''
+    if isinstance(col.type, Boolean):
+        return "json"
+    if isinstance(col.type, Integer):
+        return "int"
+    if isinstance(col.type, (Float, Numeric)):
+        return "float"
+    if isinstance(col.type, String):
+        return "str"
+    return "json"
+
+
+def _tofile(arr, path):
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    with open(path, "wb") as handle:
+        arr.tofile(handle)
+
+
+class ColumnWriter(object):
+    '''Collects the values of one column while its table is exported'''
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        if kind == "json":
+            self.handle = open(path + ".dat", "wb")
+            self.offsets = array("Q", [0])
+        else:
+            self.values = array(FIXED[kind][0])
+            self.codes = {}
+
+    def add(self, value):
+        if self.kind == "json":
+            raw = simplejson.dumps(value).encode("utf-8")
+            self.handle.write(raw)
+            self.offsets.append(self.offsets[-1] + len(raw))
+        elif value is None:
+            self.values.append({"int": NULL_INT, "float": float("nan"),
+                                "str": NULL_CODE}[self.kind])
+        elif self.kind == "str":
+            # codes in order of appearance, sorted once all values are known
+            self.values.append(self.codes.setdefault(value, len(self.codes)))
+        else:
+            self.values.append(value)
+
+    def _is_null(self, value):
+        if self.kind == "float":
+            return value != value
+        return value == (NULL_INT if self.kind == "int" else NULL_CODE)
+
+    def close(self):
+        if self.kind == "json":
+            self.handle.close()
+            _tofile(self.offsets, self.path + ".idx")
+            return
+        values = self.values
+        if self.kind == "str":
+            dictionary = sorted(self.codes)
+            remap = array("I", [0] * len(dictionary))
+            for code, value in enumerate(dictionary):
+                remap[self.codes[value]] = code
+            values = array("I", [code if code == NULL_CODE else remap[code]
+                                 for code in values])
+            with open(self.path + ".dict", "w") as handle:
+                simplejson.dump(dictionary, handle)
+        order = array("I", sorted((row for row, value in enumerate(values)
+                                   if not self._is_null(value)),
+                                  key=values.__getitem__))
+        _tofile(values, self.path + ".dat")
+        _tofile(order, self.path + ".ord")
+
+
+def _write_table(path, tbl):
+    os.makedirs(path)
+    names = table_columns(tbl)
+    kinds = [column_kind(tbl.__mapper__.column_attrs[name].columns[0]) for name in names]
+    writers = [ColumnWriter(os.path.join(path, name), kind)
+               for name, kind in zip(names, kinds)]
+    years = set()
+    year_idx = names.index(consts.YEAR) if consts.YEAR in names else None
+
+    qry = db.session.query(*[getattr(tbl, name) for name in names])
+    rows = 0
+    for row in qry.yield_per(5000):
+        for writer, value in zip(writers, row):
+            writer.add(value)
+        if year_idx is not None and row[year_idx] is not None:
+            years.add(row[year_idx])
+        rows += 1
+    for writer in writers:
+        writer.close()
+
+    years = sorted(years)
+    return {
+        "rows": rows,
+        "columns": names,
+        "kinds": dict(zip(names, kinds)),
+        "years_set": years if year_idx is not None else None,
+        "years": {consts.LATEST: years[-1], consts.OLDEST: years[0]}
+                 if years else None,
+    }
+
+
+def build_snapshot(version=None, activate=True):
+    '''Export every registered table into a new snapshot version and
+    optionally make it the current one'''
+    root = snapshot_dir()
+    version = version or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    final_path = os.path.join(root, version)
+    if os.path.exists(final_path):
+        raise ValueError("Snapshot {} already exists".format(version))
+    tmp_path = os.path.join(root, ".tmp-" + version)
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = {"version": version,
+                "format": FORMAT,
+                "created": datetime.datetime.utcnow().isoformat(),
+                "tables": {}}
+    for tbl in snapshot_models():
+        table_path = os.path.join(tmp_path, tbl.__table__.fullname)
+        manifest["tables"][tbl.__table__.fullname] = _write_table(table_path, tbl)
+
+    with open(os.path.join(tmp_path, MANIFEST), "w") as handle:
+        simplejson.dump(manifest, handle)
+    os.rename(tmp_path, final_path)
+
+    if activate:
+        activate_snapshot(version)
+    return manifest
+
+
+def activate_snapshot(version):
+    '''Atomically point CURRENT at the given version'''
+    root = snapshot_dir()
+    if not os.path.isfile(os.path.join(root, version, MANIFEST)):
+        raise ValueError("Snapshot {} does not exist".format(version))
+    tmp_link = os.path.join(root, ".{}.{}".format(CURRENT, os.getpid()))
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version, tmp_link)
+    os.rename(tmp_link, os.path.join(root, CURRENT))
+
+
+def list_snapshots():
+    root = snapshot_dir()
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if os.path.isfile(os.path.join(root, name, MANIFEST)))
+
+
+def prune_snapshots(keep):
+    '''Remove all but the newest keep versions, never touching CURRENT.
+    Workers that still map a removed version keep working since unlinked
+    files stay valid until they are unmapped.'''
+    active = current_version()
+    removed = []
+    for version in list_snapshots()[:-keep or None]:
+        if version != active:
+            shutil.rmtree(os.path.join(snapshot_dir(), version))
+            removed.append(version)
+    return removed
+
+
+def current_version():
+    try:
+        return os.readlink(os.path.join(snapshot_dir(), CURRENT))
+    except OSError:
+        return None
+
+
+def current():
+    '''Return the active snapshot, remapping if CURRENT has moved'''
+    version = current_version()
+    if not version:
+        raise SnapshotMiss("No active snapshot")
+    snap = _state["snapshot"]
+    if snap is None or snap.version != version:
+        snap = Snapshot(os.path.join(snapshot_dir(), version))
+        _state["snapshot"] = snap
+    return snap
+
+
+def _map(path):
+    with open(path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _row_ids(raw):
+    row_ids = array("I")
+    if hasattr(row_ids, "frombytes"):
+        row_ids.frombytes(raw)
+    else:  # Python 2
+        row_ids.fromstring(raw)
+    if sys.byteorder == "big":
+        row_ids.byteswap()
+    return row_ids
+
+
+class SnapshotColumn(object):
+    '''A fixed-width int, float or str column and its sorted row ids'''
+
+    def __init__(self, path, kind):
+        self.kind = kind
+        self._value = FIXED[kind][1]
+        self._data = _map(path + ".dat")
+        self._order = _map(path + ".ord")
+        self.rows = len(self._data) // self._value.size
+        self.dictionary = None
+        if kind == "str":
+            with open(path + ".dict") as handle:
+                self.dictionary = simplejson.load(handle)
+
+    def __len__(self):
+        return self.rows
+
+    def _stored(self, row):
+        return self._value.unpack_from(self._data, row * self._value.size)[0]
+
+    def __getitem__(self, row):
+        value = self._stored(row)
+        if self.kind == "int":
+            return None if value == NULL_INT else value
+        if self.kind == "float":
+            return None if value != value else value
+        return None if value == NULL_CODE else self.dictionary[value]
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield self[row]
+
+    def _target(self, raw):
+        '''The stored value a query string stands for, or None. Numbers
+        compare by value, so 2010 finds rows holding 2010 or 2010.0.'''
+        if self.kind == "str":
+            code = bisect.bisect_left(self.dictionary, raw)
+            if code < len(self.dictionary) and self.dictionary[code] == raw:
+                return code
+            return None
+        try:
+            return float(raw)
+        except ValueError:
+            return None
+
+    def _bisect(self, target, right):
+        lo, hi = 0, len(self._order) // ROW_ID.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._stored(ROW_ID.unpack_from(self._order, mid * ROW_ID.size)[0])
+            if value < target or (right and value == target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows_matching(self, raw):
+        '''Ids of the rows holding the value of query string raw'''
+        target = self._target(raw)
+        if target is None:
+            return array("I")
+        start = self._bisect(target, False) * ROW_ID.size
+        end = self._bisect(target, True) * ROW_ID.size
+        return _row_ids(self._order[start:end])
+
+
+class JSONColumn(object):
+    '''A column of JSON encoded values, which cannot be filtered on'''
+
+    def __init__(self, path):
+        self._data = _map(path + ".dat")
+        self._idx = _map(path + ".idx")
+        self.rows = max(len(self._idx) // 8 - 1, 0)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        start, end = OFFSET.unpack_from(self._idx, row * 8)
+        return simplejson.loads(self._data[start:end].decode("utf-8"))
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield self[row]
+
+    def rows_matching(self, raw):
+        raise SnapshotMiss("JSON columns are not filtered in snapshots")
+
+
+class SnapshotTable(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.rows = meta["rows"]
+        self.column_names = meta["columns"]
+        self.years = meta["years"]
+        self.years_set = meta["years_set"]
+        self.kinds = meta["kinds"]
+        self._columns = {}
+
+    def has_column(self, name):
+        return name in self.column_names
+
+    def column(self, name):
+        if name not in self._columns:
+            if not self.has_column(name):
+                raise SnapshotMiss("Column {} not in snapshot".format(name))
+            path = os.path.join(self.path, name)
+            kind = self.kinds[name]
+            self._columns[name] = JSONColumn(path) if kind == "json" \
+                else SnapshotColumn(path, kind)
+        return self._columns[name]
+
+    def fetch(self, names, row_ids=None):
+        cols = [self.column(name) for name in names]
+        row_ids = range(self.rows) if row_ids is None else row_ids
+        for row in row_ids:
+            yield tuple(col[row] for col in cols)
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as handle:
+            self.manifest = simplejson.load(handle)
+        self.version = self.manifest["version"]
+        self._tables = {}
+
+    def table(self, full_name):
+        if self.manifest.get("format") != FORMAT:
+            raise SnapshotMiss("Snapshot {} has an older format, rebuild it".format(self.version))
+        if full_name not in self._tables:
+            meta = self.manifest["tables"].get(full_name)
+            if meta is None:
+                raise SnapshotMiss("Table {} not in snapshot".format(full_name))
+            self._tables[full_name] = SnapshotTable(
+                os.path.join(self.path, full_name), meta)
+        return self._tables[full_name]
+
+    def years(self):
+        return {name: meta["years"]
+                for name, meta in self.manifest["tables"].items()}
+
+    def years_set(self):
+        return {name: meta["years_set"]
+                for name, meta in self.manifest["tables"].items()}
+
+    def sizes(self):
+        return {name: meta["rows"]
+                for name, meta in self.manifest["tables"].items()}
+
+
+def _matching_rows(snap_tbl, filters):
+    '''Sorted ids of the rows matching every (column, allowed values)
+    filter, or None for no filters'''
+    row_ids = None
+    for name, allowed in filters:
+        column = snap_tbl.column(name)
+        matched = set()
+        for raw in allowed:
+            matched.update(column.rows_matching(raw))
+        row_ids = matched if row_ids is None else row_ids & matched
+    return None if row_ids is None else sorted(row_ids)
+
+
+def _sort_rows(rows, idx, descending):
+    present = [row for row in rows if row[idx] is not None]
+    missing = [row for row in rows if row[idx] is None]
+    present.sort(key=lambda row: row[idx], reverse=descending)
+    return present + missing
+
+
+def join_rows(tables, api_obj):
+    '''Answer a join request from the snapshot. Only single table requests
+    filtered by equality on query variables (including year=latest/oldest)
+    without sumlevel, where, inside or neighbors logic are supported; any
+    other request raises SnapshotMiss so the caller can use the database.'''
+    if len(tables) != 1:
+        raise SnapshotMiss("Multi-table joins are not served from snapshots")
+    table = tables[0]
+    if hasattr(table, "crosswalk"):
+        should_xwalk = not hasattr(table, "crosswalk_cond") or table.crosswalk_cond(api_obj)
+        if should_xwalk:
+            raise SnapshotMiss("Crosswalked queries are not served from snapshots")
+    if api_obj.where or api_obj.inside or api_obj.neighbors or api_obj.display_names:
+        raise SnapshotMiss("Unsupported query arguments")
+    if any(level != consts.ALL for level in api_obj.shows_and_levels.values()):
+        raise SnapshotMiss("Sumlevel filtering is not served from snapshots")
+    if any(derived.is_derived(name) for name in api_obj.vars_needed + [api_obj.order]):
+        raise SnapshotMiss("Derived measures are not served from snapshots")
+
+    snap_tbl = current().table(table.full_name())
+    names = api_obj.output_names(table.dimensions())
+
+    filters = []
+    for col_name, val in api_obj.vars_and_vals.items():
+        if col_name == consts.YEAR and val in [consts.LATEST, consts.OLDEST]:
+            val = str(snap_tbl.years[val])
+        filters.append((col_name, set(val.split(","))))
+
+    # lookup columns are stored as their key column and translated below
+    attrs = [getattr(table, name, None) for name in names]
+    fetch_names = [lookups.key_name(attr) if lookups.lookup_name(attr) else name
+                   for name, attr in zip(names, attrs)]
+    if not all(snap_tbl.has_column(name) for name in fetch_names):
+        raise SnapshotMiss("Unknown field")
+    if api_obj.order:
+        if not snap_tbl.has_column(api_obj.order):
+            raise SnapshotMiss("Order column not in snapshot")
+        if api_obj.order not in fetch_names:
+            fetch_names.append(api_obj.order)
+    rows = list(snap_tbl.fetch(fetch_names, _matching_rows(snap_tbl, filters)))
+    if api_obj.order:
+        rows = _sort_rows(rows, fetch_names.index(api_obj.order),
+                          api_obj.sort == "desc")
+    if len(fetch_names) > len(names):
+        rows = [row[:len(names)] for row in rows]
+
+    start = api_obj.offset or 0
+    stop = start + api_obj.limit if api_obj.limit else None
+    return names, list(lookups.translate(attrs, rows[start:stop]))
+
+
+def serve_join(tables, api_obj, fmt=None):
+    names, rows = join_rows(tables, api_obj)
+    return stream_rows(fmt, tables, names, rows, api_obj)
+
+
+def attr_rows(attr_cls, sumlevels=None):
+    '''Return headers and rows for an attribute table'''
+    snap_tbl = current().table(attr_cls.__table__.fullname)
+    names = list(snap_tbl.column_names)
+    fetch_names = list(names)
+    # lookup columns are not stored, they are translated from their key
+    for prop in attr_cls.__mapper__.column_attrs:
+        attr = getattr(attr_cls, prop.key)
+        if lookups.lookup_name(attr) and prop.key not in names:
+            names.append(prop.key)
+            fetch_names.append(lookups.key_name(attr))
+    row_ids = None
+    if sumlevels is not None:
+        row_ids = _matching_rows(snap_tbl, [("level", set(sumlevels))])
+    attrs = [getattr(attr_cls, name, None) for name in names]
+    return names, list(lookups.translate(attrs, snap_tbl.fetch(fetch_names, row_ids)))
+
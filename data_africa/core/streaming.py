@@ -1,17 +1,39 @@
-'''Module to provide streaming of sqlalchemy queries back to client'''
+'''Module to provide streaming of sqlalchemy queries back to client
+
+A streamed response has already been sent with a 200 when its rows are
+iterated, so stream_rows reads the first row inside the view: the query is
+executed there and a statement timeout still becomes a 504. Only ndjson
+fetches later batches through a server-side cursor; a timeout on one of
+those ends the body with an {"error": ..., "status": 504} line.
+'''
+import itertools
+import zlib
+
 import simplejson
-from flask import Response
+from flask import Response, request, stream_with_context
+from sqlalchemy.exc import OperationalError
+
+from data_africa import app
+from data_africa.core import pool_stats
+from data_africa.core.compact import compact_response
 
 def stream_qry_csv(cols, qry, api_obj):
+    stats = {"rows": 0}
+
     def generate():
         yield ','.join([col if isinstance(col, str) else col.key for col in cols]) + '\n'
         for row in qry:
             row = [u'"{}"'.format(x) if isinstance(x, str) else str(x) for x in list(row)]
+            stats["rows"] += 1
             yield u','.join(row) + u'\n'
-    return Response(generate(), mimetype='text/csv')
+    resp = Response(generate(), mimetype='text/csv')
+    resp.stats = stats
+    return resp
 
 def stream_qry(tables, cols, data, api_obj):
     ''' Based on https://github.com/al4/orlo/blob/1b3930bae4aa37eb51aed33a97c088e576cb5a99/orlo/route_api.py#L285-L311'''
+    stats = {"rows": 0}
+
     def generate(tables):
         headers = [col if not hasattr(col, "key") else col.key for col in cols]
         inf = float('inf')
@@ -45,10 +67,12 @@ def stream_qry(tables, cols, data, api_obj):
         # Iterate over the releases
         for row in rows:
             yield simplejson.dumps([x if x != inf else None for x in prev_row]) + u', '
+            stats["rows"] += 1
             prev_row = row
 
         # Now yield the last iteration without comma
         yield simplejson.dumps([x if x != inf else None for x in prev_row])
+        stats["rows"] += 1
 
         yield u'''], "headers": {},
                  "source": {},
@@ -59,4 +83,88 @@ def stream_qry(tables, cols, data, api_obj):
                    api_obj.limit,
                    simplejson.dumps(api_obj.warnings)) + u'}'
 
-    return Response(generate(tables), content_type='application/json')
+    resp = Response(generate(tables), content_type='application/json')
+    resp.stats = stats
+    return resp
+
+
+def gzip_stream(chunks):
+    '''gzip a stream of text chunks. The compressor is flushed with
+    Z_SYNC_FLUSH every STREAM_FLUSH_BYTES of input, so the client can
+    decompress what it has received so far.'''
+    compressor = zlib.compressobj(app.config["STREAM_GZIP_LEVEL"], zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    pending = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        out = compressor.compress(data)
+        pending += len(data)
+        if pending >= app.config["STREAM_FLUSH_BYTES"]:
+            out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    return "gzip" in request.headers.get("Accept-Encoding", "")
+
+
+def stream_qry_ndjson(tables, cols, data, api_obj):
+    '''Stream a metadata line followed by one JSON array per row'''
+    stats = {"rows": 0}
+    inf = float('inf')
+    headers = [col if not hasattr(col, "key") else col.key for col in cols]
+
+    def generate():
+        yield simplejson.dumps({
+            "headers": headers,
+            "source": [table.info(api_obj) for table in tables],
+            "subs": api_obj.subs,
+            "limit": api_obj.limit,
+            "warnings": api_obj.warnings,
+        }) + u'\n'
+        try:
+            for row in data:
+                stats["rows"] += 1
+                yield simplejson.dumps([x if x != inf else None for x in row]) + u'\n'
+        except OperationalError as err:
+            if not pool_stats.is_statement_timeout(err):
+                raise
+            app.logger.warning("Statement timeout after %s ndjson rows", stats["rows"])
+            yield simplejson.dumps({"error": pool_stats.TIMEOUT_MESSAGE, "status": 504}) + u'\n'
+
+    # the server-side cursor opened by prefetch must outlive the view, so
+    # the session is only removed once the body has been sent
+    body = stream_with_context(generate())
+    if app.config["STREAM_GZIP"] and accepts_gzip():
+        resp = Response(gzip_stream(body), content_type='application/x-ndjson')
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(body, content_type='application/x-ndjson')
+    resp.vary.add("Accept-Encoding")
+    resp.stats = stats
+    return resp
+
+
+def prefetch(data):
+    '''Iterator over data with its first row already fetched'''
+    rows = iter(data)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], rows)
+
+
+def stream_rows(fmt, tables, cols, data, api_obj):
+    '''Stream rows in the requested output format (json, csv, ndjson or compact)'''
+    data = prefetch(data)
+    if fmt == "csv":
+        return stream_qry_csv(cols, data, api_obj)
+    elif fmt == "ndjson":
+        return stream_qry_ndjson(tables, cols, data, api_obj)
+    elif fmt == "compact":
+        return compact_response(tables, cols, data, api_obj)
+    return stream_qry(tables, cols, data, api_obj)
@@ -1,14 +1,18 @@
+import functools
 import operator
 
 from sqlalchemy import distinct, and_
 from sqlalchemy.sql import func
 
 from data_africa.core import get_columns, str_tbl_columns
+from data_africa.core import derived
 from data_africa.core.registrar import registered_models
 from data_africa.core.exceptions import DataAfricaException
 from data_africa.attrs import consts
 
-from data_africa import cache
+from data_africa import app, cache
+from data_africa.core import data_version
+from data_africa.core import snapshot
 
 
 def table_name(tbl):
@@ -16,8 +20,25 @@ def table_name(tbl):
                           tbl.__tablename__)
 
 
-@cache.memoize()
-def tbl_years_set():
+def versioned(func):
+    '''Memoize func(version) in the shared cache. Called without a
+    version, the one this process serves is used, so values computed for
+    one data version are never read for another.'''
+    memoized = cache.memoize()(func)
+
+    @functools.wraps(func)
+    def wrapper(version=None):
+        return memoized(data_version.current() if version is None else version)
+    return wrapper
+
+
+@versioned
+def tbl_years_set(version):
+    if app.config["SNAPSHOT_MODE"]:
+        try:
+            return snapshot.current().years_set()
+        except snapshot.SnapshotMiss:  # none built yet, read the database
+            pass
     years_set = {}
     for tbl in registered_models:
         tbl_name = table_name(tbl)
@@ -30,8 +51,13 @@ def tbl_years_set():
             years_set[tbl_name] = None
     return years_set
 
-@cache.memoize()
-def tbl_years():
+@versioned
+def tbl_years(version):
+    if app.config["SNAPSHOT_MODE"]:
+        try:
+            return snapshot.current().years()
+        except snapshot.SnapshotMiss:  # none built yet, read the database
+            pass
     years = {}
     for tbl in registered_models:
         tbl_name = table_name(tbl)
@@ -52,8 +78,13 @@ def table_exists(full_tblname):
     return full_tblname in tbl_years()
 
 
-@cache.memoize()
-def tbl_sizes():
+@versioned
+def tbl_sizes(version):
+    if app.config["SNAPSHOT_MODE"]:
+        try:
+            return snapshot.current().sizes()
+        except snapshot.SnapshotMiss:  # none built yet, read the database
+            pass
     sizes = {}
     for tbl in registered_models:
         tbl_name = table_name(tbl)
@@ -61,13 +92,61 @@ def tbl_sizes():
     return sizes
 
 
+@versioned
+def tbl_distinct_counts(version):
+    '''Number of distinct values of each key column, used to estimate the
+    selectivity of equality filters'''
+    counts = {}
+    if app.config["SNAPSHOT_MODE"] and snapshot.current_version():
+        return counts
+    for tbl in registered_models:
+        keys = tbl.dimensions()
+        qry = tbl.query.with_entities(
+            *[func.count(distinct(getattr(tbl, key))) for key in keys])
+        counts[table_name(tbl)] = dict(zip(keys, qry.one()))
+    return counts
+
+
+@data_version.on_prepare
+def prepare(version):
+    from data_africa.core import coalesce
+    # one worker per host scans the tables, the others read its results
+    with coalesce.single_flight("table_metadata/{}".format(version)):
+        for compute in [tbl_years_set, tbl_years, tbl_sizes, tbl_distinct_counts]:
+            compute(version)
+
+
+@data_version.on_activate
+def activate(version):
+    TableManager.table_years_set = tbl_years_set(version)
+    TableManager.table_years = tbl_years(version)
+
+
+class OnFirstUse(object):
+    '''Class attribute computed on first access and then stored on the
+    class, so importing the app issues no query'''
+
+    def __init__(self, name, compute):
+        self.name = name
+        self.compute = compute
+
+    def __get__(self, obj, cls):
+        value = self.compute()
+        setattr(cls, self.name, value)
+        return value
+
+
 class TableManager(object):
     possible_variables = list(set([col.key for t in registered_models
                           for col in get_columns(t)]))
-    table_years_set = tbl_years_set()
-    table_years = tbl_years()
+    table_years_set = OnFirstUse("table_years_set", tbl_years_set)
+    table_years = OnFirstUse("table_years", tbl_years)
 
 
+    @classmethod
+    def can_order(cls, name):
+        return name in cls.possible_variables or derived.is_derived(name)
+
     @classmethod
     def table_can_show(cls, table, api_obj):
         shows_and_levels = api_obj.shows_and_levels
@@ -118,8 +197,9 @@ class TableManager(object):
     def required_table_joins(cls, api_obj):
         '''Given a list of X, do Y'''
         vars_needed = api_obj.vars_needed + api_obj.where_vars()
-        if api_obj.order and api_obj.order in cls.possible_variables:
+        if api_obj.order and cls.can_order(api_obj.order):
             vars_needed = vars_needed + [api_obj.order]
+        vars_needed = derived.expand(vars_needed)
         universe = set(vars_needed)
         tables_to_use = []
         table_cols = []
@@ -197,8 +277,9 @@ class TableManager(object):
         vars_needed = api_obj.vars_needed
         candidates = []
         for table in registered_models:
-            if api_obj.order and api_obj.order in cls.possible_variables:
+            if api_obj.order and cls.can_order(api_obj.order):
                 vars_needed = vars_needed + [api_obj.order]
+            vars_needed = derived.expand(vars_needed)
             if TableManager.table_has_cols(table, vars_needed):
                 if TableManager.table_can_show(table, api_obj):
                     candidates.append(table)
@@ -1,13 +1,26 @@
 from flask import Blueprint, request, jsonify
 
+from data_africa import app
+from data_africa.core import admission
+from data_africa.core import coalesce
+from data_africa.core import pool_stats
+from data_africa.core import querylog
+from data_africa.core import snapshot
 from data_africa.core import table_manager
 from data_africa.core import join_api
+from data_africa.core import metadata
+from data_africa.core import metrics
 from data_africa.core.models import ApiObject
-from data_africa.core.exceptions import DataAfricaException
+from data_africa.spatial import locate
+from data_africa.spatial import shapes
+from data_africa.core.exceptions import DataAfricaException, QueryRejectedException
 from data_africa.attrs.consts import ADM0, ADM1
 
 mod = Blueprint('core', __name__, url_prefix='/api')
 
+# join formats written row by row as the query runs
+STREAMED_FORMATS = ("csv", "ndjson")
+
 manager = table_manager.TableManager()
 
 
@@ -28,6 +41,8 @@ def build_api_obj(default_limit=None):
     limit = request.args.get("limit", default_limit)
     offset = request.args.get("offset", None)
     exclude = request.args.get("exclude", None)
+    fields = request.args.get("fields", None)
+    layout = request.args.get("layout", None)
     inside = request.args.get("inside", None)
     neighbors = request.args.get("neighbors", None)
     if neighbors:
@@ -50,10 +65,13 @@ def build_api_obj(default_limit=None):
     vars_and_vals = {k: v for k, v in vars_and_vals.items() if v}
 
     vars_needed = list(vars_and_vals.keys()) + shows + values
+    if fields:
+        vars_needed += [name for name in fields.split(",") if name not in vars_needed]
     api_obj = ApiObject(vars_needed=vars_needed, vars_and_vals=vars_and_vals,
                         shows_and_levels=shows_and_levels, values=values,
                         where=where, force=force, order=order,
-                        sort=sort, limit=limit, exclude=exclude,
+                        sort=sort, limit=limit, exclude=exclude, fields=fields,
+                        layout=layout,
                         auto_crosswalk=auto_crosswalk,
                         display_names=display_names,
                         offset=offset, inside=inside, neighbors=neighbors)
@@ -68,17 +86,73 @@ def api_view(csv=None):
 
 
 @mod.route("/join/")
-@mod.route("/join/csv/", defaults={'csv': True})
-def api_join_view(csv=None):
+@mod.route("/join/csv/", defaults={'fmt': 'csv'})
+@mod.route("/join/ndjson/", defaults={'fmt': 'ndjson'})
+@mod.route("/join/compact/", defaults={'fmt': 'compact'})
+@querylog.capture
+def api_join_view(fmt=None):
+    # rendered incrementally, so never buffered to be shared
+    if fmt in STREAMED_FORMATS:
+        return join_response(fmt)
+    return coalesced_join_response(fmt)
+
+
+@coalesce.coalesce
+def coalesced_join_response(fmt=None):
+    return join_response(fmt)
+
+
+def join_response(fmt=None):
     api_obj = build_api_obj(default_limit=10000)
-    if api_obj.limit and api_obj.limit > 80000:
-        raise DataAfricaException("Limit parameter must be less than 80,000")
+    admission.check_limit(api_obj)
     tables, joins = manager.required_table_joins(api_obj)
+    metrics.label(tables=tables, fmt=fmt or "json")
+    if app.config["SNAPSHOT_MODE"]:
+        try:
+            return snapshot.serve_join(tables, api_obj, fmt=fmt)
+        except snapshot.SnapshotMiss:
+            pass
     data = join_api.joinable_query(tables, joins, api_obj, manager.table_years,
-                                   csv_format=csv)
+                                   fmt=fmt)
     return data
 
 
+@mod.route("/shapes/<layer>/")
+@querylog.capture
+def shapes_view(layer):
+    '''Precomputed TopoJSON of a layer, with the rows of a join query
+    attached when join arguments are given'''
+    layer = shapes.get_layer(layer)
+    level = request.args.get("level", app.config["SHAPES_DEFAULT_LEVEL"])
+    if not request.args.get("show"):
+        return shapes.topology_response(layer, level)
+
+    shapes.level_entry(layer, level)
+    api_obj = build_api_obj(default_limit=10000)
+    if layer.key not in api_obj.shows_and_levels:
+        raise QueryRejectedException("Join data for {} shapes must show {}".format(
+            layer.name, layer.key))
+    admission.check_limit(api_obj)
+    tables, joins = manager.required_table_joins(api_obj)
+    metrics.label(tables=tables, fmt="topojson")
+    data = join_api.joinable_query(tables, joins, api_obj, manager.table_years)
+    return shapes.joined_response(layer, level, data)
+
+
+@mod.route("/locate/", methods=["GET", "POST"])
+@querylog.capture
+def locate_view():
+    '''Geo, poverty and DHS ids containing the points given as lat/lon,
+    points=lat,lon;lat,lon or a POSTed {"points": [[lat, lon], ...]}'''
+    if request.method == "POST":
+        points = locate.parse_body(request.get_json(silent=True))
+    elif request.args.get("points"):
+        points = locate.parse_points(request.args["points"])
+    else:
+        points = [locate.parse_point(request.args.get("lat"), request.args.get("lon"))]
+    return querylog.jsonify_rows(locate.locate_all(points))
+
+
 @mod.route("/logic/")
 def logic_view():
     api_obj = build_api_obj()
@@ -91,60 +165,40 @@ def view_variables():
     '''show available data tables and contained variables'''
     shows = request.args.get("show", "").split(",")
     sumlevels = request.args.get("sumlevel", "").split(",")
-    list_all = sumlevels == [""] and shows == [""]
-    if sumlevels == [""]:
-        sumlevels = ["all"] * len(shows)
-    combos = zip(shows, sumlevels)
-    results = {}
-    for show, sumlevel in combos:
-        for table in table_manager.registered_models:
-            if list_all or all([table.can_show(show, sumlevel)]):
-                results[table.full_name()] = table.col_strs(short_name=True)
-    return jsonify(metadata=results)
+    return metadata.variables(shows, sumlevels).response()
 
 
 @mod.route('/table/variables/')
 def all_table_vars():
     '''show all available data tables and contained variables'''
-    results = {table.full_name(): table.col_strs(short_name=True)
-               for table in table_manager.registered_models}
-    return jsonify(metadata=results)
+    return metadata.table_variables().response()
 
 
 @mod.route("/geo/variables/")
 def geo_variables():
     '''show available data tables and contained variables'''
-    geo_data = {}
-    for table in table_manager.registered_models:
-        if table.get_schema_name() == 'spatial':
-            continue
-        if table.can_show("geo", "adm0"):
-            levels = table.get_supported_levels()
-            if 'year' not in levels:
-                levels['year'] = ['all']
+    return metadata.geo_variables().response()
 
-            for col in table.measures(short_name=True):
-                if col in ['year', 'start_year']: continue
-                obj = {}
-                obj["column"] = col
-                obj["levels"] = [levels]
 
-                if col in geo_data:
-                    geo_data[col]["levels"] += [levels]
-                else:
-                    geo_data[col] = obj
+@mod.route("/years/")
+def years_view():
+    return metadata.years(manager.table_years_set).response()
 
 
-    return jsonify(metadata=[res for res in geo_data.values()])
+@mod.route("/stats/pool/")
+def pool_stats_view():
+    from data_africa.database import db
+    return jsonify(data=pool_stats.snapshot(db.engine.pool))
 
 
-@mod.route("/years/")
-def years_view():
-    years_data = manager.table_years_set
-    return jsonify(data=years_data)
+@mod.route("/stats/coalesce/")
+def coalesce_stats_view():
+    return jsonify(data=coalesce.snapshot())
 
 
 @mod.route("/poverty/")
+@querylog.capture
+@coalesce.coalesce
 def pov_map_qry():
     from data_africa.database import db
     import sqlalchemy
@@ -178,10 +232,12 @@ def pov_map_qry():
             'ZMB')""".format(adm0_parta, adm0_partb, lvl_filt, poverty_level)
     results = db.engine.execute(sqlalchemy.text(sql), poverty_level=poverty_level)
     data = [(dict(row.items())) for row in results]
-    return jsonify(data=data)
+    return querylog.jsonify_rows(data)
 
 
 @mod.route("/health/")
+@querylog.capture
+@coalesce.coalesce
 def dhs_map_qry():
     from data_africa.database import db
     import sqlalchemy
@@ -218,10 +274,12 @@ def dhs_map_qry():
             'KE')""".format(adm0_parta, adm0_partb, lvl_filt)
     results = db.engine.execute(sqlalchemy.text(sql), severity=severity, condition=condition)
     data = [(dict(row.items())) for row in results]
-    return jsonify(data=data)
+    return querylog.jsonify_rows(data)
 
 
 @mod.route("/harvested_area/")
+@querylog.capture
+@coalesce.coalesce
 def ha_qry():
     from data_africa.database import db
     import sqlalchemy
@@ -248,10 +306,12 @@ def ha_qry():
                 'ZMB')""".format(lvl_filt)
     results = db.engine.execute(sqlalchemy.text(sql))
     data = [(dict(row.items())) for row in results]
-    return jsonify(data=data)
+    return querylog.jsonify_rows(data)
 
 
 @mod.route("/production_value/")
+@querylog.capture
+@coalesce.coalesce
 def val_qry():
     from data_africa.database import db
     import sqlalchemy
@@ -278,4 +338,4 @@ def val_qry():
                 'ZMB')""".format(lvl_filt)
     results = db.engine.execute(sqlalchemy.text(sql))
     data = [(dict(row.items())) for row in results]
-    return jsonify(data=data)
+    return querylog.jsonify_rows(data)
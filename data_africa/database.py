@@ -1,3 +1,14 @@
 from data_africa import app
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy(app)
+
+from data_africa.core.pool_stats import InstrumentedQueuePool
+
+
+class DataAfricaSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        super(DataAfricaSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith("postgres"):
+            options["poolclass"] = InstrumentedQueuePool
+
+
+db = DataAfricaSQLAlchemy(app)
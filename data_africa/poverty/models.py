@@ -5,11 +5,11 @@ from data_africa.attrs.consts import LATEST_BY_GEO, GENDER, RESIDENCE
 from data_africa.attrs.consts import POVERTY_LEVEL, MALE, FEMALE
 from data_africa.attrs.consts import PPP1, PPP2, URBAN, RURAL
 from data_africa.spatial.models import PovertyXWalk
-from data_africa.attrs.models import Geo
+from data_africa.core.lookups import lookup_property
 from sqlalchemy.orm import column_property
 
-from sqlalchemy import tuple_, select
-from sqlalchemy import or_, and_
+from sqlalchemy import tuple_
+from sqlalchemy import or_
 from sqlalchemy.sql import func
 
 FOCUS_PG = [
@@ -100,10 +100,7 @@ class Survey_Yg(BasePoverty):
     geo = column_property(PovertyXWalk.geo)
     gini = db.Column(db.Float)
     totpop = db.Column(db.Float)
-    url_name = column_property(
-        select([Geo.url_name])
-        .where(and_(poverty_geo == PovertyXWalk.poverty_geo, Geo.id == PovertyXWalk.geo)).limit(1)
-    )
+    url_name = lookup_property("poverty_url_name", poverty_geo)
 
 class Survey_Ygl(BasePoverty, PovertyValues):
     __tablename__ = "survey_ygl"
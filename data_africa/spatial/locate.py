@@ -0,0 +1,202 @@
+'''Resolve coordinates to the geo ids containing them
+
+The Cell5M and DHS polygons are read from PostGIS once per process and
+registered in a uniform grid of LOCATE_GRID_SIZE degree cells: every
+polygon is listed in each cell its bounding box overlaps. A point only
+tests the polygons listed in its own cell, first against their bounding
+box, then with an even-odd ray cast over the polygon's edges in the
+point's latitude band (holes included).
+
+Poverty geographies have no polygons of their own. They are taken from the
+poverty crosswalk: for every geo found, the poverty_geo of each level with
+the largest overlap. Like the lookups, the index is kept per data version:
+once built, it is rebuilt in the background for a new version.
+'''
+import math
+import threading
+
+from data_africa import app
+from data_africa.attrs import consts
+from data_africa.core import data_version
+from data_africa.core.exceptions import QueryRejectedException
+from data_africa.database import db
+from data_africa.spatial import shapes
+from data_africa.spatial.models import PovertyXWalk
+from data_africa.spatial.topojson import geometry_polygons
+
+# geo id prefix to level name
+LEVELS = {"040": consts.ADM0, "050": consts.ADM1}
+
+_state = {"indexes": {}}
+_lock = threading.Lock()
+
+
+class Shape(object):
+    '''A polygon or multipolygon with its edges bucketed by latitude band.
+    A horizontal ray only crosses edges spanning its latitude, so a point
+    tests the edges of its own band rather than every edge.'''
+    __slots__ = ("key", "bbox", "bands", "band_size")
+
+    def __init__(self, key, geometry, band_size):
+        self.key = key
+        self.band_size = float(band_size)
+        self.bands = {}
+        xs = []
+        ys = []
+        for polygon in geometry_polygons(geometry):
+            for ring in polygon:
+                for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                    xs.append(x1)
+                    ys.append(y1)
+                    if y1 == y2:
+                        continue
+                    for band in range(self._band(min(y1, y2)), self._band(max(y1, y2)) + 1):
+                        self.bands.setdefault(band, []).append((x1, y1, x2, y2))
+        self.bbox = (min(xs), min(ys), max(xs), max(ys)) if xs else None
+
+    def _band(self, lat):
+        return int(math.floor(lat / self.band_size))
+
+    def contains(self, lon, lat):
+        x0, y0, x1, y1 = self.bbox
+        if lon < x0 or lon > x1 or lat < y0 or lat > y1:
+            return False
+        # even-odd rule over every ring: holes and extra polygons included
+        inside = False
+        for ex1, ey1, ex2, ey2 in self.bands.get(self._band(lat), ()):
+            if (ey1 > lat) != (ey2 > lat) and lon < (ex2 - ex1) * (lat - ey1) / (ey2 - ey1) + ex1:
+                inside = not inside
+        return inside
+
+
+class GridIndex(object):
+    '''Shapes bucketed by the grid cells their bounding box overlaps'''
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.shapes = []
+
+    def _cell(self, lon, lat):
+        return (int(math.floor(lon / self.cell_size)), int(math.floor(lat / self.cell_size)))
+
+    def insert(self, shape):
+        if shape.bbox is None:
+            return
+        x0, y0, x1, y1 = shape.bbox
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                self.cells.setdefault((cx, cy), []).append(shape)
+        self.shapes.append(shape)
+
+    def candidates(self, lon, lat):
+        return self.cells.get(self._cell(lon, lat), ())
+
+    def query(self, lon, lat):
+        '''Keys of the shapes containing the point'''
+        return [shape.key for shape in self.candidates(lon, lat)
+                if shape.contains(lon, lat)]
+
+
+def _poverty_geos():
+    '''{(geo, poverty level): poverty_geo} keeping the largest overlap'''
+    qry = db.session.query(PovertyXWalk.geo, PovertyXWalk.poverty_geo) \
+        .order_by(PovertyXWalk.pct_overlap.asc().nullsfirst())
+    return {(geo, LEVELS.get(poverty_geo[:3], poverty_geo[:3])): poverty_geo
+            for geo, poverty_geo in qry}
+
+
+class Locator(object):
+    def __init__(self):
+        cell_size = app.config["LOCATE_GRID_SIZE"]
+        self.indexes = {}
+        for layer in shapes.LAYERS.values():
+            index = GridIndex(cell_size)
+            for key, geometry in shapes.fetch(layer):
+                index.insert(Shape(key, geometry, cell_size))
+            self.indexes[layer.key] = index
+        self.poverty_geos = _poverty_geos()
+
+    def locate(self, lat, lon):
+        geos = {}
+        for geo in self.indexes["geo"].query(lon, lat):
+            geos[LEVELS.get(geo[:3], geo[:3])] = geo
+        poverty_geos = {}
+        for geo in geos.values():
+            for level in LEVELS.values():
+                poverty_geo = self.poverty_geos.get((geo, level))
+                if poverty_geo and level not in poverty_geos:
+                    poverty_geos[level] = poverty_geo
+        # newest survey first
+        dhs_geos = sorted(self.indexes["dhs_geo"].query(lon, lat),
+                          key=lambda key: key[-4:], reverse=True)
+        return {"lat": lat, "lon": lon, "geo": geos,
+                "poverty_geo": poverty_geos, "dhs_geo": dhs_geos}
+
+
+def index():
+    '''The process-wide locator of the current data version'''
+    version = data_version.current()
+    if version not in _state["indexes"]:
+        with _lock:
+            if version not in _state["indexes"]:
+                _state["indexes"][version] = Locator()
+    return _state["indexes"][version]
+
+
+@data_version.on_prepare
+def prepare(version):
+    # only processes that use the index build one
+    if _state["indexes"]:
+        _state["indexes"][version] = Locator()
+
+
+@data_version.on_activate
+def activate(version):
+    _state["indexes"] = {key: locator for key, locator in _state["indexes"].items()
+                         if key == version}
+
+
+def parse_point(lat, lon):
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise QueryRejectedException("Invalid coordinates {},{}".format(lat, lon))
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        raise QueryRejectedException("Coordinates out of range {},{}".format(lat, lon))
+    return lat, lon
+
+
+def parse_points(raw):
+    '''Points from "lat,lon;lat,lon;..."'''
+    points = []
+    for pair in raw.split(";"):
+        if pair:
+            parts = pair.split(",")
+            if len(parts) != 2:
+                raise QueryRejectedException("Invalid point {}".format(pair))
+            points.append(parse_point(*parts))
+    return points
+
+
+def parse_body(body):
+    '''Points from a POSTed {"points": [[lat, lon], ...]}, rejecting any
+    malformed point so results line up with the input'''
+    if not isinstance(body, dict) or not isinstance(body.get("points", []), list):
+        raise QueryRejectedException('Expected a JSON body {"points": [[lat, lon], ...]}')
+    points = []
+    for point in body.get("points", []):
+        if not isinstance(point, (list, tuple)) or len(point) != 2:
+            raise QueryRejectedException("Invalid point {}".format(point))
+        points.append(parse_point(*point))
+    return points
+
+
+def locate_all(points):
+    if len(points) > app.config["LOCATE_MAX_POINTS"]:
+        raise QueryRejectedException("At most {} points per request".format(
+            app.config["LOCATE_MAX_POINTS"]))
+    locator = index()
+    return [locator.locate(lat, lon) for lat, lon in points]
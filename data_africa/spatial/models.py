@@ -3,6 +3,7 @@ from data_africa.core.models import BaseModel
 from data_africa.attrs.consts import ALL, ADM0, ADM1
 from data_africa.attrs.models import Geo, PovertyGeo, DHSGeo
 from geoalchemy2 import Geometry
+from sqlalchemy import Integer, String, cast, func
 from sqlalchemy.ext.hybrid import hybrid_property
 
 class BaseSpatial(db.Model, BaseModel):
@@ -19,6 +20,10 @@ class BaseXWalk(BaseSpatial):
     st_area = db.Column(db.Float())
     pct_overlap = db.Column(db.Float())
 
+    @staticmethod
+    def is_crosswalk():
+        return True
+
 
 class PovertyXWalk(BaseXWalk):
     __tablename__ = "pov_xwalk2"
@@ -69,3 +74,9 @@ class DHSGeo(BaseSpatial):
     @hybrid_property
     def dhs_geo(self):
         return "050HG" + self.iso + str(int(self.regcd)).zfill(3) + str(self.svyyr)
+
+    @dhs_geo.expression
+    def dhs_geo(cls):
+        return func.concat("050HG", cls.iso,
+                           func.lpad(cast(cast(cls.regcd, Integer), String), 3, "0"),
+                           cast(cls.svyyr, String))
@@ -0,0 +1,196 @@
+'''Precomputed, pre-gzipped TopoJSON of the Cell5M and DHS geometries
+
+build_shapes reads every polygon of a layer from PostGIS once, builds a
+quantized topology and writes one gzipped TopoJSON file per simplification
+level in SHAPES_LEVELS. Geometries are keyed by the id used in join
+queries (geo for Cell5M, dhs_geo for DHS regions), so data from a join can
+be matched to shapes on the client.
+
+    SHAPES_DIR/
+        cell5m/
+            manifest.json
+            high.3f2a9c0d41b7.topojson.gz
+            medium.9b1e77a0c2d4.topojson.gz
+            ...
+
+File names carry the hash of their content and the manifest is replaced
+last, so a rebuild never changes a file a worker may be reading.
+'''
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import zlib
+
+import simplejson
+from flask import Response, request
+from sqlalchemy import func
+
+from data_africa import app
+from data_africa.core.exceptions import NotFoundException
+from data_africa.core.streaming import accepts_gzip, gzip_stream
+from data_africa.database import db
+from data_africa.spatial.models import Cell5M, DHSGeo
+from data_africa.spatial.topojson import Topology
+
+MANIFEST = "manifest.json"
+
+_state = {"manifests": {}}
+
+
+class Layer(object):
+    '''A geometry table served as shapes, keyed by a join variable'''
+
+    def __init__(self, name, model, key):
+        self.name = name
+        self.model = model
+        self.key = key
+
+    def key_column(self):
+        return getattr(self.model, self.key)
+
+
+LAYERS = {
+    "cell5m": Layer("cell5m", Cell5M, "geo"),
+    "dhs": Layer("dhs", DHSGeo, "dhs_geo"),
+}
+
+
+def get_layer(name):
+    if name not in LAYERS:
+        raise NotFoundException("Unknown shape layer {}, expected one of {}".format(
+            name, ", ".join(sorted(LAYERS))))
+    return LAYERS[name]
+
+
+def layer_dir(layer):
+    return os.path.join(app.config["SHAPES_DIR"], layer.name)
+
+
+def fetch(layer):
+    '''(key, GeoJSON geometry) of every shape in the layer'''
+    model = layer.model
+    qry = db.session.query(layer.key_column(),
+                           func.ST_AsGeoJSON(model.geom, app.config["SHAPES_PRECISION"]))
+    qry = qry.filter(model.geom.isnot(None))
+    return [(key, simplejson.loads(geojson)) for key, geojson in qry.yield_per(5000)]
+
+
+def _write_gzip(path, body):
+    buf = io.BytesIO()
+    # mtime=0 so identical content gives identical files
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as handle:
+        handle.write(body)
+    tmp_path = "{}.{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as handle:
+        handle.write(buf.getvalue())
+    os.rename(tmp_path, path)
+    return len(buf.getvalue())
+
+
+def build_layer(layer):
+    '''Write every level of a layer and switch the manifest to them'''
+    shapes = fetch(layer)
+    topology = Topology(shapes, app.config["SHAPES_QUANTIZATION"])
+    path = layer_dir(layer)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    manifest = {"layer": layer.name,
+                "key": layer.key,
+                "created": datetime.datetime.utcnow().isoformat(),
+                "shapes": len(shapes),
+                "arcs": len(topology.arcs),
+                "levels": {}}
+    for level, tolerance in sorted(app.config["SHAPES_LEVELS"].items()):
+        body = simplejson.dumps(topology.encode(layer.name, tolerance),
+                                separators=(",", ":")).encode("utf-8")
+        etag = hashlib.md5(body).hexdigest()[:12]
+        filename = "{}.{}.topojson.gz".format(level, etag)
+        size = _write_gzip(os.path.join(path, filename), body)
+        manifest["levels"][level] = {"file": filename, "etag": etag,
+                                     "tolerance": tolerance,
+                                     "bytes": len(body), "gzip_bytes": size}
+
+    tmp_path = os.path.join(path, "{}.{}".format(MANIFEST, os.getpid()))
+    with open(tmp_path, "w") as handle:
+        simplejson.dump(manifest, handle, indent=2, sort_keys=True)
+    os.rename(tmp_path, os.path.join(path, MANIFEST))
+
+    current = set(entry["file"] for entry in manifest["levels"].values())
+    for name in os.listdir(path):
+        if name.endswith(".topojson.gz") and name not in current:
+            os.remove(os.path.join(path, name))
+    return manifest
+
+
+def manifest(layer):
+    '''The layer's manifest, re-read when the file changes'''
+    path = os.path.join(layer_dir(layer), MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        raise NotFoundException("Shapes for {} have not been built".format(layer.name))
+    cached = _state["manifests"].get(layer.name)
+    if cached is None or cached[0] != mtime:
+        with open(path) as handle:
+            cached = (mtime, simplejson.load(handle))
+        _state["manifests"][layer.name] = cached
+    return cached[1]
+
+
+def level_entry(layer, level):
+    levels = manifest(layer)["levels"]
+    if level not in levels:
+        raise NotFoundException("Unknown level {}, expected one of {}".format(
+            level, ", ".join(sorted(levels))))
+    return levels[level]
+
+
+def _read(layer, entry):
+    with open(os.path.join(layer_dir(layer), entry["file"]), "rb") as handle:
+        return handle.read()
+
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def topology_response(layer, level):
+    '''The stored file as is when the client accepts gzip'''
+    entry = level_entry(layer, level)
+    data = _read(layer, entry)
+    gzipped = accepts_gzip()
+    resp = Response(data if gzipped else _gunzip(data), mimetype="application/json")
+    if gzipped:
+        resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(entry["etag"] + ("-gzip" if gzipped else ""))
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config["SHAPES_MAX_AGE"]
+    return resp.make_conditional(request)
+
+
+def joined_response(layer, level, join_resp):
+    '''Stream {"topology": ..., "join": ...} with the join response's body'''
+    topology = _gunzip(_read(layer, level_entry(layer, level))).decode("utf-8")
+
+    def generate():
+        yield u'{"topology":'
+        yield topology
+        yield u',"join":'
+        for chunk in join_resp.response:
+            yield chunk if not isinstance(chunk, bytes) else chunk.decode("utf-8")
+        yield u'}'
+
+    if app.config["STREAM_GZIP"] and accepts_gzip():
+        resp = Response(gzip_stream(generate()), content_type="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(generate(), content_type="application/json")
+    resp.vary.add("Accept-Encoding")
+    resp.stats = getattr(join_resp, "stats", None)
+    # releases the join's admission slot once streamed
+    resp.call_on_close(join_resp.close)
+    return resp
@@ -0,0 +1,183 @@
+'''Quantized TopoJSON built from GeoJSON polygons
+
+Coordinates are snapped to a QUANTIZATION x QUANTIZATION integer grid over
+the bounding box of all shapes, so corners shared by neighbouring shapes
+become identical points. Rings are then cut into arcs wherever a point is
+shared with differing neighbours, and every arc is stored once however many
+rings use it. Simplification runs per arc with fixed end points, so borders
+shared by two shapes stay shared at every level.
+'''
+import math
+
+
+class Topology(object):
+    '''Arcs and per-shape rings of arc indexes, in quantized coordinates'''
+
+    def __init__(self, shapes, quantization):
+        '''shapes is a list of (key, GeoJSON geometry) pairs of Polygons or
+        MultiPolygons'''
+        self.quantization = int(quantization)
+        self.bbox = _bbox(shapes)
+        x0, y0, x1, y1 = self.bbox
+        self.scale = ((x1 - x0) / (self.quantization - 1) or 1.0,
+                      (y1 - y0) / (self.quantization - 1) or 1.0)
+        self.translate = (x0, y0)
+
+        quantized = [(key, self._polygons(geometry)) for key, geometry in shapes]
+        junctions = _junctions(ring for _, polygons in quantized
+                               for polygon in polygons for ring in polygon)
+        self.arcs = []
+        self._index = {}
+        self.shapes = [(key, [[self._cut(ring, junctions) for ring in polygon]
+                              for polygon in polygons])
+                       for key, polygons in quantized]
+
+    def _polygons(self, geometry):
+        '''Quantized polygons of a geometry, without collapsed rings and
+        without polygons whose exterior collapsed'''
+        polygons = []
+        for polygon in geometry_polygons(geometry):
+            rings = [self._ring(ring) for ring in polygon]
+            if rings and rings[0]:
+                polygons.append([ring for ring in rings if ring])
+        return polygons
+
+    def _ring(self, ring):
+        '''Quantize a closed ring, dropping repeated points. Rings that
+        collapse to fewer than three distinct points are dropped.'''
+        kx, ky = self.scale
+        x0, y0 = self.translate
+        points = []
+        for x, y in ring[:-1] if ring and ring[0] == ring[-1] else ring:
+            point = (int(round((x - x0) / kx)), int(round((y - y0) / ky)))
+            if not points or points[-1] != point:
+                points.append(point)
+        while len(points) > 1 and points[-1] == points[0]:
+            points.pop()
+        return points if len(points) >= 3 else []
+
+    def _arc_id(self, arc):
+        key = tuple(arc)
+        idx = self._index.get(key)
+        if idx is not None:
+            return idx
+        idx = self._index.get(key[::-1])
+        if idx is not None:
+            return ~idx
+        self._index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return len(self.arcs) - 1
+
+    def _cut(self, ring, junctions):
+        '''Arc indexes of a ring (given without its closing point)'''
+        cuts = [idx for idx, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # a ring shared only as a whole: start at its smallest point
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            return [self._arc_id(ring + [ring[0]])]
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        closed = ring + [ring[0]]
+        cuts = [idx - cuts[0] for idx in cuts] + [len(ring)]
+        return [self._arc_id(closed[start:stop + 1])
+                for start, stop in zip(cuts, cuts[1:])]
+
+    def encode(self, name, tolerance=0.0):
+        '''TopoJSON document with one GeometryCollection called name, arcs
+        simplified by tolerance (in input units) and delta-encoded'''
+        limit = tolerance / min(self.scale) if tolerance else 0
+        arcs = []
+        for arc in self.arcs:
+            points = simplify(arc, limit) if limit else arc
+            encoded = [list(points[0])]
+            for prev, point in zip(points, points[1:]):
+                encoded.append([point[0] - prev[0], point[1] - prev[1]])
+            arcs.append(encoded)
+
+        geometries = []
+        for key, polygons in self.shapes:
+            if not polygons:
+                continue
+            if len(polygons) == 1:
+                geometries.append({"type": "Polygon", "id": key, "arcs": polygons[0]})
+            else:
+                geometries.append({"type": "MultiPolygon", "id": key, "arcs": polygons})
+        return {
+            "type": "Topology",
+            "bbox": list(self.bbox),
+            "transform": {"scale": list(self.scale), "translate": list(self.translate)},
+            "objects": {name: {"type": "GeometryCollection", "geometries": geometries}},
+            "arcs": arcs,
+        }
+
+
+def geometry_polygons(geometry):
+    '''Coordinates of a Polygon or MultiPolygon as a list of polygons'''
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+
+def _bbox(shapes):
+    xs = []
+    ys = []
+    for _, geometry in shapes:
+        for polygon in geometry_polygons(geometry):
+            for ring in polygon:
+                for x, y in ring:
+                    xs.append(x)
+                    ys.append(y)
+    if not xs:
+        return (0.0, 0.0, 0.0, 0.0)
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _junctions(rings):
+    '''Points that have different neighbours in different rings'''
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        count = len(ring)
+        for idx, point in enumerate(ring):
+            pair = frozenset([ring[idx - 1], ring[(idx + 1) % count]])
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+def _distance(point, start, end):
+    '''Distance from point to the line through start and end'''
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    if not dx and not dy:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    return abs(dy * point[0] - dx * point[1] + end[0] * start[1] - end[1] * start[0]) / \
+        math.hypot(dx, dy)
+
+
+def simplify(points, tolerance):
+    '''Douglas-Peucker simplification keeping both end points. A closed arc
+    that would keep fewer than four points is returned unchanged.'''
+    if len(points) <= 2:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        worst, worst_idx = -1.0, None
+        for idx in range(first + 1, last):
+            dist = _distance(points[idx], points[first], points[last])
+            if dist > worst:
+                worst, worst_idx = dist, idx
+        if worst_idx is not None and (worst > tolerance or points[first] == points[last]):
+            keep[worst_idx] = True
+            stack.append((first, worst_idx))
+            stack.append((worst_idx, last))
+    result = [point for point, kept in zip(points, keep) if kept]
+    if points[0] == points[-1] and len(result) < 4:
+        return points
+    return result
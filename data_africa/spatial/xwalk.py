@@ -0,0 +1,244 @@
+'''Offline rebuild of the poverty and DHS crosswalks from their geometries
+
+For every region of a source layer (DHS regions, and poverty regions when
+XWALK_POVERTY_GEOMETRY names their table) the crosswalk holds each Cell5M
+geo of the same level it intersects: st_area is the area of the
+intersection in square metres and pct_overlap the share of the geo's area
+it covers, in percent.
+
+The work is split by country. A fingerprint of a country's source
+geometries and of the Cell5M geometries is kept in spatial.xwalk_state, and
+only countries whose fingerprint changed are recomputed. Intersections are
+computed by PostGIS, one country per task on a pool of worker processes;
+the parent replaces each country's rows in one transaction, loading them
+with COPY. Rows of regions that no longer exist are deleted, at the levels
+the source has polygons for.
+'''
+import datetime
+import hashlib
+import multiprocessing
+import time
+
+from geoalchemy2 import Geometry
+from sqlalchemy import (Column, DateTime, Float, Integer, MetaData, String, Table,
+                        func, literal_column, select)
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from data_africa import app
+from data_africa.database import db
+from data_africa.spatial.models import Cell5M, DHSGeo, DHSXWalk, PovertyXWalk
+from data_africa.util import bulk
+
+# bump when the way rows are computed changes, to recompute every country
+ALGORITHM = "1"
+
+state_table = Table(
+    "xwalk_state", MetaData(),
+    Column("xwalk", String, primary_key=True),
+    Column("country", String, primary_key=True),
+    Column("fingerprint", String),
+    Column("rows", Integer),
+    Column("seconds", Float),
+    Column("built", DateTime),
+    schema="spatial")
+
+
+class Source(object):
+    '''Region geometries crosswalked to Cell5M geos, split by country'''
+
+    def __init__(self, name, xwalk, key_name, key, country, geom, check_group):
+        self.name = name
+        self.xwalk = xwalk
+        self.key_name = key_name
+        self.key = key
+        self.country = country
+        self.geom = geom
+        # regions expected not to overlap each other, e.g. one survey year
+        self.check_group = check_group
+
+    def xwalk_key(self):
+        return self.xwalk.__table__.c[self.key_name]
+
+
+def _poverty_source():
+    conf = app.config["XWALK_POVERTY_GEOMETRY"]
+    if not conf:
+        return None
+    schema, name = conf["table"].split(".")
+    geo_table = Table(name, MetaData(),
+                      Column(conf["key"], String, primary_key=True),
+                      Column(conf["country"], String),
+                      Column(conf["geom"], Geometry),
+                      schema=schema)
+    return Source("poverty", PovertyXWalk, "poverty_geo", geo_table.c[conf["key"]],
+                  geo_table.c[conf["country"]], geo_table.c[conf["geom"]],
+                  lambda key: func.substr(key, 1, 3))
+
+
+def sources():
+    found = {"dhs": Source("dhs", DHSXWalk, "dhs_geo", DHSGeo.dhs_geo, DHSGeo.iso, DHSGeo.geom,
+                           lambda key: func.right(key, 4))}
+    poverty = _poverty_source()
+    if poverty is not None:
+        found["poverty"] = poverty
+    return found
+
+
+def _execute(qry):
+    '''All rows of qry, free of the API's statement timeout'''
+    with db.engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute("SET LOCAL statement_timeout = 0")
+        return conn.execute(qry).fetchall()
+
+
+def _geometry_hash(key, geom):
+    return func.concat(key, ":", func.md5(func.ST_AsEWKB(geom)))
+
+
+def target_fingerprint():
+    '''Hash of every Cell5M geometry'''
+    entry = _geometry_hash(Cell5M.geo, Cell5M.geom)
+    qry = select([func.md5(func.string_agg(
+        entry, aggregate_order_by(literal_column("','"), Cell5M.geo)))])
+    return _execute(qry)[0][0] or ""
+
+
+def fingerprints(source):
+    '''{country: hash of its source geometries, the targets and ALGORITHM}'''
+    entry = _geometry_hash(source.key, source.geom)
+    qry = select([source.country, func.md5(func.string_agg(
+        entry, aggregate_order_by(literal_column("','"), source.key)))]) \
+        .where(source.country.isnot(None)) \
+        .group_by(source.country)
+    targets = target_fingerprint()
+    return {country: hashlib.md5("{}|{}|{}".format(digest, targets, ALGORITHM)
+                                 .encode("utf-8")).hexdigest()
+            for country, digest in _execute(qry)}
+
+
+def stored_fingerprints(source):
+    state_table.create(db.engine, checkfirst=True)
+    qry = select([state_table.c.country, state_table.c.fingerprint]) \
+        .where(state_table.c.xwalk == source.name)
+    return dict(db.engine.execute(qry).fetchall())
+
+
+def overlaps(source, country):
+    '''Crosswalk rows of one country as (key, geo, st_area, pct_overlap)'''
+    intersection = func.ST_Intersection(source.geom, Cell5M.geom)
+    qry = select([source.key, Cell5M.geo,
+                  func.ST_Area(func.geography(intersection)),
+                  func.ST_Area(func.geography(Cell5M.geom))]) \
+        .where(source.country == country) \
+        .where(func.ST_Intersects(source.geom, Cell5M.geom)) \
+        .where(func.substr(Cell5M.geo, 1, 3) == func.substr(source.key, 1, 3))
+    rows = []
+    for key, geo, area, geo_area in _execute(qry):
+        # neighbours that only share a border intersect with no area
+        if area and geo_area:
+            rows.append((key, geo, area, 100.0 * area / geo_area))
+    return rows
+
+
+def _init_worker():
+    # never reuse connections inherited from the parent
+    db.engine.dispose()
+
+
+def _compute(task):
+    name, country = task
+    start = time.time()
+    rows = overlaps(sources()[name], country)
+    return name, country, rows, time.time() - start
+
+
+def _store(source, country, fingerprint, rows, seconds):
+    xwalk_table = source.xwalk.__table__
+    columns = [source.key_name, "geo", "st_area", "pct_overlap"]
+    country_keys = select([source.key]).where(source.country == country)
+    with db.engine.begin() as conn:
+        conn.execute(xwalk_table.delete().where(source.xwalk_key().in_(country_keys)))
+        bulk.copy_rows(conn, xwalk_table, columns, rows)
+        conn.execute(state_table.delete().where(state_table.c.xwalk == source.name)
+                     .where(state_table.c.country == country))
+        conn.execute(state_table.insert(), {
+            "xwalk": source.name, "country": country, "fingerprint": fingerprint,
+            "rows": len(rows), "seconds": seconds, "built": datetime.datetime.utcnow()})
+
+
+def _remove_stale(source, countries):
+    '''Drop rows of regions that no longer exist and state of countries
+    that no longer have any region. Only levels the source has polygons
+    for are touched, so e.g. hand-made adm0 rows are kept.'''
+    levels = select([func.substr(source.key, 1, 3)]).distinct()
+    with db.engine.begin() as conn:
+        removed = conn.execute(source.xwalk.__table__.delete()
+                               .where(func.substr(source.xwalk_key(), 1, 3).in_(levels))
+                               .where(~source.xwalk_key().in_(select([source.key])))).rowcount
+        conn.execute(state_table.delete().where(state_table.c.xwalk == source.name)
+                     .where(~state_table.c.country.in_(countries or [""])))
+    return removed
+
+
+def build(names=None, workers=None, force=False, progress=None):
+    '''Recompute the changed countries of the named sources (default all).
+    Returns per source the countries rebuilt and skipped, rows written
+    and rows removed.'''
+    available = sources()
+    names = names or sorted(available)
+    workers = workers or app.config["XWALK_WORKERS"]
+    results = {}
+    tasks = []
+    wanted = {}
+    for name in names:
+        source = available[name]
+        current = fingerprints(source)
+        stored = {} if force else stored_fingerprints(source)
+        changed = sorted(country for country, digest in current.items()
+                         if stored.get(country) != digest)
+        wanted[name] = current
+        results[name] = {"rebuilt": {}, "skipped": sorted(set(current) - set(changed)),
+                         "rows": 0, "removed": 0}
+        tasks += [(name, country) for country in changed]
+
+    if tasks:
+        state_table.create(db.engine, checkfirst=True)
+        db.session.remove()
+        db.engine.dispose()
+        pool = multiprocessing.Pool(min(workers, len(tasks)), initializer=_init_worker)
+        try:
+            for name, country, rows, seconds in pool.imap_unordered(_compute, tasks):
+                _store(available[name], country, wanted[name][country], rows, seconds)
+                results[name]["rebuilt"][country] = seconds
+                results[name]["rows"] += len(rows)
+                if progress:
+                    progress(name, country, len(rows), seconds)
+        finally:
+            pool.close()
+            pool.join()
+
+    for name in names:
+        results[name]["removed"] = _remove_stale(available[name], list(wanted[name]))
+    return results
+
+
+def check(source, tolerance):
+    '''Sum of pct_overlap per geo and check group. Geos fully covered sum
+    to 100; a sum above 100 + tolerance means overlapping regions.
+    Returns (groups checked, covered, partial, [(geo, group, sum)] over)'''
+    xwalk_table = source.xwalk.__table__
+    group = source.check_group(source.xwalk_key())
+    qry = select([xwalk_table.c.geo, group, func.sum(xwalk_table.c.pct_overlap)]) \
+        .group_by(xwalk_table.c.geo, group)
+    covered = partial = 0
+    over = []
+    rows = _execute(qry)
+    for geo, group_val, total in rows:
+        if total > 100 + tolerance:
+            over.append((geo, group_val, total))
+        elif total >= 100 - tolerance:
+            covered += 1
+        else:
+            partial += 1
+    return len(rows), covered, partial, sorted(over, key=lambda item: -item[2])
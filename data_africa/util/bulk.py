@@ -0,0 +1,52 @@
+'''Bulk loading of rows into a table
+
+On Postgres rows are streamed through COPY ... FROM STDIN as CSV, on the
+connection's current transaction. Other databases get a plain executemany
+insert.
+'''
+import csv
+
+import six
+
+
+def _csv_value(value):
+    # COPY reads an unquoted empty field as NULL
+    return "" if value is None else value
+
+
+def copy_rows(conn, table, columns, rows, batch_size=50000):
+    '''Load rows (sequences in columns order) into a sqlalchemy Table
+    using conn, a Connection inside a transaction. Returns the row count.'''
+    count = 0
+    if conn.dialect.name != "postgresql":
+        batch = []
+        for row in rows:
+            batch.append(dict(zip(columns, row)))
+            count += 1
+            if len(batch) >= batch_size:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+        return count
+
+    statement = "COPY {} ({}) FROM STDIN WITH CSV".format(
+        table.fullname, ", ".join('"{}"'.format(col) for col in columns))
+    cursor = conn.connection.cursor()
+    try:
+        buf = six.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([_csv_value(value) for value in row])
+            count += 1
+            if count % batch_size == 0:
+                buf.seek(0)
+                cursor.copy_expert(statement, buf)
+                buf = six.StringIO()
+                writer = csv.writer(buf)
+        if buf.tell():
+            buf.seek(0)
+            cursor.copy_expert(statement, buf)
+    finally:
+        cursor.close()
+    return count
@@ -0,0 +1,246 @@
+'''Byte-bounded cache shared by all workers on a host
+
+LocalCache keeps every entry in one SQLite database in write-ahead-log mode,
+so any number of gunicorn workers can read concurrently while one writes.
+Entries belong to a namespace chosen by key prefix (see CACHE_NAMESPACES).
+Each namespace has a byte quota and the whole cache has a byte cap.
+Triggers keep a running byte count per namespace. When a write pushes a
+namespace or the cache over its limit, expired entries are dropped first,
+then the least recently used ones. Writes also drop every expired entry,
+at most once per PURGE_INTERVAL seconds in each process.
+
+Use it through Flask-Cache with
+    CACHE_TYPE = 'data_africa.util.local_cache.local_cache'
+'''
+import os
+import sqlite3
+import threading
+import time
+
+from six.moves import cPickle as pickle
+from werkzeug.contrib.cache import BaseCache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (namespace, accessed);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS usage (
+    namespace TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT OR IGNORE INTO usage VALUES (NEW.namespace, 0);
+    UPDATE usage SET bytes = bytes + NEW.size WHERE namespace = NEW.namespace;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE usage SET bytes = bytes - OLD.size WHERE namespace = OLD.namespace;
+END;
+'''
+
+# refresh an entry's LRU timestamp at most this often (seconds), so hot keys
+# do not turn every read into a write
+ACCESS_RESOLUTION = 1.0
+EVICT_BATCH = 64
+PURGE_INTERVAL = 60.0
+
+
+class LocalCache(BaseCache):
+    def __init__(self, path, max_bytes, namespaces=None, default_timeout=300,
+                 busy_timeout=5.0):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.max_bytes = max_bytes
+        # [(name, key prefix, quota in bytes)], first matching prefix wins
+        self.namespaces = list(namespaces or [])
+        self.quotas = dict((name, quota) for name, _, quota in self.namespaces)
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._counts = {}
+        self._counts_lock = threading.Lock()
+        self._purged = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # never reuse a connection inherited through fork
+            local.conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                         isolation_level=None)
+            local.conn.execute("PRAGMA journal_mode = WAL")
+            local.conn.execute("PRAGMA synchronous = NORMAL")
+            local.pid = os.getpid()
+        return local.conn
+
+    def namespace(self, key):
+        for name, prefix, _ in self.namespaces:
+            if key.startswith(prefix):
+                return name
+        return "default"
+
+    def _count(self, key, hit):
+        namespace = self.namespace(key)
+        with self._counts_lock:
+            counts = self._counts.setdefault(namespace, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else 0
+
+    def _normalize_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return timeout
+
+    def get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires, accessed FROM entries WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None or (row[1] and row[1] <= now):
+            self._count(key, False)
+            return None
+        if now - row[2] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        try:
+            value = pickle.loads(bytes(row[0]))
+        except Exception:
+            self._count(key, False)
+            return None
+        self._count(key, True)
+        return value
+
+    def _store(self, key, value, timeout, replace):
+        blob = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        namespace = self.namespace(key)
+        size = len(blob) + len(key)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and not replace and not (row[0] and row[0] <= now):
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, namespace, blob, size, self._expires(timeout), now))
+            if now - self._purged >= PURGE_INTERVAL:
+                self.purge_expired(conn, now)
+            self._enforce(conn, namespace, key)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def _usage(self, conn, namespace=None):
+        if namespace is None:
+            row = conn.execute("SELECT SUM(bytes) FROM usage").fetchone()
+        else:
+            row = conn.execute("SELECT bytes FROM usage WHERE namespace = ?",
+                               (namespace,)).fetchone()
+        return (row and row[0]) or 0
+
+    def _over(self, conn, namespace):
+        '''Bytes above the namespace quota, or above the cache cap when
+        namespace is None'''
+        if namespace is None:
+            return self._usage(conn) - self.max_bytes if self.max_bytes else 0
+        quota = self.quotas.get(namespace)
+        return self._usage(conn, namespace) - quota if quota else 0
+
+    def _evict(self, conn, namespace, keep):
+        '''Drop expired entries, then the least recently used ones, until
+        the namespace (or the whole cache when namespace is None) fits.
+        The entry being written is kept.'''
+        where, params = ("WHERE namespace = ?", [namespace]) if namespace else ("", [])
+        conn.execute("DELETE FROM entries WHERE expires > 0 AND expires <= ?" +
+                     (" AND namespace = ?" if namespace else ""),
+                     [time.time()] + params)
+        excess = self._over(conn, namespace)
+        while excess > 0:
+            rows = conn.execute(
+                "SELECT key, size FROM entries {} ORDER BY accessed LIMIT ?".format(where),
+                params + [EVICT_BATCH]).fetchall()
+            victims = []
+            for key, size in rows:
+                if key == keep:
+                    continue
+                victims.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            if not victims:
+                break
+            conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+
+    def purge_expired(self, conn=None, now=None):
+        '''Drop every expired entry, returning how many were dropped'''
+        now = time.time() if now is None else now
+        self._purged = now
+        cur = (conn or self._conn()).execute(
+            "DELETE FROM entries WHERE expires > 0 AND expires <= ?", (now,))
+        return cur.rowcount
+
+    def _enforce(self, conn, namespace, key):
+        for scope in [namespace, None]:
+            if self._over(conn, scope) > 0:
+                self._evict(conn, scope, key)
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, timeout, replace=True)
+
+    def add(self, key, value, timeout=None):
+        return self._store(key, value, timeout, replace=False)
+
+    def delete(self, key):
+        cur = self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+        return cur.rowcount > 0
+
+    def has(self, key):
+        row = self._conn().execute("SELECT expires FROM entries WHERE key = ?",
+                                   (key,)).fetchone()
+        return row is not None and not (row[0] and row[0] <= time.time())
+
+    def clear(self):
+        self._conn().execute("DELETE FROM entries")
+        return True
+
+    def counts(self):
+        '''Hit and miss counts of this process by namespace'''
+        with self._counts_lock:
+            return dict((name, dict(vals)) for name, vals in self._counts.items())
+
+    def stats(self):
+        '''Hit and miss counts of this process plus shared usage in bytes'''
+        conn = self._conn()
+        counts = self.counts()
+        usage = dict(conn.execute("SELECT namespace, bytes FROM usage").fetchall())
+        entries = dict(conn.execute(
+            "SELECT namespace, COUNT(*) FROM entries GROUP BY namespace").fetchall())
+        names = set(counts) | set(usage) | set(self.quotas)
+        return dict((name, {
+            "hits": counts.get(name, {}).get("hits", 0),
+            "misses": counts.get(name, {}).get("misses", 0),
+            "bytes": usage.get(name, 0),
+            "entries": entries.get(name, 0),
+            "quota": self.quotas.get(name),
+        }) for name in names)
+
+
+def local_cache(app, config, args, kwargs):
+    '''Flask-Cache factory for CACHE_TYPE'''
+    path = os.path.join(config["CACHE_DIR"], "cache.sqlite")
+    return LocalCache(path, config["CACHE_LOCAL_MAX_BYTES"],
+                      namespaces=config["CACHE_NAMESPACES"], *args, **kwargs)
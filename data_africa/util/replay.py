@@ -0,0 +1,171 @@
+'''Replay lists of API requests against the app, either in-process through
+the Flask test client or against a running server'''
+import math
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import simplejson
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlsplit
+from six.moves.urllib.request import urlopen
+from werkzeug.exceptions import HTTPException
+
+from data_africa import app
+
+# endpoints whose responses (or the metadata behind them) are worth warming
+WARMABLE_PREFIXES = ("/api/", "/attrs/")
+
+
+def normalize_url(raw):
+    '''Reduce a full URL or a path to path?query'''
+    parts = urlsplit(raw.strip())
+    url = parts.path or "/"
+    if parts.query:
+        url = "{}?{}".format(url, parts.query)
+    return url
+
+
+def parse_line(line):
+    '''A line is either a bare URL or a JSON record with a url field'''
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        record = simplejson.loads(line)
+        if "url" in record:
+            return normalize_url(record["url"])
+        if "path" in record:
+            args = record.get("args")
+            return "{}?{}".format(record["path"], args) if args else record["path"]
+        return None
+    return normalize_url(line)
+
+
+def read_urls(paths):
+    urls = []
+    for path in paths:
+        with open(path) as handle:
+            for line in handle:
+                url = parse_line(line)
+                if url:
+                    urls.append(url)
+    return urls
+
+
+def endpoint_for(url):
+    adapter = app.url_map.bind("localhost")
+    try:
+        endpoint, _ = adapter.match(urlsplit(url).path)
+    except HTTPException:
+        return None
+    return endpoint
+
+
+def warmable_endpoints():
+    return sorted(set(rule.endpoint for rule in app.url_map.iter_rules()
+                      if rule.rule.startswith(WARMABLE_PREFIXES)))
+
+
+def fetch(url, base_url=None):
+    '''Issue a single request, consuming the full body.
+    Returns (status, response bytes, seconds elapsed).'''
+    start = time.time()
+    if base_url:
+        try:
+            resp = urlopen(base_url.rstrip("/") + url)
+            status, body = resp.getcode(), resp.read()
+        except HTTPError as err:
+            status, body = err.code, err.read()
+    else:
+        resp = app.test_client().get(url)
+        status, body = resp.status_code, resp.get_data()
+    return status, len(body), time.time() - start
+
+
+def run(urls, workers=8, base_url=None):
+    '''Replay urls with a pool of workers, returning one result dict per url'''
+    def job(url):
+        try:
+            status, size, elapsed = fetch(url, base_url)
+        except Exception as err:  # keep going, report the failure
+            status, size, elapsed = None, 0, 0.0
+            app.logger.warning("Replay of %s failed: %s", url, err)
+        return {"url": url, "endpoint": endpoint_for(url), "status": status,
+                "bytes": size, "elapsed": elapsed}
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(job, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of an unsorted list'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+def load(urls, concurrency=8, rate=None, base_url=None):
+    '''Drive the app with urls at a fixed concurrency, optionally paced to
+    rate requests per second overall. Returns (results, wall seconds).'''
+    lock = threading.Lock()
+    state = {"next": 0}
+    results = []
+    start = time.time()
+
+    def worker():
+        while True:
+            with lock:
+                idx = state["next"]
+                state["next"] += 1
+            if idx >= len(urls):
+                return
+            if rate:
+                delay = start + idx / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            url = urls[idx]
+            try:
+                status, size, elapsed = fetch(url, base_url)
+            except Exception as err:  # count as an error and keep going
+                status, size, elapsed = None, 0, 0.0
+                app.logger.warning("Replay of %s failed: %s", url, err)
+            with lock:
+                results.append({"url": url, "endpoint": endpoint_for(url),
+                                "status": status, "bytes": size,
+                                "elapsed": elapsed})
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def summarize(results, wall):
+    '''Throughput and latency percentiles (ms) per endpoint and overall'''
+    groups = {}
+    for res in results:
+        groups.setdefault(res["endpoint"] or "(unrouted)", []).append(res)
+    groups["(all)"] = results
+
+    summary = {}
+    for endpoint, items in groups.items():
+        latencies = [1000 * res["elapsed"] for res in items]
+        summary[endpoint] = {
+            "count": len(items),
+            "errors": sum(1 for res in items if res["status"] != 200),
+            "rps": len(items) / wall if wall else 0.0,
+            "bytes": sum(res["bytes"] for res in items),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+    return summary
@@ -0,0 +1,46 @@
+'''gunicorn settings, used with: gunicorn -c gunicorn_conf.py data_africa:app
+
+The app is preloaded in the master so metadata and lookup structures are
+built once and shared copy-on-write by all workers. Set
+DATA_AFRICA_PRELOAD=0 to let every worker import the app on its own.
+'''
+import glob
+import os
+import time
+
+bind = os.environ.get("DATA_AFRICA_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("DATA_AFRICA_WORKERS", 4))
+timeout = 120
+preload_app = os.environ.get("DATA_AFRICA_PRELOAD", "1") != "0"
+
+# optional file receiving one line per booted worker, used by bench_startup
+boot_log = os.environ.get("DATA_AFRICA_BOOT_LOG")
+
+
+def on_starting(server):
+    # counters restart with the server, drop the files of earlier workers
+    import config
+    for pattern in ["*.json", "*.totals"]:
+        for path in glob.glob(os.path.join(config.METRICS_DIR, pattern)):
+            os.remove(path)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from data_africa.core import preload
+        preload.preload()
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.time()
+    if server.cfg.preload_app:
+        from data_africa.core import pool_stats
+        pool_stats.reset()
+
+
+def post_worker_init(worker):
+    elapsed = time.time() - worker.boot_started
+    worker.log.info("Worker %s booted in %.3fs", worker.pid, elapsed)
+    if boot_log:
+        with open(boot_log, "a") as handle:
+            handle.write("{} {:.6f}\n".format(worker.pid, elapsed))
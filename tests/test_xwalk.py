@@ -0,0 +1,140 @@
+'''Crosswalk checks and the choice of countries to rebuild, with every
+database call replaced by canned results'''
+import pytest
+from sqlalchemy import func
+
+from data_africa.spatial import xwalk
+from data_africa.spatial.models import DHSXWalk
+
+
+def dhs_source():
+    return xwalk.Source("dhs", DHSXWalk, "dhs_geo", None, None, None,
+                        lambda key: func.right(key, 4))
+
+
+def run_check(monkeypatch, rows, tolerance=1.0):
+    monkeypatch.setattr(xwalk, "_execute", lambda qry: rows)
+    return xwalk.check(dhs_source(), tolerance)
+
+
+def test_check_counts_covered_and_partial_groups(monkeypatch):
+    rows = [("050AF001", "2008", 100.0), ("050AF002", "2008", 60.0),
+            ("050AF001", "2014", 100.0)]
+    assert run_check(monkeypatch, rows) == (3, 2, 1, [])
+
+
+def test_check_applies_tolerance(monkeypatch):
+    rows = [("050AF001", "2008", 99.5), ("050AF002", "2008", 100.9),
+            ("050AF003", "2008", 98.9), ("050AF004", "2008", 101.1)]
+    groups, covered, partial, over = run_check(monkeypatch, rows)
+    assert (groups, covered, partial) == (4, 2, 1)
+    assert over == [("050AF004", "2008", 101.1)]
+
+    groups, covered, partial, over = run_check(monkeypatch, rows, tolerance=0.0)
+    assert (covered, partial, len(over)) == (0, 2, 2)
+
+
+def test_check_lists_overlapping_groups_largest_first(monkeypatch):
+    rows = [("050AF001", "2008", 130.0), ("050AF002", "2008", 100.0),
+            ("050AF003", "2014", 180.0), ("050AF004", "2014", 101.5)]
+    groups, covered, partial, over = run_check(monkeypatch, rows)
+    assert (groups, covered, partial) == (4, 1, 0)
+    assert over == [("050AF003", "2014", 180.0), ("050AF001", "2008", 130.0),
+                    ("050AF004", "2014", 101.5)]
+
+
+class InlinePool(object):
+    '''multiprocessing.Pool running tasks in the calling process'''
+
+    def __init__(self, processes, initializer=None):
+        self.processes = processes
+
+    def imap_unordered(self, func, tasks):
+        return [func(task) for task in tasks]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class FakeDB(object):
+    class session(object):
+        @staticmethod
+        def remove():
+            pass
+
+    class engine(object):
+        @staticmethod
+        def dispose():
+            pass
+
+
+@pytest.fixture
+def build_env(monkeypatch):
+    '''Stubs around build(); returns the fingerprints to serve and a log
+    of the computed, stored and pruned countries'''
+    env = {"current": {}, "stored": {}, "computed": [], "stored_rows": [],
+           "pools": [], "stale": []}
+    source = dhs_source()
+
+    def pool(processes, initializer=None):
+        env["pools"].append(processes)
+        return InlinePool(processes, initializer)
+
+    def overlaps(src, country):
+        env["computed"].append(country)
+        return [("050HG{}".format(country), "050AF001", 1.0, 100.0)]
+
+    def store(src, country, fingerprint, rows, seconds):
+        env["stored_rows"].append((country, fingerprint, len(rows)))
+
+    def remove_stale(src, countries):
+        env["stale"].append(sorted(countries))
+        return 0
+
+    monkeypatch.setattr(xwalk, "sources", lambda: {"dhs": source})
+    monkeypatch.setattr(xwalk, "fingerprints", lambda src: dict(env["current"]))
+    monkeypatch.setattr(xwalk, "stored_fingerprints", lambda src: dict(env["stored"]))
+    monkeypatch.setattr(xwalk, "overlaps", overlaps)
+    monkeypatch.setattr(xwalk, "_store", store)
+    monkeypatch.setattr(xwalk, "_remove_stale", remove_stale)
+    monkeypatch.setattr(xwalk.state_table, "create", lambda *args, **kwargs: None)
+    monkeypatch.setattr(xwalk, "db", FakeDB)
+    monkeypatch.setattr(xwalk.multiprocessing, "Pool", pool)
+    return env
+
+
+def test_build_rebuilds_only_changed_countries(build_env):
+    build_env["current"] = {"KE": "a", "ET": "b2", "TZ": "c"}
+    build_env["stored"] = {"KE": "a", "ET": "b1"}
+    results = xwalk.build(workers=8)["dhs"]
+    assert sorted(results["rebuilt"]) == ["ET", "TZ"]
+    assert results["skipped"] == ["KE"]
+    assert results["rows"] == 2
+    assert sorted(build_env["computed"]) == ["ET", "TZ"]
+    assert sorted(build_env["stored_rows"]) == [("ET", "b2", 1), ("TZ", "c", 1)]
+    # never more workers than countries to compute
+    assert build_env["pools"] == [2]
+    assert build_env["stale"] == [["ET", "KE", "TZ"]]
+
+
+def test_build_skips_everything_when_unchanged(build_env):
+    build_env["current"] = {"KE": "a", "ET": "b"}
+    build_env["stored"] = {"KE": "a", "ET": "b", "UG": "gone"}
+    results = xwalk.build(workers=8)["dhs"]
+    assert results["rebuilt"] == {}
+    assert results["skipped"] == ["ET", "KE"]
+    assert build_env["pools"] == []
+    assert build_env["computed"] == []
+    # countries without regions any more are still pruned
+    assert build_env["stale"] == [["ET", "KE"]]
+
+
+def test_build_force_recomputes_every_country(build_env):
+    build_env["current"] = {"KE": "a", "ET": "b"}
+    build_env["stored"] = {"KE": "a", "ET": "b"}
+    results = xwalk.build(workers=8, force=True)["dhs"]
+    assert sorted(results["rebuilt"]) == ["ET", "KE"]
+    assert results["skipped"] == []